@@ -0,0 +1,48 @@
+"""Scaling benchmark for RooftopProc.convert_multipgons_to_pgons.
+
+Usage: python benchmarks/bench_explode.py [max_rows]
+"""
+import sys
+import time
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import box, MultiPolygon, GeometryCollection, LineString
+from rooftop.rooftop import RooftopProc
+
+
+def synthetic_gdf(n, seed=0):
+    """n rows mixing polygons, 2-part multipolygons and overlay-style collections"""
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(0, 1e5, n)
+    y = rng.uniform(0, 1e5, n)
+    geoms = []
+    for i in range(n):
+        a = box(x[i], y[i], x[i] + 10, y[i] + 10)
+        b = box(x[i] + 20, y[i], x[i] + 30, y[i] + 10)
+        kind = i % 3
+        if kind == 0:
+            geoms.append(a)
+        elif kind == 1:
+            geoms.append(MultiPolygon([a, b]))
+        else:
+            geoms.append(GeometryCollection([a, LineString([(x[i], y[i]), (x[i], y[i] + 5)])]))
+    return gpd.GeoDataFrame({'faid': np.arange(n), 'flat_area': rng.random(n)},
+                            geometry=geoms, crs=32612)
+
+
+def main(max_rows=100000):
+    # convert_multipgons_to_pgons does not touch instance state
+    proc = RooftopProc.__new__(RooftopProc)
+    n = 1000
+    print('{:>10} {:>10} {:>12}'.format('rows', 'seconds', 'rows/s'))
+    while n <= max_rows:
+        gdf = synthetic_gdf(n)
+        start = time.perf_counter()
+        proc.convert_multipgons_to_pgons(gdf)
+        elapsed = time.perf_counter() - start
+        print('{:>10} {:>10.4f} {:>12.0f}'.format(n, elapsed, n / elapsed))
+        n *= 10
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
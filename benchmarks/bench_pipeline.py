@@ -0,0 +1,225 @@
+"""End to end benchmark of the RooftopProc stages on a synthetic city.
+
+Every stage runs against a local S3 stand-in (see local_s3.py) and is timed
+for wall time, throughput (buildings/s and pixels/s) and peak resident memory.
+Results can be saved as a baseline and later runs checked against it, failing
+(exit code 1) when a stage gets slower or bigger than the tolerance allows.
+
+Usage:
+    python benchmarks/bench_pipeline.py --bldgs 1000
+    python benchmarks/bench_pipeline.py --bldgs 100000 --block-size 2048 --memmap
+    python benchmarks/bench_pipeline.py --bldgs 1000 --footprints-only
+    python benchmarks/bench_pipeline.py --bldgs 1000 --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_pipeline.py --bldgs 1000 --baseline benchmarks/baseline.json --tolerance 0.25
+
+baseline.json holds the timings of the 1000 and 10000 building cities on the
+machine that last saved them; refresh it with --save-baseline when a change makes
+a stage faster on purpose, so later regressions are measured from there.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import threading
+import numpy as np
+from synthetic_city import make_city
+from local_s3 import local_s3
+from rooftop.rooftop import RooftopProc
+
+FEATURES = ['average_slope', 'height', 'volume_on_roof', 'parapet', 'parapet_height',
+            'closeness_to_pts', 'sun_exposure']
+# One day at a coarse step keeps the sun sweep comparable in cost to the rest.
+FEATURE_KWARGS = {'ctp_paths': ['pts.parquet'], 'ctp_k': 3,
+                  'sun_dates': ['2021-06-21'], 'sun_step': 120}
+SWEEP_SLOPES = [5, 8, 11, 14]
+SWEEP_AREAS = [5, 9, 15]
+N_SCENARIOS = 64
+SLACK = {'seconds': 0.05, 'peak_rss_mb': 16}
+
+
+class PeakRss(object):
+
+    """Samples the resident set size in a background thread and keeps the peak
+    since start(). Falls back to the process-wide peak (getrusage) where
+    /proc is not available."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            scale = 1 if sys.platform == 'darwin' else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def start(self):
+        self.peak = self.current()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+        return self.peak
+
+
+def run_stage(results, name, func, n_bldgs, n_pixels):
+    """Runs func() and records wall time, throughput and peak RSS under name"""
+    rss = PeakRss()
+    rss.start()
+    start = time.perf_counter()
+    out = func()
+    seconds = time.perf_counter() - start
+    peak = rss.stop()
+    results[name] = {'seconds': seconds,
+                     'bldgs_per_s': n_bldgs / seconds if seconds else float('inf'),
+                     'pixels_per_s': n_pixels / seconds if seconds else float('inf'),
+                     'peak_rss_mb': peak / 2**20}
+    print('{:<24} {:>9.3f} {:>12.0f} {:>14.0f} {:>10.1f}'.format(
+        name, seconds, results[name]['bldgs_per_s'], results[name]['pixels_per_s'],
+        results[name]['peak_rss_mb']))
+    return out
+
+
+def run(n_bldgs, lot=24, block_size=None, memmap=False, footprints_only=False, seed=0):
+    """Runs the whole pipeline once and returns {stage: metrics}"""
+    dsm, hfdem, bldgs, meta = make_city(n_bldgs, lot=lot, seed=seed)
+    n_pixels = dsm.size
+    print('{} buildings, {}x{} pixels'.format(n_bldgs, meta['height'], meta['width']))
+    print('{:<24} {:>9} {:>12} {:>14} {:>10}'.format('stage', 'seconds', 'bldgs/s',
+                                                    'pixels/s', 'peak MB'))
+    results = {}
+    main_dir = 'bench/'
+    with local_s3() as S3:
+        def upload():
+            S3.write_raster_to_s3(dsm, main_dir + 'dsm.tif', meta, cog=True)
+            S3.write_raster_to_s3(hfdem, main_dir + 'hfdem.tif', meta, cog=True)
+            S3.write_gdf_to_s3(bldgs, main_dir + 'bldgs.parquet')
+            # Points for closeness_to_pts: every tenth building's centre.
+            pts = bldgs.iloc[::10][['fid', 'geometry']].copy()
+            pts['geometry'] = pts.representative_point()
+            S3.write_gdf_to_s3(pts, main_dir + 'pts.parquet')
+        run_stage(results, 'upload_inputs', upload, n_bldgs, 2 * n_pixels)
+        del dsm, hfdem
+
+        proc = run_stage(results, 'load', lambda: RooftopProc(
+            S3, main_dir, 'dsm.tif', 'hfdem.tif', 'bldgs.parquet', 'fid', memmap=memmap).load(),
+            n_bldgs, n_pixels)
+        run_stage(results, 'create_slope_arr',
+                  lambda: proc.create_slope_arr('slope.tif', block_size=block_size,
+                                                footprints_only=footprints_only),
+                  n_bldgs, n_pixels)
+        run_stage(results, 'create_height_arr',
+                  lambda: proc.create_height_arr('height.tif', block_size=block_size),
+                  n_bldgs, n_pixels)
+        run_stage(results, 'slope_histograms', proc.slope_histograms, n_bldgs, n_pixels)
+        run_stage(results, 'pitched_roof_sweep',
+                  lambda: proc.pitched_roof_sweep(SWEEP_SLOPES, SWEEP_AREAS),
+                  n_bldgs, n_pixels)
+        proc.release('dsm', 'hfdem')
+        flat_bldgs = run_stage(results, 'pitched_roof_filter',
+                               lambda: proc.pitched_roof_filter(11, 9), n_bldgs, n_pixels)
+        rooftops = run_stage(results, 'flat_area_disaggregator',
+                             lambda: proc.flat_area_disaggregator(flat_bldgs, 45, 93.903,
+                                                                  'flat_area.parquet'),
+                             n_bldgs, n_pixels)
+        run_stage(results, 'flat_area_sweep',
+                  lambda: proc.flat_area_sweep(SWEEP_SLOPES), n_bldgs, n_pixels)
+        # One stage per feature so a regression points at the feature; the
+        # columns accumulate so index_builder sees them all.
+        full = rooftops
+        for name in FEATURES:
+            full = run_stage(results, 'feature_' + name,
+                             lambda: proc.feature_builder(full, [name], **FEATURE_KWARGS),
+                             n_bldgs, n_pixels)
+        run_stage(results, 'index_builder',
+                  lambda: proc.index_builder(full, out_fname='main_index.parquet'),
+                  n_bldgs, n_pixels)
+        weights = np.random.default_rng(seed).random((N_SCENARIOS, len(proc.col_names)))
+        run_stage(results, 'index_scenarios',
+                  lambda: proc.index_scenarios(full, list(weights)),
+                  n_bldgs, n_pixels)
+    return results
+
+
+def check(results, baseline, tolerance, slack=None):
+    """Stages whose wall time or peak RSS exceed the baseline by more than
+    tolerance (a fraction) and by more than the absolute slack of the metric,
+    which keeps millisecond stages from failing on timer noise"""
+    slack = dict(SLACK, **(slack or {}))
+    failures = []
+    for stage, base in baseline.items():
+        if stage not in results:
+            continue
+        for metric in ('seconds', 'peak_rss_mb'):
+            limit = max(base[metric] * (1 + tolerance), base[metric] + slack[metric])
+            if results[stage][metric] > limit:
+                failures.append('{} {}: {:.3f} > {:.3f}'.format(
+                    stage, metric, results[stage][metric], limit))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bldgs', type=int, default=1000, help='number of buildings')
+    parser.add_argument('--lot', type=int, default=24, help='lot size in pixels')
+    parser.add_argument('--block-size', type=int, default=None,
+                        help='block size for slope and height')
+    parser.add_argument('--memmap', action='store_true', help='memory-map rasters')
+    parser.add_argument('--footprints-only', action='store_true',
+                        help='compute slope only around footprints')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='JSON baseline to check against')
+    parser.add_argument('--save-baseline', help='store results as a baseline in this file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown/growth over the baseline (fraction)')
+    args = parser.parse_args()
+
+    results = run(args.bldgs, lot=args.lot, block_size=args.block_size, memmap=args.memmap,
+                  footprints_only=args.footprints_only)
+    # Baselines are kept per scale so one file can track several city sizes.
+    scale = '{}x{}'.format(args.bldgs, args.lot)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({scale: results}, f, indent=2)
+
+    if args.save_baseline:
+        saved = {}
+        if os.path.exists(args.save_baseline):
+            with open(args.save_baseline) as f:
+                saved = json.load(f)
+        saved[scale] = {stage: {'seconds': r['seconds'], 'peak_rss_mb': r['peak_rss_mb']}
+                        for stage, r in results.items()}
+        with open(args.save_baseline, 'w') as f:
+            json.dump(saved, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f).get(scale)
+        if baseline is None:
+            print('No baseline for scale ' + scale)
+            return 0
+        failures = check(results, baseline, args.tolerance)
+        for failure in failures:
+            print('REGRESSION ' + failure)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
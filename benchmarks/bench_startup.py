@@ -0,0 +1,105 @@
+"""Import time and cold start of each rooftop entry point.
+
+Every entry point runs in a fresh interpreter (best of --repeat runs) and is
+checked against a budget in seconds, failing (exit code 1) when one is over.
+Short-lived domain workers pay these costs once per process, so they are kept
+small: heavy dependencies (richdem, scipy.stats, scipy.ndimage, pyarrow.fs, boto3
+resources) are imported or created on first use, and a RooftopProc opens no
+input until a stage needs it.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --scale 2 --repeat 10
+    python benchmarks/bench_startup.py --importtime rooftop.rooftop
+"""
+import sys
+import json
+import argparse
+import subprocess
+
+# Code timed in a fresh interpreter for each entry point. Nothing here touches
+# the network: a worker that has not run a stage yet should not need S3.
+ENTRY_POINTS = {
+    'import rooftop.s3utils': 'import rooftop.s3utils',
+    'import rooftop.rooftop': 'import rooftop.rooftop',
+    'import rooftop.domains': 'import rooftop.domains',
+    'import rooftop.cli': 'import rooftop.cli',
+    'cli --help': 'from rooftop.cli import main\n'
+                  'try:\n'
+                  '    main(["--help"])\n'
+                  'except SystemExit:\n'
+                  '    pass',
+    'worker cold start': 'from rooftop.s3utils import S3Helper\n'
+                         'from rooftop.rooftop import RooftopProc\n'
+                         'S3 = S3Helper("rooftop-bench")\n'
+                         'RooftopProc(S3, "city/", "dsm.tif", "hfdem.tif", "bldgs.parquet", "fid")',
+}
+
+# Seconds on a typical development machine; --scale adjusts for slower ones.
+BUDGETS = {
+    'import rooftop.s3utils': 0.6,
+    'import rooftop.rooftop': 0.6,
+    'import rooftop.domains': 0.6,
+    'import rooftop.cli': 0.1,
+    'cli --help': 0.1,
+    'worker cold start': 0.7,
+}
+
+TIMER = 'import time\n_t = time.perf_counter()\n{}\nprint(time.perf_counter() - _t)'
+
+
+def measure(code, repeat=5):
+    """Best wall time of code over repeat fresh interpreters"""
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', TIMER.format(code)], check=True,
+                             capture_output=True, text=True).stdout
+        times.append(float(out.strip().splitlines()[-1]))
+    return min(times)
+
+
+def importtime(module, top=20):
+    """Prints the modules that take longest to import under module"""
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                         check=True, capture_output=True, text=True).stderr
+    rows = []
+    for line in err.splitlines()[1:]:
+        _, self_us, cumulative, name = [p.strip() for p in line.replace(':', '|', 1).split('|')]
+        rows.append((int(cumulative), int(self_us), name))
+    print('{:>10} {:>10}  module'.format('cum ms', 'self ms'))
+    for cumulative, self_us, name in sorted(rows, reverse=True)[:top]:
+        print('{:>10.1f} {:>10.1f}  {}'.format(cumulative / 1000, self_us / 1000, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per entry')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for the budgets')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--importtime', metavar='MODULE',
+                        help='only print the slowest imports under MODULE')
+    args = parser.parse_args()
+
+    if args.importtime:
+        importtime(args.importtime)
+        return 0
+
+    results, failures = {}, []
+    print('{:<26} {:>9} {:>9}'.format('entry point', 'seconds', 'budget'))
+    for name, code in ENTRY_POINTS.items():
+        results[name] = measure(code, args.repeat)
+        budget = BUDGETS[name] * args.scale
+        print('{:<26} {:>9.3f} {:>9.3f}'.format(name, results[name], budget))
+        if results[name] > budget:
+            failures.append('{}: {:.3f} > {:.3f}'.format(name, results[name], budget))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    for failure in failures:
+        print('OVER BUDGET ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
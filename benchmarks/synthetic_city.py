@@ -0,0 +1,76 @@
+"""Synthetic city generator for benchmarks.
+
+Buildings sit on a square grid of lots. Every lot holds one rectangular
+building of random size and height, cycling through four roof types:
+
+- flat: flat roof with a little noise
+- pitched: gable roof rising to a ridge along the long axis
+- parapet: flat roof with a raised one pixel edge
+- obstructed: flat roof with a raised block (HVAC, stair tower) on top
+"""
+import numpy as np
+import geopandas as gpd
+import rasterio
+from affine import Affine
+from shapely import box
+
+ROOF_TYPES = ('flat', 'pitched', 'parapet', 'obstructed')
+
+
+def make_city(n_bldgs, lot=24, px=1.0, seed=0, epsg=32612):
+    """Builds DSM, HFDEM and footprints for a synthetic city
+
+    Args:
+        n_bldgs (int): number of buildings
+        lot (int, optional): lot size in pixels. Defaults to 24.
+        px (float, optional): pixel size in map units. Defaults to 1.0.
+        seed (int, optional): random seed. Defaults to 0.
+        epsg (int, optional): CRS of the outputs. Defaults to 32612.
+
+    Returns:
+        tuple: (dsm, hfdem, bldgs, meta) with float32 rasters, a footprint gdf
+            with 'fid' and 'roof_type' columns and a rasterio profile
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_bldgs)))
+    size = side * lot
+    transform = Affine(px, 0, 500000, 0, -px, 4000000)
+
+    # Gently sloping terrain with a little noise.
+    rows, cols = np.mgrid[0:size, 0:size].astype('float32')
+    hfdem = 1000 + 0.01 * rows + 0.005 * cols
+    hfdem += rng.normal(0, 0.02, (size, size)).astype('float32')
+    dsm = hfdem.copy()
+
+    i = np.arange(n_bldgs)
+    r0 = (i // side) * lot + rng.integers(2, 4, n_bldgs)
+    c0 = (i % side) * lot + rng.integers(2, 4, n_bldgs)
+    h = rng.integers(lot // 2, lot - 4, n_bldgs)
+    w = rng.integers(lot // 2, lot - 4, n_bldgs)
+    height = rng.uniform(4, 40, n_bldgs)
+    kind = i % len(ROOF_TYPES)
+
+    for b in range(n_bldgs):
+        rs = slice(r0[b], r0[b] + h[b])
+        cs = slice(c0[b], c0[b] + w[b])
+        roof = np.full((h[b], w[b]), height[b], dtype='float32')
+        roof += rng.normal(0, 0.02, roof.shape).astype('float32')
+        if kind[b] == 1:
+            ridge = np.abs(np.arange(h[b]) - (h[b] - 1) / 2)
+            roof += (ridge.max() - ridge)[:, None] * px * 0.6
+        elif kind[b] == 2:
+            roof[[0, -1], :] += 1.2
+            roof[:, [0, -1]] += 1.2
+        elif kind[b] == 3:
+            rr, cc = h[b] // 3, w[b] // 3
+            roof[rr:rr + max(h[b] // 4, 2), cc:cc + max(w[b] // 4, 2)] += 3
+        dsm[rs, cs] += roof
+
+    x0, y0 = transform * (c0, r0)
+    x1, y1 = transform * (c0 + w, r0 + h)
+    bldgs = gpd.GeoDataFrame({'fid': i, 'roof_type': np.asarray(ROOF_TYPES)[kind]},
+                             geometry=box(x0, y1, x1, y0), crs=epsg)
+    meta = dict(driver='GTiff', dtype='float32', nodata=-9999.0, width=size,
+                height=size, count=1, crs=rasterio.crs.CRS.from_epsg(epsg),
+                transform=transform)
+    return dsm, hfdem, bldgs, meta
@@ -0,0 +1,121 @@
+import os
+import fcntl
+import mmap
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+
+class LocalCache(object):
+
+    """
+    On-disk cache for S3 objects keyed by bucket, key and ETag, so a changed
+    object gets a new entry and stale ones age out. Entries are written to a
+    temp file and renamed into place (atomic), a per-entry lock stops
+    concurrent processes from downloading the same object twice, and the least
+    recently used entries are evicted once the cache grows past max_bytes.
+    """
+
+    LOCK_SUFFIX = '.lock'
+    PART_SUFFIX = '.part'
+
+    def __init__(self, cache_dir, max_bytes=10 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_fetched = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, bucket, key, etag):
+        """Local path of the cache entry for one version of an object"""
+        digest = hashlib.sha256('{}/{}@{}'.format(bucket, key, etag).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest + os.path.splitext(key)[1])
+
+    @contextmanager
+    def _lock(self, path):
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, bucket, key, etag, fetch):
+        """Returns the local path of an object, fetching it on a miss
+
+        Args:
+            bucket (str): S3 bucket
+            key (str): S3 key
+            etag (str): current ETag of the object
+            fetch (callable): fetch(fileobj) writes the object into fileobj
+
+        Returns:
+            str: path of the cached copy
+        """
+        path = self.entry_path(bucket, key, etag)
+        with self._lock(path + self.LOCK_SUFFIX):
+            if os.path.exists(path):
+                os.utime(path)
+                self.hits += 1
+                return path
+
+            self.misses += 1
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=self.PART_SUFFIX)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    fetch(f)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            self.bytes_fetched += os.path.getsize(path)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """Removes least recently used entries until the cache fits in max_bytes"""
+        with self._lock(os.path.join(self.cache_dir, self.LOCK_SUFFIX)):
+            entries = []
+            for e in os.scandir(self.cache_dir):
+                if e.is_file() and not e.name.endswith((self.LOCK_SUFFIX, self.PART_SUFFIX)):
+                    st = e.stat()
+                    entries.append((st.st_mtime, st.st_size, e.path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                # Only the data file goes, under its entry lock (skipped if
+                # another process holds it). Lock files stay: removing one
+                # would let two writers lock different inodes for the same
+                # entry. Readers that already opened the file keep their handle.
+                with open(path + self.LOCK_SUFFIX, 'a') as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    try:
+                        if os.path.exists(path):
+                            os.remove(path)
+                    finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+                total -= size
+                self.evictions += 1
+
+    @staticmethod
+    def open_mmap(path):
+        """Memory-maps a cached entry read-only"""
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def stats(self):
+        """Returns hit/miss statistics for this process"""
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions, 'bytes_fetched': self.bytes_fetched}
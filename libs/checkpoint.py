@@ -0,0 +1,77 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+# Bump when a stage changes its output for the same inputs, so old checkpoints
+# stop matching.
+CHECKPOINT_VERSION = 1
+
+
+def stage_key(*parts):
+    """Content hash of everything that determines a stage's output (stage name,
+    input ETags, parameters, keys of upstream stages)"""
+    blob = json.dumps([CHECKPOINT_VERSION] + list(parts), sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()[:20]
+
+
+class CheckpointStore(object):
+
+    """
+    Stage outputs of one job on local disk, one file per stage named by its
+    key. A stage whose key has a file is done; anything that changes the
+    inputs or parameters changes the key, so stale checkpoints are never read.
+    Files are written to a temp file and renamed into place, so a crash never
+    leaves a half-written checkpoint behind.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, stage, key, ext):
+        return os.path.join(self.root, '{}-{}.{}'.format(stage, key, ext))
+
+    def has(self, stage, key, ext):
+        return os.path.exists(self.path(stage, key, ext))
+
+    def _write(self, stage, key, ext, write):
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.part')
+        os.close(fd)
+        try:
+            write(tmp)
+            os.replace(tmp, self.path(stage, key, ext))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        # Older checkpoints of the same stage can't match again.
+        for f in os.listdir(self.root):
+            if f.startswith(stage + '-') and not f.startswith('{}-{}.'.format(stage, key)):
+                os.remove(os.path.join(self.root, f))
+
+    def save_array(self, stage, key, arr):
+        def write(tmp):
+            with open(tmp, 'wb') as f:
+                np.save(f, np.asarray(arr))
+        self._write(stage, key, 'npy', write)
+
+    def load_array(self, stage, key):
+        """Memory-maps a saved array read-only"""
+        return np.load(self.path(stage, key, 'npy'), mmap_mode='r')
+
+    def save_gdf(self, stage, key, gdf, **attrs):
+        """Saves a gdf as GeoParquet; attrs (JSON serializable) are stored next
+        to it and returned by load_gdf()"""
+        def write_attrs(tmp):
+            with open(tmp, 'w') as f:
+                json.dump(attrs, f)
+        self._write(stage, key, 'json', write_attrs)
+        self._write(stage, key, 'parquet', gdf.to_parquet)
+
+    def load_gdf(self, stage, key):
+        """Returns (gdf, attrs) saved by save_gdf()"""
+        import geopandas as gpd
+        gdf = gpd.read_parquet(self.path(stage, key, 'parquet'))
+        with open(self.path(stage, key, 'json')) as f:
+            return gdf, json.load(f)
@@ -0,0 +1,164 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .tiling import iter_blocks
+
+# Gaussian kernels are cut off at this many sigmas (as in scipy.ndimage).
+TRUNCATE = 4.0
+
+
+def disk(radius):
+    """Boolean disk structuring element of the given radius in pixels"""
+    k = int(np.floor(radius))
+    yy, xx = np.mgrid[-k:k + 1, -k:k + 1]
+    return yy ** 2 + xx ** 2 <= radius ** 2
+
+
+def gaussian_smooth(arr, valid, sigma):
+    """Separable Gaussian smoothing that ignores invalid pixels (normalized
+    convolution): every pixel becomes the weighted mean of the valid pixels
+    around it, so nodata neither leaks into nor punches holes in the result.
+
+    Args:
+        arr (np.array): 2D values
+        valid (np.array): boolean mask of the pixels to use
+        sigma (float): standard deviation in pixels
+
+    Returns:
+        np.array: float32 smoothed values, NaN where no valid pixel is in reach
+    """
+    from scipy import ndimage
+
+    num = np.where(valid, arr, 0).astype('float32')
+    weight = valid.astype('float32')
+    for axis in (0, 1):
+        num = ndimage.gaussian_filter1d(num, sigma, axis=axis, mode='constant',
+                                        truncate=TRUNCATE)
+        weight = ndimage.gaussian_filter1d(weight, sigma, axis=axis, mode='constant',
+                                           truncate=TRUNCATE)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = num / weight
+    out[weight < 1e-6] = np.nan
+    return out
+
+
+def cleanup_halo(sigma=0, open_radius=0, close_radius=0):
+    """Pixels of context a tile needs for the smoothing and morphology of
+    clean_flat_tile() to give the same result as on the whole raster: the
+    Gaussian kernel radius plus twice each morphology radius. Patch sizes are
+    not local, clean_flat_labels() filters them on the whole mask instead."""
+    halo = int(TRUNCATE * sigma + 0.5) if sigma > 0 else 0
+    return halo + 2 * int(np.floor(open_radius)) + 2 * int(np.floor(close_radius))
+
+
+def drop_small_patches(flat, labels, min_pixels):
+    """Drops flat patches smaller than min_pixels. A patch is a connected
+    (4-connectivity, as polygonization) set of flat pixels of one building.
+
+    Args:
+        flat (np.array): boolean flat mask
+        labels (np.array): building labels, 0 outside the buildings
+        min_pixels (int): smallest patch kept
+
+    Returns:
+        np.array: boolean flat mask without the small patches
+    """
+    from scipy import ndimage
+
+    if min_pixels <= 1 or not flat.any():
+        return flat
+    components, _ = ndimage.label(flat)
+    patch = components[flat].astype(np.int64) * (int(labels.max()) + 1) + labels[flat]
+    _, inverse, counts = np.unique(patch, return_inverse=True, return_counts=True)
+    keep = flat.copy()
+    keep[flat] = counts[inverse.ravel()] >= min_pixels
+    return keep
+
+
+def clean_flat_tile(slope, labels, slope_thresh, sigma=0, open_radius=0, close_radius=0,
+                    min_pixels=0, nodata=None):
+    """Flat pixels of a tile, labelled with the building they belong to
+
+    Slope is smoothed over the building pixels (sigma > 0) and thresholded,
+    then the flat mask is opened (removes spurs and isolated pixels) and closed
+    (fills pits and cracks narrower than the structuring element), and flat
+    patches smaller than min_pixels are dropped. A patch is a connected
+    (4-connectivity, as polygonization) set of flat pixels of one building.
+
+    Args:
+        slope (np.array): slope in degrees
+        labels (np.array): building labels, 0 outside the buildings
+        slope_thresh (float): pixels with a slope up to this are flat
+        sigma (float, optional): Gaussian sigma in pixels. Defaults to 0.
+        open_radius (float, optional): opening disk radius in pixels.
+            Defaults to 0.
+        close_radius (float, optional): closing disk radius in pixels.
+            Defaults to 0.
+        min_pixels (int, optional): smallest patch kept. Defaults to 0.
+        nodata (float, optional): nodata value of slope. Defaults to None.
+
+    Returns:
+        np.array: labels where flat, 0 elsewhere
+    """
+    from scipy import ndimage
+
+    bldg = labels > 0
+    if sigma > 0:
+        # Only roof pixels are averaged: walls and ground around a footprint
+        # would make its edge look steep (and are not computed by footprint
+        # only slope).
+        valid = bldg & ~np.isnan(slope)
+        if nodata is not None:
+            valid &= slope != nodata
+        slope = gaussian_smooth(slope, valid, sigma)
+    flat = (slope <= slope_thresh) & bldg
+    # Pixels beyond the array edge count as flat for erosions, so patches on
+    # the raster edge are not eaten away.
+    if open_radius >= 1:
+        se = disk(open_radius)
+        flat = ndimage.binary_dilation(ndimage.binary_erosion(flat, se, border_value=1), se)
+    if close_radius >= 1:
+        se = disk(close_radius)
+        flat = ndimage.binary_erosion(ndimage.binary_dilation(flat, se), se,
+                                      border_value=1) & bldg
+    flat = drop_small_patches(flat, labels, min_pixels)
+    return np.where(flat, labels, 0)
+
+
+def clean_flat_labels(slope, labels, slope_thresh, sigma=0, open_radius=0, close_radius=0,
+                      min_pixels=0, nodata=None, tile_size=1024, max_threads=None):
+    """Runs clean_flat_tile() over a whole raster in tiles with a halo (see
+    cleanup_halo()), in a thread pool. Tiles without buildings are skipped.
+    Small patches are dropped afterwards on the whole mask, as they may span
+    several tiles. The result does not depend on tile_size.
+
+    Args:
+        slope (np.array): slope in degrees
+        labels (np.array): building labels, 0 outside the buildings
+        slope_thresh (float): pixels with a slope up to this are flat
+        sigma, open_radius, close_radius, min_pixels, nodata: see
+            clean_flat_tile()
+        tile_size (int, optional): tile side in pixels, excluding the halo.
+            Defaults to 1024.
+        max_threads (int, optional): size of the thread pool. Defaults to the
+            ThreadPoolExecutor default.
+
+    Returns:
+        np.array: labels where flat, 0 elsewhere
+    """
+    out = np.zeros(labels.shape, dtype=labels.dtype)
+    halo = cleanup_halo(sigma, open_radius, close_radius)
+
+    def run(block):
+        read_win, write_win, inner = block
+        if not labels[write_win.toslices()].any():
+            return
+        tile = clean_flat_tile(np.asarray(slope[read_win.toslices()]),
+                               labels[read_win.toslices()], slope_thresh, sigma,
+                               open_radius, close_radius, nodata=nodata)
+        out[write_win.toslices()] = tile[inner]
+
+    with ThreadPoolExecutor(max_workers=max_threads) as pool:
+        list(pool.map(run, iter_blocks(labels.shape[0], labels.shape[1], tile_size, halo)))
+    if min_pixels > 1:
+        out[~drop_small_patches(out > 0, labels, min_pixels)] = 0
+    return out
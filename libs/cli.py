@@ -0,0 +1,288 @@
+"""Command line interface: runs the rooftop pipeline for every job in a manifest.
+
+A manifest is a JSON file:
+
+    {
+        "bucket": "dirtsat-rooftop",
+        "endpoint_url": null,
+        "cache_dir": "/tmp/rooftop-cache",
+        "defaults": {"pitch_slope_threshold": 11, "features": ["height", "volume_on_roof"]},
+        "jobs": [
+            {"name": "missoula", "main_dir": "missoula/", "dsm": "dsm.tif",
+             "hfdem": "hfdem.tif", "bldgs": "bldgs.parquet", "bldgs_id": "fid"},
+            {"name": "missoula-downtown", "main_dir": "missoula/", "dsm": "dsm.tif",
+             "hfdem": "hfdem.tif", "bldgs": "bldgs.parquet",
+             "bounds": [272000, 5194000, 274000, 5196000]}
+        ]
+    }
+
+Every job key other than name, main_dir, dsm, hfdem and bldgs overrides the
+defaults below. A job is one city or one domain of a city (bounds). Stage
+outputs are checkpointed under --checkpoint-dir keyed on the input ETags and
+the stage parameters, so re-running the same command after a crash or a
+parameter change only runs the stages whose inputs changed.
+
+Usage:
+    rooftop run manifest.json --workers 4
+    rooftop status manifest.json
+    rooftop serve main_index.parquet --port 8000
+    rooftop tiles main_index.parquet tiles/ --min-zoom 12 --max-zoom 16
+"""
+import os
+import sys
+import json
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .checkpoint import CheckpointStore, stage_key
+
+DEFAULTS = dict(bldgs_id='fid', bounds=None, pad=1, crop_to_bldgs=False, memmap=False,
+                block_size=None, footprints_only=False, footprint_pad=2,
+                slope_fname='slope.tif', height_fname='height.tif',
+                flat_area_fname='flat_area.parquet', index_fname='main_index.parquet',
+                pitch_slope_threshold=11, pitch_area_threshold=9, fa_slope_thresh=45,
+                fa_area_thresh=93.903, fa_cleanup={},
+                features=['average_slope', 'height', 'volume_on_roof', 'parapet'],
+                feature_kwargs={}, wts=None)
+
+STAGES = ('slope', 'height', 'flat_bldgs', 'flat_area', 'features', 'index')
+
+
+def load_manifest(path):
+    """Reads a manifest and returns (settings, jobs) with defaults filled in"""
+    with open(path) as f:
+        manifest = json.load(f)
+    defaults = dict(DEFAULTS, **manifest.get('defaults', {}))
+    jobs = []
+    for job in manifest['jobs']:
+        missing = [k for k in ('name', 'main_dir', 'dsm', 'hfdem', 'bldgs') if k not in job]
+        if missing:
+            raise ValueError('Job {} is missing {}.'.format(job.get('name', len(jobs)),
+                                                            ', '.join(missing)))
+        jobs.append(dict(defaults, **job))
+    names = [job['name'] for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError('Job names must be unique.')
+    settings = {k: manifest.get(k) for k in ('bucket', 'endpoint_url', 'cache_dir')}
+    return settings, jobs
+
+
+def _make_s3(settings):
+    from .s3utils import S3Helper
+    return S3Helper(settings['bucket'], cache_dir=settings.get('cache_dir'),
+                    endpoint_url=settings.get('endpoint_url'))
+
+
+def stage_keys(job, etags):
+    """Checkpoint key of every stage of a job. Each key covers the stage's own
+    parameters and the keys of the stages it reads, so a change invalidates
+    everything downstream of it."""
+    window = [job['bounds'], job['pad'], job['crop_to_bldgs'], job['bldgs'], etags['bldgs']] \
+        if job['bounds'] is not None or job['crop_to_bldgs'] else None
+    keys = {}
+    # Footprint-only slope depends on the footprints as well.
+    sparse = [etags['bldgs'], job['bldgs_id'], job['footprint_pad']] \
+        if job['footprints_only'] else []
+    keys['slope'] = stage_key('slope', etags['dsm'], window, *sparse)
+    keys['height'] = stage_key('height', etags['dsm'], etags['hfdem'], window)
+    keys['flat_bldgs'] = stage_key('flat_bldgs', keys['slope'], etags['bldgs'], job['bldgs_id'],
+                                   job['pitch_slope_threshold'], job['pitch_area_threshold'])
+    keys['flat_area'] = stage_key('flat_area', keys['flat_bldgs'], job['fa_slope_thresh'],
+                                  job['fa_area_thresh'], job['fa_cleanup'])
+    keys['features'] = stage_key('features', keys['flat_area'], keys['height'],
+                                 job['features'], job['feature_kwargs'],
+                                 sorted(etags.get('ctp', {}).items()))
+    keys['index'] = stage_key('index', keys['features'], job['wts'])
+    return keys
+
+
+def input_etags(S3, job):
+    """ETags of the job's input objects (any change to an input changes them)"""
+    head = lambda name: S3.client.head_object(Bucket=S3.bucket,
+                                              Key=job['main_dir'] + name)['ETag']
+    etags = {'dsm': head(job['dsm']), 'hfdem': head(job['hfdem']), 'bldgs': head(job['bldgs'])}
+    ctp_paths = job['feature_kwargs'].get('ctp_paths', [])
+    etags['ctp'] = {p: head(p) for p in ctp_paths}
+    return etags
+
+
+def _ext(stage):
+    return 'npy' if stage in ('slope', 'height') else 'parquet'
+
+
+def run_job(settings, job, checkpoint_dir, events=None, force=False):
+    """Runs the pipeline for one job, restoring every stage whose checkpoint is
+    still valid. Executed in a worker process by main().
+
+    Returns:
+        dict: job name, per stage 'cached', 'computed' or 'skipped' (not needed
+            by the stages that ran), number of FAIDs
+    """
+    from .rooftop import RooftopProc
+    from .instrument import Instrument, JsonLinesSink
+
+    S3 = _make_s3(settings)
+    store = CheckpointStore(os.path.join(checkpoint_dir, job['name']))
+    keys = stage_keys(job, input_etags(S3, job))
+    done = {s: not force and store.has(s, keys[s], _ext(s)) for s in STAGES}
+    status = {s: 'cached' if done[s] else 'skipped' for s in STAGES}
+    if done['index']:
+        index, _ = store.load_gdf('index', keys['index'])
+        return {'name': job['name'], 'stages': status, 'faids': len(index)}
+
+    instrument = Instrument(sinks=[JsonLinesSink(events)] if events else None,
+                            run_id=job['name'])
+    proc = RooftopProc(S3, job['main_dir'], job['dsm'], job['hfdem'], job['bldgs'],
+                       job['bldgs_id'], bounds=job['bounds'], pad=job['pad'],
+                       crop_to_bldgs=job['crop_to_bldgs'], memmap=job['memmap'],
+                       instrument=instrument)
+
+    # Rasters are only needed by the stages that still have to run.
+    need_rasters = not (done['flat_bldgs'] and done['flat_area'] and done['features'])
+
+    if need_rasters:
+        if done['slope']:
+            proc.slope_arr = store.load_array('slope', keys['slope'])
+        else:
+            proc.create_slope_arr(job['slope_fname'], block_size=job['block_size'],
+                                  footprints_only=job['footprints_only'],
+                                  footprint_pad=job['footprint_pad'])
+            store.save_array('slope', keys['slope'], proc.slope_arr)
+            status['slope'] = 'computed'
+        if done['height']:
+            proc.height_arr = store.load_array('height', keys['height'])
+        else:
+            proc.create_height_arr(job['height_fname'], block_size=job['block_size'])
+            store.save_array('height', keys['height'], proc.height_arr)
+            status['height'] = 'computed'
+        proc.release('dsm', 'hfdem')
+
+    if done['flat_bldgs']:
+        proc.flat_bldgs, _ = store.load_gdf('flat_bldgs', keys['flat_bldgs'])
+    else:
+        proc.pitched_roof_filter(job['pitch_slope_threshold'], job['pitch_area_threshold'])
+        store.save_gdf('flat_bldgs', keys['flat_bldgs'], proc.flat_bldgs)
+        status['flat_bldgs'] = 'computed'
+
+    if done['flat_area']:
+        rooftops, attrs = store.load_gdf('flat_area', keys['flat_area'])
+        proc.col_names = [tuple(c) for c in attrs['col_names']]
+    else:
+        rooftops = proc.flat_area_disaggregator(proc.flat_bldgs, job['fa_slope_thresh'],
+                                                job['fa_area_thresh'], job['flat_area_fname'],
+                                                **job['fa_cleanup'])
+        store.save_gdf('flat_area', keys['flat_area'], rooftops, col_names=proc.col_names)
+        status['flat_area'] = 'computed'
+
+    if done['features']:
+        full, attrs = store.load_gdf('features', keys['features'])
+        proc.col_names = [tuple(c) for c in attrs['col_names']]
+    else:
+        full = proc.feature_builder(rooftops, job['features'], **job['feature_kwargs'])
+        store.save_gdf('features', keys['features'], full, col_names=proc.col_names)
+        status['features'] = 'computed'
+
+    index = proc.index_builder(full, wts=job['wts'], out_fname=job['index_fname'])
+    store.save_gdf('index', keys['index'], index.reset_index())
+    status['index'] = 'computed'
+    S3.wait()
+    return {'name': job['name'], 'stages': status, 'faids': len(index)}
+
+
+def _run_job_safe(*args, **kwargs):
+    try:
+        return run_job(*args, **kwargs)
+    except Exception:
+        return {'name': args[1]['name'], 'error': traceback.format_exc()}
+
+
+def status(settings, jobs, checkpoint_dir):
+    """Prints which stages of each job have a valid checkpoint"""
+    S3 = _make_s3(settings)
+    print('{:<30} '.format('job') + ' '.join('{:<10}'.format(s) for s in STAGES))
+    for job in jobs:
+        store = CheckpointStore(os.path.join(checkpoint_dir, job['name']))
+        keys = stage_keys(job, input_etags(S3, job))
+        marks = ['done' if store.has(s, keys[s], _ext(s)) else '-' for s in STAGES]
+        print('{:<30} '.format(job['name']) + ' '.join('{:<10}'.format(m) for m in marks))
+
+
+def _serve(args):
+    from .query import IndexQuery, make_server, write_tiles
+    index = IndexQuery.from_file(args.index)
+    tiles = index.tiles(args.min_zoom, args.max_zoom)
+    if args.command == 'tiles':
+        write_tiles(tiles, args.out_dir)
+        print('Wrote {} tiles to {}.'.format(len(tiles), args.out_dir))
+        return 0
+    server = make_server(index, args.host, args.port, tiles)
+    print('Serving {} FAIDs and {} tiles on http://{}:{}/'.format(
+        len(index), len(tiles), *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='rooftop', description=__doc__.split('\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('run', help='run every job in a manifest')
+    run.add_argument('manifest', help='job manifest (JSON)')
+    run.add_argument('--workers', type=int, default=1, help='jobs run at the same time')
+    run.add_argument('--checkpoint-dir', default='.rooftop-checkpoints',
+                     help='where stage checkpoints are kept')
+    run.add_argument('--events', help='append per-stage events to this JSON lines file')
+    run.add_argument('--jobs', nargs='+', help='only run these jobs')
+    run.add_argument('--force', action='store_true', help='ignore existing checkpoints')
+    stat = sub.add_parser('status', help='show valid checkpoints per job')
+    stat.add_argument('manifest', help='job manifest (JSON)')
+    stat.add_argument('--checkpoint-dir', default='.rooftop-checkpoints',
+                      help='where stage checkpoints are kept')
+    serve = sub.add_parser('serve', help='serve queries and tiles over an index (for testing)')
+    serve.add_argument('index', help='index_builder() output (.parquet, .zip or .fgb)')
+    serve.add_argument('--host', default='127.0.0.1', help='interface to bind')
+    serve.add_argument('--port', type=int, default=8000, help='port to listen on')
+    serve.add_argument('--min-zoom', type=int, default=12, help='lowest tile zoom level')
+    serve.add_argument('--max-zoom', type=int, default=16, help='highest tile zoom level')
+    tiles = sub.add_parser('tiles', help='write GeoJSON tiles of an index for static hosting')
+    tiles.add_argument('index', help='index_builder() output (.parquet, .zip or .fgb)')
+    tiles.add_argument('out_dir', help='directory for the {z}/{x}/{y}.geojson files')
+    tiles.add_argument('--min-zoom', type=int, default=12, help='lowest tile zoom level')
+    tiles.add_argument('--max-zoom', type=int, default=16, help='highest tile zoom level')
+    args = parser.parse_args(argv)
+
+    if args.command in ('serve', 'tiles'):
+        return _serve(args)
+
+    settings, jobs = load_manifest(args.manifest)
+    if args.command == 'status':
+        status(settings, jobs, args.checkpoint_dir)
+        return 0
+
+    if args.jobs:
+        jobs = [job for job in jobs if job['name'] in args.jobs]
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(_run_job_safe, settings, job, args.checkpoint_dir,
+                               events=args.events, force=args.force) for job in jobs]
+        for fut in as_completed(futures):
+            result = fut.result()
+            if 'error' in result:
+                failed += 1
+                print('Job {} failed:\n{}'.format(result['name'], result['error']))
+            else:
+                cached = [s for s, v in result['stages'].items() if v == 'cached']
+                skipped = [s for s, v in result['stages'].items() if v == 'skipped']
+                print('Job {} finished ({} FAIDs, cached: {}, skipped: {}).'.format(
+                    result['name'], result['faids'], ', '.join(cached) or 'none',
+                    ', '.join(skipped) or 'none'))
+    print('{} of {} jobs finished.'.format(len(jobs) - failed, len(jobs)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from shapely.geometry import box
+import pandas as pd
+import numpy as np
+import geopandas as gpd
+from .rooftop import RooftopProc, resolve_features
+
+
+def split_domains(bldgs, domain_size):
+    """Tiles the footprint extent into square domains without splitting buildings.
+    Each building goes to the grid cell holding its representative point and the
+    domain extent is grown to the bounds of its buildings, so neighbouring
+    domains may overlap slightly but every footprint lies inside one domain.
+
+    Args:
+        bldgs (gdf): building footprints
+        domain_size (float): side length of the domain grid in map units
+
+    Returns:
+        tuple: (bldgs, domains) where bldgs is a copy of the footprints with a
+            'domain' column and domains is a gdf with one extent per domain.
+    """
+    pts = bldgs.geometry.representative_point()
+    minx, miny = bldgs.total_bounds[:2]
+    col = np.floor((pts.x.values - minx) / domain_size).astype('int64')
+    row = np.floor((pts.y.values - miny) / domain_size).astype('int64')
+    cell = row * (col.max() + 1) + col
+    domain = pd.factorize(cell, sort=True)[0]
+    bldgs = bldgs.assign(domain=domain)
+
+    bounds = bldgs.geometry.bounds.groupby(domain)
+    bounds = pd.concat([bounds['minx'].min(), bounds['miny'].min(),
+                        bounds['maxx'].max(), bounds['maxy'].max()], axis=1)
+    domains = gpd.GeoDataFrame({'domain': bounds.index,
+                                'n_bldgs': np.bincount(domain)},
+                               geometry=[box(*b) for b in bounds.values],
+                               crs=bldgs.crs)
+    return bldgs, domains
+
+
+def _domain_fname(fname, domain):
+    """Adds a zero padded domain number to a file name (slope.tif -> slope_003.tif)"""
+    stem, ext = fname.rsplit('.', 1)
+    return '{}_{:03d}.{}'.format(stem, domain, ext)
+
+
+def run_domain(S3, main_dir, dsm_fname, hfdem_fname, bldgs, bldgs_id, bounds, domain,
+               params):
+    """Runs slope, pitched roof filter, flat area disaggregation and features for
+    one domain. Executed in a worker process by run_domains().
+
+    Returns:
+        tuple: (FAID gdf with features or None if the domain has no flat roofs,
+            list of (feature, invert) column names)
+    """
+    proc = RooftopProc(S3, main_dir, dsm_fname, hfdem_fname, bldgs, bldgs_id,
+                       bounds=bounds)
+    if params.get('dsm_blocks') is not None:
+        proc.dsm_blocks = params['dsm_blocks']
+    proc.create_slope_arr(_domain_fname(params['slope_fname'], domain),
+                          block_size=params.get('block_size'),
+                          footprints_only=params.get('footprints_only', False))
+    proc.create_height_arr(_domain_fname(params['height_fname'], domain),
+                           block_size=params.get('block_size'))
+    flat_bldgs = proc.pitched_roof_filter(params['pitch_slope_threshold'],
+                                          params['pitch_area_threshold'])
+    if flat_bldgs.empty:
+        return None, []
+
+    rooftops = proc.flat_area_disaggregator(flat_bldgs, params['fa_slope_thresh'],
+                                            params['fa_area_thresh'],
+                                            _domain_fname(params['flat_area_fname'], domain),
+                                            **(params.get('fa_cleanup') or {}))
+    if rooftops.empty:
+        return None, []
+
+    rooftops = proc.feature_builder(rooftops, params['features'], **params['kwargs'])
+    rooftops['domain'] = domain
+    return rooftops, proc.col_names
+
+
+def _run_pool(proc, tasks, params, max_workers=None):
+    """Runs run_domain() for every (domain, bldgs, bounds) task in worker
+    processes
+
+    Returns:
+        tuple: ({domain: FAID gdf} for the domains with flat roofs, col_names)
+    """
+    results = {}
+    col_names = []
+    # Sun shadows reach across domains; the coarse DSM that bounds them is
+    # read once here instead of in every worker.
+    if 'sun_exposure' in [f for level in resolve_features(params['features']) for f in level]:
+        params = dict(params, dsm_blocks=proc.dsm_blocks)
+    print('Processing {} domains.'.format(len(tasks)))
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for domain, domain_bldgs, bounds in tasks:
+            fut = pool.submit(run_domain, proc.S3, proc.main_dir, proc.dsm_fname,
+                              proc.hfdem_fname, domain_bldgs, proc.bldgs_id,
+                              bounds, domain, params)
+            futures[fut] = domain
+
+        for i, fut in enumerate(as_completed(futures), start=1):
+            rooftops, names = fut.result()
+            if rooftops is not None:
+                results[futures[fut]] = rooftops
+                col_names = col_names or names
+            print('Domain {} finished ({} of {}).'.format(futures[fut], i, len(tasks)))
+    return results, col_names
+
+
+def run_domains(proc, domain_size, slope_fname, height_fname, flat_area_fname, features,
+                pitch_slope_threshold=11, pitch_area_threshold=9, fa_slope_thresh=45,
+                fa_area_thresh=93.903, fa_cleanup=None, block_size=None,
+                footprints_only=False, max_workers=None, **kwargs):
+    """Runs the per-building part of the pipeline for a whole city, one domain per
+    worker process, and merges the FAIDs into one layer. Per-domain rasters and
+    flat area files are written with a _<domain> suffix; the merged FAIDs are
+    written to flat_area_fname. Rank the result with proc.index_builder().
+
+    Args:
+        proc (RooftopProc): processor for the full AOI (inputs and buildings)
+        domain_size (float): side length of the domain grid in map units
+        slope_fname (str): file name of slope geotiffs to be written to S3 bucket
+        height_fname (str): file name of height geotiffs to be written to S3 bucket
+        flat_area_fname (str): file name of the merged flat areas
+        features (list): features passed to feature_builder()
+        pitch_slope_threshold (int, optional): hyperparameter. Defaults to 11.
+        pitch_area_threshold (int, optional): hyperparameter. Defaults to 9.
+        fa_slope_thresh (int, optional): slope threshold to determine flat area.
+            Defaults to 45.
+        fa_area_thresh (float, optional): minimum flat area. Defaults to 93.903.
+        fa_cleanup (dict, optional): raster cleanup arguments of 
+            RooftopProc.flat_area_disaggregator() (smooth_sigma, open_radius, 
+            close_radius, min_patch_area, ...). Defaults to None.
+        block_size (int, optional): block size for windowed slope and height.
+            Defaults to None.
+        footprints_only (bool, optional): only calculate slope around the 
+            footprints (see RooftopProc.create_slope_arr()). Defaults to False.
+        max_workers (int, optional): number of worker processes. Defaults to the
+            number of CPUs.
+        **kwargs: passed on to feature_builder() (e.g. ctp_paths)
+
+    Returns:
+        gdf: FAIDs of all domains with a global faid and a domain column
+    """
+    bldgs, domains = split_domains(proc.bldgs, domain_size)
+    params = dict(slope_fname=slope_fname, height_fname=height_fname,
+                  flat_area_fname=flat_area_fname, features=features,
+                  pitch_slope_threshold=pitch_slope_threshold,
+                  pitch_area_threshold=pitch_area_threshold,
+                  fa_slope_thresh=fa_slope_thresh, fa_area_thresh=fa_area_thresh,
+                  fa_cleanup=fa_cleanup, block_size=block_size,
+                  footprints_only=footprints_only, kwargs=kwargs)
+
+    groups = bldgs.drop(columns='domain').groupby(bldgs['domain'])
+    tasks = [(d.domain, groups.get_group(d.domain), d.geometry.bounds)
+             for d in domains.itertuples()]
+    results, col_names = _run_pool(proc, tasks, params, max_workers)
+
+    if not results:
+        raise ValueError('No flat rooftops were found in any domain.')
+
+    merged = pd.concat([results[d] for d in sorted(results)], ignore_index=True)
+    merged = gpd.GeoDataFrame(merged, geometry='geometry', crs=proc.bldgs.crs)
+    merged['faid'] = range(len(merged))
+    proc.col_names = list(col_names)
+    proc.S3.write_gdf_to_s3(merged, proc.main_dir + flat_area_fname)
+    return merged
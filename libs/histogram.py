@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+
+
+class SlopeHistogram(object):
+
+    """
+    Per-zone slope histograms built in one pass over a label grid. Bin j holds
+    the pixels with edges[j - 1] < slope <= edges[j] (bin 0 also holds anything
+    at or below the first edge, the last bin anything above the last edge) and
+    NaN pixels are tallied separately. A cumulative sum over the bins then gives
+    the number of pixels at or below any edge, so slope thresholds on a bin edge
+    are answered exactly without touching the raster again.
+    """
+
+    def __init__(self, counts, nan_counts, ids, id_col, bin_width):
+        self.counts = counts
+        self.nan_counts = nan_counts
+        self.ids = np.asarray(ids)
+        self.id_col = id_col
+        self.bin_width = bin_width
+        self.edges = np.arange(counts.shape[1] - 1) * bin_width
+        self._cum = np.cumsum(counts, axis=1)
+
+    @classmethod
+    def from_grid(cls, grid, slope, bin_width=0.5, max_slope=90):
+        """Builds the histograms of a slope raster for every zone of a label grid
+
+        Args:
+            grid (LabelGrid): zones
+            slope (np.array): slope raster (degrees) aligned with the grid
+            bin_width (float, optional): bin width in degrees. Defaults to 0.5.
+            max_slope (float, optional): last bin edge. Defaults to 90.
+
+        Returns:
+            SlopeHistogram: histograms keyed by the grid ids
+        """
+        edges = np.arange(int(round(max_slope / bin_width)) + 1) * bin_width
+        n = len(grid.ids)
+        nbins = len(edges) + 1
+
+        vals = np.asarray(slope).ravel()[grid._pix]
+        lab = grid._lab.astype('int64')
+        nan = np.isnan(vals)
+        idx = np.searchsorted(edges, vals[~nan], side='left')
+        counts = np.bincount(lab[~nan] * nbins + idx, minlength=(n + 1) * nbins)
+        counts = counts.reshape(n + 1, nbins)[1:]
+        nan_counts = np.bincount(lab[nan], minlength=n + 1)[1:]
+
+        dtype = 'int32' if counts.size == 0 or counts.max() < 2**31 else 'int64'
+        return cls(counts.astype(dtype), nan_counts.astype(dtype), grid.ids,
+                   grid.id_col, bin_width)
+
+    def _edge_index(self, thresholds):
+        """Index of the bin edge at or below each threshold"""
+        idx = np.floor(np.asarray(thresholds, dtype='float64') / self.bin_width + 1e-9)
+        return np.clip(idx.astype('int64'), 0, len(self.edges) - 1)
+
+    def total_count(self):
+        """Number of pixels per zone, NaN included"""
+        return self._cum[:, -1] + self.nan_counts
+
+    def count_below(self, thresholds, nan_below=False):
+        """Number of pixels per zone with slope <= each threshold. Thresholds
+        between bin edges are rounded down to the nearest edge.
+
+        Args:
+            thresholds (list): slope thresholds in degrees
+            nan_below (bool, optional): count NaN pixels as well, which matches
+                ~(slope > threshold). Defaults to False (slope <= threshold).
+
+        Returns:
+            np.array: (n_zones, n_thresholds) pixel counts
+        """
+        out = self._cum[:, self._edge_index(np.atleast_1d(thresholds))]
+        if nan_below:
+            out = out + self.nan_counts[:, None]
+        return out
+
+    def flat_percent(self, slope_thresholds, pixel_area=1.0):
+        """Flat area percentage per zone as computed by pitched_roof_filter()
+
+        Returns:
+            np.array: (n_zones, n_thresholds) percentages, NaN for empty zones
+        """
+        flat_area = self.count_below(slope_thresholds, nan_below=True) * pixel_area
+        total_area = self.total_count()[:, None] * pixel_area
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (flat_area / total_area) * 100
+
+    def sweep(self, slope_thresholds, area_thresholds, pixel_area=1.0):
+        """Evaluates the pitched roof filter for every threshold pair
+
+        Args:
+            slope_thresholds (list): pitch slope thresholds in degrees
+            area_thresholds (list): pitch area thresholds in percent
+            pixel_area (float, optional): area of one pixel. Defaults to 1.0.
+
+        Returns:
+            pd.DataFrame: one row per threshold pair with the number of flat
+                zones, their summed flat area and their summed total area
+        """
+        slope_thresholds = np.atleast_1d(slope_thresholds)
+        area_thresholds = np.atleast_1d(area_thresholds)
+        flat_area = self.count_below(slope_thresholds, nan_below=True) * pixel_area
+        total_area = self.total_count() * pixel_area
+        # (zones, slope thresholds, area thresholds); NaN compares False.
+        flat = self.flat_percent(slope_thresholds, pixel_area)[:, :, None] > area_thresholds
+
+        n_flat = flat.sum(axis=0)
+        area = np.einsum('zs,zsa->sa', flat_area, flat.astype('float64'))
+        total = np.einsum('z,zsa->sa', total_area.astype('float64'), flat.astype('float64'))
+        s, a = np.meshgrid(slope_thresholds, area_thresholds, indexing='ij')
+        return pd.DataFrame({'pitch_slope_threshold': s.ravel(),
+                             'pitch_area_threshold': a.ravel(),
+                             'n_flat_bldgs': n_flat.ravel(),
+                             'flat_area': area.ravel(),
+                             'total_area': total.ravel()})
@@ -0,0 +1,193 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import box
+from .domains import split_domains, _run_pool
+from .rooftop import FEATURES, resolve_features
+
+
+def diff_footprints(old, new, bldgs_id):
+    """Compares two versions of a footprint layer by building id
+
+    Args:
+        old (gdf): footprints of the previous run
+        new (gdf): updated footprints (same CRS)
+        bldgs_id (str): name of the unique building id column
+
+    Returns:
+        dict: 'added', 'removed' and 'changed' (outline differs) building ids
+    """
+    old_geoms = pd.Series(old.geometry.values, index=old[bldgs_id].values)
+    new_geoms = pd.Series(new.geometry.values, index=new[bldgs_id].values)
+    both = old_geoms.index.intersection(new_geoms.index)
+    same = shapely.equals_exact(np.asarray(old_geoms.loc[both].values),
+                                np.asarray(new_geoms.loc[both].values), tolerance=0)
+    return {'added': new_geoms.index.difference(old_geoms.index).values,
+            'removed': old_geoms.index.difference(new_geoms.index).values,
+            'changed': both[~same].values}
+
+
+def affected_buildings(old, new, bldgs_id, changed_bounds=None, margin=3, reach=None):
+    """Ids of the buildings in new whose FAIDs or features can differ from the
+    previous run: added or changed buildings, buildings on a changed raster
+    extent and buildings within margin of any of those changes (slope reads
+    the neighbouring pixels and the raster parapet ring the neighbouring
+    footprints), or within reach of a changed raster extent (shadows).
+
+    Args:
+        old (gdf): footprints of the previous run
+        new (gdf): updated footprints (same CRS)
+        bldgs_id (str): name of the unique building id column
+        changed_bounds (list, optional): (minx, miny, maxx, maxy) extents of
+            updated DSM or HFDEM tiles. Defaults to None.
+        margin (float, optional): distance in map units around each change.
+            Defaults to 3.
+        reach (list, optional): extra distance in map units around each of
+            changed_bounds (see sun_reach()). Defaults to None.
+
+    Returns:
+        np.array: affected building ids
+    """
+    diff = diff_footprints(old, new, bldgs_id)
+    touched = np.concatenate([diff['removed'], diff['changed']])
+    regions = list(old.geometry.values[old[bldgs_id].isin(touched).values])
+    regions += list(new.geometry.values[new[bldgs_id].isin(
+        np.concatenate([diff['added'], diff['changed']])).values])
+    distance = [margin] * len(regions)
+    changed_bounds = changed_bounds or []
+    regions += [box(*b) for b in changed_bounds]
+    distance += [margin + r for r in (reach or [0] * len(changed_bounds))]
+    if not regions:
+        return np.array([], dtype=new[bldgs_id].dtype)
+    regions = shapely.buffer(np.asarray(regions, dtype=object), distance)
+    _, hits = new.sindex.query(regions, predicate='intersects')
+    return new[bldgs_id].values[np.unique(hits)]
+
+
+def sun_reach(proc, features, kwargs, changed_bounds=None):
+    """Distance in map units around each changed raster extent over which the
+    DSM there can change sun_hours, if the sun_exposure feature is built (see
+    RooftopProc._sun_reach()), otherwise 0. Heights come from the new DSM, so
+    pass a larger margin if an update lowers the tallest objects of an extent.
+
+    Args:
+        proc (RooftopProc): processor for the full AOI
+        features (list): features passed to feature_builder()
+        kwargs (dict): feature_builder() kwargs (sun_dates, sun_step and 
+            sun_min_elevation are used)
+        changed_bounds (list, optional): (minx, miny, maxx, maxy) extents of
+            updated DSM or HFDEM tiles. Defaults to None.
+
+    Returns:
+        list: one distance per extent
+    """
+    changed_bounds = changed_bounds or []
+    if 'sun_exposure' not in [f for level in resolve_features(features) for f in level]:
+        return [0] * len(changed_bounds)
+    spec = FEATURES['sun_exposure'].kwargs
+    args = {spec[kw]: kwargs[kw] for kw in ('sun_dates', 'sun_step', 'sun_min_elevation')
+            if kw in kwargs}
+    return [proc._sun_reach(b, **args) for b in changed_bounds]
+
+
+def update_domains(proc, previous, old_bldgs, domain_size, slope_fname, height_fname,
+                   flat_area_fname, features, changed_bounds=None, margin=3,
+                   pitch_slope_threshold=11, pitch_area_threshold=9, fa_slope_thresh=45,
+                   fa_area_thresh=93.903, fa_cleanup=None, block_size=None,
+                   footprints_only=True,
+                   max_workers=None, **kwargs):
+    """Brings the FAIDs of a previous run up to date after a footprint update or
+    new LiDAR tiles, recomputing slope, flat areas and features only around
+    the affected buildings (see affected_buildings()). The affected buildings
+    are split into domains and run like run_domains(), with the buildings
+    within margin of a domain included as context, so every recomputed FAID
+    sees the same pixels and neighbours as in a full run. FAIDs of the other
+    buildings are kept as they are.
+
+    The result has the same FAIDs, faid numbering and features as a full run
+    with the new inputs, so proc.index_builder() on it gives the full run's
+    index: TOPSIS only needs the feature table, which is cheap to re-rank
+    compared to recomputing features.
+
+    Use slope_fname, height_fname and flat_area_fname distinct from the
+    previous run if its per-domain rasters should be kept.
+
+    Args:
+        proc (RooftopProc): processor for the full AOI with the updated inputs
+        previous (gdf): FAIDs with features of the previous run (from
+            feature_builder(), run_domains() or update_domains())
+        old_bldgs (gdf): footprints of the previous run
+        domain_size (float): side length of the domain grid in map units
+        slope_fname (str): file name of slope geotiffs to be written to S3 bucket
+        height_fname (str): file name of height geotiffs to be written to S3 bucket
+        flat_area_fname (str): file name of the merged flat areas
+        features (list): features passed to feature_builder(), as in the
+            previous run
+        changed_bounds (list, optional): (minx, miny, maxx, maxy) extents of
+            updated DSM or HFDEM tiles. Defaults to None.
+        margin (float, optional): distance in map units around each change
+            (at least a pixel plus the parapet width, plus the halo of 
+            fa_cleanup if set, see cleanup.cleanup_halo()). The reach of sun 
+            shadows is added around changed_bounds when sun_exposure is among
+            the features (see sun_reach()). Defaults to 3.
+        footprints_only (bool, optional): only calculate slope around the
+            footprints. Defaults to True.
+        max_workers (int, optional): number of worker processes. Defaults to the
+            number of CPUs.
+        **kwargs: the remaining arguments of run_domains(), as in the previous
+            run
+
+    Returns:
+        gdf: updated FAIDs with features and a renumbered faid
+    """
+    bldgs_id = proc.bldgs_id
+    new = proc.bldgs
+    old_bldgs = old_bldgs.to_crs(new.crs)
+    reach = sun_reach(proc, features, kwargs, changed_bounds)
+    affected = affected_buildings(old_bldgs, new, bldgs_id, changed_bounds, margin, reach)
+    diff = diff_footprints(old_bldgs, new, bldgs_id)
+    print('{} buildings added, {} removed, {} changed; {} to recompute.'.format(
+        len(diff['added']), len(diff['removed']), len(diff['changed']), len(affected)))
+
+    params = dict(slope_fname=slope_fname, height_fname=height_fname,
+                  flat_area_fname=flat_area_fname, features=features,
+                  pitch_slope_threshold=pitch_slope_threshold,
+                  pitch_area_threshold=pitch_area_threshold,
+                  fa_slope_thresh=fa_slope_thresh, fa_area_thresh=fa_area_thresh,
+                  fa_cleanup=fa_cleanup, block_size=block_size,
+                  footprints_only=footprints_only, kwargs=kwargs)
+
+    results = {}
+    col_names = []
+    if len(affected):
+        bldgs, domains = split_domains(new[new[bldgs_id].isin(affected)], domain_size)
+        owner = pd.Series(bldgs['domain'].values, index=bldgs[bldgs_id].values)
+        tasks = []
+        for d in domains.itertuples():
+            extent = d.geometry.buffer(margin, join_style=2)
+            _, hits = new.sindex.query(np.array([extent]), predicate='intersects')
+            tasks.append((d.domain, new.iloc[np.sort(hits)], extent.bounds))
+        results, col_names = _run_pool(proc, tasks, params, max_workers)
+
+    dropped = np.concatenate([affected, diff['removed']])
+    kept = previous[~previous[bldgs_id].isin(dropped)].sort_values('faid')
+    if 'domain' in kept.columns:
+        kept = kept.drop(columns='domain')
+    parts = [kept]
+    # An affected building can also be context of a neighbouring domain; take
+    # its FAIDs from its own domain only.
+    for d in sorted(results):
+        rooftops = results[d].drop(columns='domain')
+        parts.append(rooftops[rooftops[bldgs_id].map(owner).values == d])
+
+    # Same order as a full run: by building, FAIDs of a building in the order
+    # they were found.
+    merged = pd.concat(parts, ignore_index=True)
+    merged = merged.sort_values(bldgs_id, kind='stable', ignore_index=True)
+    merged = gpd.GeoDataFrame(merged, geometry='geometry', crs=new.crs)
+    merged['faid'] = range(len(merged))
+    if col_names:
+        proc.col_names = list(col_names)
+    proc.S3.write_gdf_to_s3(merged, proc.main_dir + flat_area_fname)
+    return merged
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import logging
+import resource
+import threading
+import functools
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+
+def _rss_bytes():
+    """Current resident set size (Linux), else the peak from getrusage"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return _peak_rss_bytes()
+
+
+def _peak_rss_bytes():
+    scale = 1 if os.uname().sysname == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class JsonLinesSink(object):
+
+    """Appends every event as one JSON line to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+
+class LoggingSink(object):
+
+    """Sends every event to a logger as a JSON message"""
+
+    def __init__(self, logger='rooftop', level=logging.INFO):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+
+    def __call__(self, event):
+        self.logger.log(self.level, json.dumps(event, default=str))
+
+
+class Instrument(object):
+
+    """
+    Records one event per pipeline stage: wall and CPU time, resident memory
+    and the growth of its peak, row and pixel counts and S3 bytes moved. Events
+    are kept in memory (see summary()) and passed to every sink, e.g.
+    JsonLinesSink, LoggingSink or any callable taking the event dict.
+
+    Stages can be profiled on request: profile selects the stages run under
+    cProfile (a .prof file per call, open with pstats or snakeviz) and
+    trace_memory the ones run under tracemalloc (top allocations written to a
+    .txt file, Python heap peak added to the event). Both take a list of stage
+    names or True for all stages. cProfile only sees the thread that runs the
+    stage, so features built in worker threads show up under feature_<name>
+    profiles only when those stages are profiled themselves.
+    """
+
+    def __init__(self, sinks=None, profile=None, trace_memory=None, profile_dir='.',
+                 run_id=None):
+        """
+        Args:
+            sinks (list, optional): callables receiving each event. Defaults to
+                None (events are only kept in memory).
+            profile (list or bool, optional): stages to run under cProfile.
+                Defaults to None.
+            trace_memory (list or bool, optional): stages to run under
+                tracemalloc. Defaults to None.
+            profile_dir (str, optional): where profiles are written. Defaults
+                to the working directory.
+            run_id (str, optional): added to every event. Defaults to None.
+        """
+        self.sinks = list(sinks or [])
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.run_id = run_id
+        self.events = []
+        self._lock = threading.Lock()
+        self._profiling = False
+        self._calls = {}
+
+    @staticmethod
+    def _selected(option, name):
+        return option is True or (bool(option) and name in option)
+
+    def emit(self, event):
+        """Stores an event and passes it to every sink"""
+        with self._lock:
+            self.events.append(event)
+        for sink in self.sinks:
+            sink(event)
+
+    def _profile_path(self, name, ext):
+        with self._lock:
+            n = self._calls[name] = self._calls.get(name, 0) + 1
+        os.makedirs(self.profile_dir, exist_ok=True)
+        return os.path.join(self.profile_dir, '{}-{}.{}'.format(name, n, ext))
+
+    @contextmanager
+    def stage(self, name, s3=None, **counts):
+        """Times the enclosed block as one stage. The yielded dict is the event;
+        add counts to it (e.g. event['rows_out'] = len(out)) before the block
+        ends.
+
+        Args:
+            name (str): stage name
+            s3 (S3Helper, optional): helper whose transfer counters are read.
+                Defaults to None.
+            **counts: extra event fields (e.g. rows_in, pixels)
+        """
+        event = {'stage': name, 'run_id': self.run_id, 'thread': threading.get_ident()}
+        event.update(counts)
+        if not hasattr(s3, 'transfer_stats'):
+            s3 = None
+        s3_start = s3.transfer_stats() if s3 is not None else None
+
+        profiler = None
+        if self._selected(self.profile, name):
+            # Python allows one active profiler; nested and concurrent stages
+            # run unprofiled.
+            with self._lock:
+                if not self._profiling:
+                    self._profiling = True
+                    profiler = cProfile.Profile()
+        tracing = False
+        if self._selected(self.trace_memory, name):
+            with self._lock:
+                tracing = not tracemalloc.is_tracing()
+                if tracing:
+                    tracemalloc.start()
+
+        rss_start = _rss_bytes()
+        peak_start = _peak_rss_bytes()
+        event['start'] = time.time()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield event
+        except BaseException as e:
+            event['error'] = repr(e)
+            raise
+        finally:
+            if profiler:
+                profiler.disable()
+            event['wall_s'] = time.perf_counter() - wall
+            event['cpu_s'] = time.process_time() - cpu
+            event['rss_mb'] = _rss_bytes() / 2**20
+            event['rss_delta_mb'] = (_rss_bytes() - rss_start) / 2**20
+            event['peak_rss_delta_mb'] = (_peak_rss_bytes() - peak_start) / 2**20
+            if s3_start is not None:
+                s3_end = s3.transfer_stats()
+                for k in s3_end:
+                    event['s3_' + k] = s3_end[k] - s3_start[k]
+            if profiler:
+                event['profile'] = self._profile_path(name, 'prof')
+                profiler.dump_stats(event['profile'])
+                with self._lock:
+                    self._profiling = False
+            if tracing:
+                snapshot = tracemalloc.take_snapshot()
+                event['py_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+                tracemalloc.stop()
+                event['tracemalloc'] = self._profile_path(name, 'tracemalloc.txt')
+                with open(event['tracemalloc'], 'w') as f:
+                    for stat in snapshot.statistics('lineno')[:50]:
+                        f.write(str(stat) + '\n')
+            self.emit(event)
+
+    def summary(self):
+        """Totals per stage, slowest first
+
+        Returns:
+            pd.DataFrame: calls, wall_s, cpu_s and peak_rss_delta_mb per stage
+        """
+        if not self.events:
+            return pd.DataFrame()
+        events = pd.DataFrame(self.events)
+        summary = events.groupby('stage').agg(calls=('stage', 'size'), wall_s=('wall_s', 'sum'),
+                                              cpu_s=('cpu_s', 'sum'),
+                                              peak_rss_delta_mb=('peak_rss_delta_mb', 'max'))
+        return summary.sort_values('wall_s', ascending=False)
+
+
+def _rows(obj):
+    return len(obj) if hasattr(obj, '__len__') and hasattr(obj, 'columns') else None
+
+
+def instrumented(name=None):
+    """Decorator for RooftopProc stage methods: runs the method as a stage of
+    self.instrument, with the rows of the first table argument as rows_in, the
+    rows of a returned table as rows_out and the raster size as pixels (None
+    if the raster profile has not been loaded yet: logging never opens the
+    DSM)."""
+
+    def wrap(func):
+        stage = name or func.__name__
+
+        @functools.wraps(func)
+        def run(self, *args, **kwargs):
+            rows_in = next((_rows(a) for a in args if _rows(a) is not None), None)
+            meta = self._inputs.get('meta')
+            pixels = meta['height'] * meta['width'] if meta is not None else None
+            with self.instrument.stage(stage, s3=self.S3, rows_in=rows_in,
+                                       pixels=pixels) as event:
+                out = func(self, *args, **kwargs)
+                event['rows_out'] = _rows(out)
+            return out
+        return run
+    return wrap
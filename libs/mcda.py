@@ -0,0 +1,88 @@
+import numpy as np
+
+# criterion directions
+MIN = -1
+MAX = 1
+
+
+def minmax_scale(matrix, invert=None):
+    """Rescales every column to [0, 1] (same as sklearn's MinMaxScaler, which
+    maps constant columns to 0)
+
+    Args:
+        matrix (np.array): (n_alternatives, n_criteria) values
+        invert (list, optional): per column flag; inverted columns are negated
+            before scaling. Defaults to None.
+
+    Returns:
+        np.array: rescaled float64 matrix
+    """
+    matrix = np.array(matrix, dtype='float64', ndmin=2)
+    if invert is not None:
+        matrix[:, np.asarray(invert, dtype=bool)] *= -1
+    lo = np.nanmin(matrix, axis=0)
+    rng = np.nanmax(matrix, axis=0) - lo
+    rng[rng == 0] = 1
+    return (matrix - lo) / rng
+
+
+def _weight_matrix(weights, n_criteria):
+    """(n_scenarios, n_criteria) weights normalized to sum to one"""
+    if weights is None:
+        weights = np.ones(n_criteria)
+    weights = np.array(weights, dtype='float64', ndmin=2)
+    if weights.shape[1] != n_criteria:
+        raise ValueError('Expected {} weights per scenario, got {}.'.format(
+            n_criteria, weights.shape[1]))
+    if (weights < 0).any():
+        raise ValueError('Weights must not be negative.')
+    total = weights.sum(axis=1, keepdims=True)
+    if (total == 0).any():
+        raise ValueError('Every scenario needs at least one positive weight.')
+    return weights / total
+
+
+def topsis(matrix, weights=None, criteria=None):
+    """TOPSIS closeness for a batch of weight scenarios
+
+    The matrix is vector normalized once. Because weights only scale columns,
+    the squared distances to the ideal and anti-ideal solutions of every
+    scenario are (deviation ** 2) @ (weights ** 2).T, so all scenarios are
+    scored with two matrix products.
+
+    Args:
+        matrix (np.array): (n_alternatives, n_criteria) decision matrix
+        weights (list, optional): weights of one scenario (n_criteria,) or of
+            several (n_scenarios, n_criteria); each scenario is normalized to
+            sum to one. Defaults to equal weights.
+        criteria (list, optional): MIN or MAX per criterion. Defaults to MIN
+            for every criterion.
+
+    Returns:
+        tuple: (closeness, rank) arrays of shape (n_alternatives, n_scenarios).
+            Rank 1 is the alternative closest to the ideal solution; equal
+            closeness gets the same (dense) rank.
+    """
+    matrix = np.array(matrix, dtype='float64', ndmin=2)
+    n, m = matrix.shape
+    weights = _weight_matrix(weights, m)
+    criteria = np.full(m, MIN) if criteria is None else np.asarray(criteria)
+
+    norm = np.sqrt(np.sum(matrix ** 2, axis=0))
+    norm[norm == 0] = 1
+    nmtx = matrix / norm
+
+    col_min = nmtx.min(axis=0)
+    col_max = nmtx.max(axis=0)
+    ideal = np.where(criteria == MAX, col_max, col_min)
+    anti_ideal = np.where(criteria == MAX, col_min, col_max)
+
+    w2 = (weights ** 2).T
+    d_better = np.sqrt((nmtx - ideal) ** 2 @ w2)
+    d_worst = np.sqrt((nmtx - anti_ideal) ** 2 @ w2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        closeness = d_worst / (d_better + d_worst)
+    # scipy.stats takes a quarter of a second to import; only pay for it here.
+    from scipy.stats import rankdata
+    rank = rankdata(-closeness, method='dense', axis=0).astype('int64')
+    return closeness, rank
@@ -0,0 +1,339 @@
+"""Queries over the final index (the output of RooftopProc.index_builder()).
+
+IndexQuery keeps the FAIDs in memory sorted by vul_rank, with an STRtree over
+their outlines, so "the best k rooftops in this area with these attributes"
+is one tree query plus a slice. make_server() puts an HTTP API in front of it
+for local testing and tiles() pre-generates GeoJSON tiles for the web map.
+
+HTTP API (responses are GeoJSON in EPSG:4326):
+    GET  /query?bbox=minx,miny,maxx,maxy&k=20&filter=height:3:12&crs=EPSG:4326
+    POST /query  {"geometry": {...}, "k": 20, "filters": {"height": [3, null]}}
+    GET  /tiles/{z}/{x}/{y}.geojson
+
+An empty result or a missing tile is answered with 204 and a malformed
+request with 400.
+"""
+import os
+import json
+import math
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import shapely
+import geopandas as gpd
+from pyproj import CRS, Transformer
+
+WGS84 = 'EPSG:4326'
+# Half the width of the web mercator world in metres.
+MERCATOR_HALF = math.pi * 6378137.0
+# Features are fetched in chunks of this many ranks when there is no area to
+# narrow them down first.
+CHUNK = 4096
+
+
+class IndexQuery(object):
+
+    """
+    In-memory index of ranked FAIDs answering area + top-k + attribute queries.
+    Rows are stored best rank first, so the positions an STRtree query returns
+    are ranks and a sorted slice of them is the top k.
+    """
+
+    def __init__(self, index, rank_col='vul_rank'):
+        """
+        Args:
+            index (gdf): index_builder() output (FAIDs with features,
+                vulnerability and vul_rank, indexed by faid or with a faid
+                column)
+            rank_col (str, optional): rank column, 1 = best. Defaults to
+                'vul_rank'.
+        """
+        if index.index.name is not None:
+            index = index.reset_index()
+        order = np.argsort(index[rank_col].values, kind='stable')
+        index = index.iloc[order].reset_index(drop=True)
+        self.crs = CRS.from_user_input(index.crs)
+        self.rank_col = rank_col
+        self.geoms = np.asarray(index.geometry.values, dtype=object)
+        self.columns = {c: index[c].to_numpy() for c in index.columns
+                        if c != index.geometry.name}
+        self.tree = shapely.STRtree(self.geoms)
+        self._transformers = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Loads an index written by index_builder() (.parquet, .zip or .fgb)"""
+        if path.endswith('.parquet'):
+            return cls(gpd.read_parquet(path), **kwargs)
+        return cls(gpd.read_file(path), **kwargs)
+
+    @classmethod
+    def from_s3(cls, S3, path, **kwargs):
+        """Loads an index written by index_builder() from S3"""
+        return cls(S3.read_gdf_from_s3(path), **kwargs)
+
+    def __len__(self):
+        return len(self.geoms)
+
+    def _transformer(self, src, dst):
+        key = (src, dst)
+        with self._lock:
+            if key not in self._transformers:
+                self._transformers[key] = Transformer.from_crs(src, dst, always_xy=True)
+            return self._transformers[key]
+
+    def _reproject(self, geoms, src, dst):
+        if CRS.from_user_input(src) == CRS.from_user_input(dst):
+            return geoms
+        transformer = self._transformer(src, dst)
+        return shapely.transform(geoms, lambda xy: np.column_stack(
+            transformer.transform(xy[:, 0], xy[:, 1])))
+
+    def _filter(self, pos, filters):
+        """Positions whose attributes lie in the inclusive {col: (lo, hi)}
+        ranges (None for an open end)"""
+        keep = np.ones(len(pos), dtype=bool)
+        for col, (lo, hi) in filters.items():
+            values = self.columns[col][pos]
+            if lo is not None:
+                keep &= values >= lo
+            if hi is not None:
+                keep &= values <= hi
+        return pos[keep]
+
+    def query(self, bbox=None, geometry=None, k=20, filters=None, crs=None,
+              predicate='intersects'):
+        """Positions of the k best ranked FAIDs in an area that pass the filters
+
+        Args:
+            bbox (tuple, optional): (minx, miny, maxx, maxy). Defaults to None.
+            geometry (shapely geometry, optional): area of interest, e.g. a
+                neighbourhood polygon; overrides bbox. Defaults to None (no
+                area: the best k of the whole index).
+            k (int, optional): number of FAIDs, None for all. Defaults to 20.
+            filters (dict, optional): {column: (min, max)} inclusive ranges,
+                None for an open end. Defaults to None.
+            crs (optional): CRS of bbox/geometry. Defaults to the index CRS.
+            predicate (str, optional): STRtree predicate between the area and
+                the FAIDs, e.g. 'intersects' or 'contains'. Defaults to
+                'intersects'.
+
+        Returns:
+            np.array: positions in rank order (see frame() and to_geojson())
+        """
+        filters = filters or {}
+        if geometry is None and bbox is not None:
+            geometry = shapely.box(*bbox)
+        if geometry is None:
+            # Walk the ranks in chunks until k FAIDs pass the filters.
+            found = []
+            n = 0
+            for start in range(0, len(self), CHUNK):
+                pos = self._filter(np.arange(start, min(start + CHUNK, len(self))), filters)
+                found.append(pos)
+                n += len(pos)
+                if k is not None and n >= k:
+                    break
+            pos = np.concatenate(found) if found else np.array([], dtype=np.int64)
+            return pos[:k]
+
+        if crs is not None:
+            geometry = self._reproject(geometry, crs, self.crs)
+        pos = np.sort(self.tree.query(geometry, predicate=predicate))
+        return self._filter(pos, filters)[:k]
+
+    def frame(self, pos):
+        """FAIDs at positions as a gdf"""
+        cols = {c: v[pos] for c, v in self.columns.items()}
+        return gpd.GeoDataFrame(cols, geometry=self.geoms[pos], crs=self.crs)
+
+    def _feature_collection(self, pos, columns, geoms):
+        """GeoJSON text of a FeatureCollection; geometries are already in the
+        output CRS"""
+        props = [_json_values(self.columns[c][pos]) for c in columns]
+        features = ['{{"type": "Feature", "geometry": {}, "properties": {}}}'.format(
+                    geom, json.dumps(dict(zip(columns, row))))
+                    for geom, row in zip(shapely.to_geojson(geoms).tolist(), zip(*props))]
+        return '{{"type": "FeatureCollection", "features": [{}]}}'.format(', '.join(features))
+
+    def to_geojson(self, pos, columns=None, crs=WGS84):
+        """FAIDs at positions as GeoJSON
+
+        Args:
+            pos (np.array): positions from query()
+            columns (list, optional): properties to include. Defaults to all.
+            crs (optional): output CRS. Defaults to EPSG:4326 (as GeoJSON
+                requires).
+
+        Returns:
+            str: a FeatureCollection
+        """
+        columns = list(self.columns) if columns is None else list(columns)
+        return self._feature_collection(pos, columns,
+                                        self._reproject(self.geoms[pos], self.crs, crs))
+
+    def tiles(self, min_zoom=12, max_zoom=16, columns=('faid', 'vulnerability', 'vul_rank')):
+        """Pre-generates GeoJSON tiles in the web mercator z/x/y scheme. Every
+        FAID is clipped to each tile it touches and simplified to the tile's
+        resolution (1/4096 of the tile), so a map only loads the tiles in view.
+
+        Args:
+            min_zoom (int, optional): lowest zoom level. Defaults to 12.
+            max_zoom (int, optional): highest zoom level. Defaults to 16.
+            columns (tuple, optional): properties kept in the tiles. Defaults
+                to faid, vulnerability and vul_rank.
+
+        Returns:
+            dict: {(z, x, y): GeoJSON bytes}
+        """
+        columns = [c for c in columns if c in self.columns]
+        merc = self._reproject(self.geoms, self.crs, 'EPSG:3857')
+        bounds = shapely.bounds(merc)
+        to_wgs84 = self._transformer('EPSG:3857', WGS84)
+        out = {}
+        for z in range(min_zoom, max_zoom + 1):
+            size = 2 * MERCATOR_HALF / 2 ** z
+            x0 = np.floor((bounds[:, 0] + MERCATOR_HALF) / size).astype(np.int64)
+            x1 = np.floor((bounds[:, 2] + MERCATOR_HALF) / size).astype(np.int64)
+            y0 = np.floor((MERCATOR_HALF - bounds[:, 3]) / size).astype(np.int64)
+            y1 = np.floor((MERCATOR_HALF - bounds[:, 1]) / size).astype(np.int64)
+            # One (FAID, tile) pair per tile each FAID touches.
+            nx, ny = x1 - x0 + 1, y1 - y0 + 1
+            pos = np.repeat(np.arange(len(merc)), nx * ny)
+            offset = np.arange(len(pos)) - np.repeat(np.cumsum(nx * ny) - nx * ny, nx * ny)
+            xs = x0[pos] + offset % nx[pos]
+            ys = y0[pos] + offset // nx[pos]
+            order = np.lexsort((pos, ys, xs))
+            pos, xs, ys = pos[order], xs[order], ys[order]
+            simple = shapely.simplify(merc, size / 4096, preserve_topology=True)
+            starts = np.flatnonzero(np.r_[True, (np.diff(xs) != 0) | (np.diff(ys) != 0)])
+            for a, b in zip(starts, np.r_[starts[1:], len(pos)]):
+                x, y = int(xs[a]), int(ys[a])
+                minx = x * size - MERCATOR_HALF
+                maxy = MERCATOR_HALF - y * size
+                clipped = shapely.clip_by_rect(simple[pos[a:b]], minx, maxy - size,
+                                               minx + size, maxy)
+                keep = ~shapely.is_empty(clipped)
+                if not keep.any():
+                    continue
+                clipped = shapely.transform(clipped[keep], lambda xy: np.column_stack(
+                    to_wgs84.transform(xy[:, 0], xy[:, 1])))
+                out[(z, x, y)] = self._feature_collection(pos[a:b][keep], columns,
+                                                          clipped).encode()
+        return out
+
+
+def _json_values(values):
+    """Array as a list of JSON values (NaN becomes null)"""
+    out = values.tolist()
+    if values.dtype.kind == 'f' and np.isnan(values).any():
+        out = [None if v != v else v for v in out]
+    return out
+
+
+def write_tiles(tiles, directory):
+    """Writes tiles from IndexQuery.tiles() as {z}/{x}/{y}.geojson files for
+    static hosting"""
+    for (z, x, y), body in tiles.items():
+        path = os.path.join(directory, str(z), str(x), '{}.geojson'.format(y))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+
+
+def _parse_filters(values):
+    """['height:3:12', 'flat_area:100:'] -> {'height': (3.0, 12.0),
+    'flat_area': (100.0, None)}"""
+    filters = {}
+    for value in values:
+        col, lo, hi = value.split(':')
+        filters[col] = (float(lo) if lo else None, float(hi) if hi else None)
+    return filters
+
+
+def make_server(index_query, host='127.0.0.1', port=8000, tiles=None):
+    """HTTP server answering /query and /tiles requests (see the module
+    docstring). Call serve_forever() on it, or shutdown() from another thread.
+
+    Args:
+        index_query (IndexQuery): the index to serve
+        host (str, optional): interface to bind. Defaults to '127.0.0.1'.
+        port (int, optional): port, 0 for a free one. Defaults to 8000.
+        tiles (dict, optional): tiles from IndexQuery.tiles(). Defaults to None.
+
+    Returns:
+        ThreadingHTTPServer: the server (server_address holds the bound port)
+    """
+    tiles = tiles or {}
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body=b'', content_type='application/geo+json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _query(self, params):
+            k = params.get('k', 20)
+            pos = index_query.query(bbox=params.get('bbox'), geometry=params.get('geometry'),
+                                    k=None if k is None else int(k),
+                                    filters=params.get('filters'),
+                                    crs=params.get('crs', WGS84),
+                                    predicate=params.get('predicate', 'intersects'))
+            if not len(pos):
+                self._send(204)
+                return
+            self._send(200, index_query.to_geojson(pos).encode())
+
+        def _error(self, e):
+            self._send(400, json.dumps({'error': str(e)}).encode(), 'application/json')
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = url.path.strip('/').split('/')
+            try:
+                if parts[0] == 'query':
+                    qs = parse_qs(url.query)
+                    params = {'filters': _parse_filters(qs.get('filter', []))}
+                    if 'bbox' in qs:
+                        params['bbox'] = [float(v) for v in qs['bbox'][0].split(',')]
+                        if len(params['bbox']) != 4:
+                            raise ValueError('bbox must be minx,miny,maxx,maxy')
+                    for key in ('k', 'crs', 'predicate'):
+                        if key in qs:
+                            params[key] = qs[key][0]
+                    self._query(params)
+                elif parts[0] == 'tiles' and len(parts) == 4:
+                    key = (int(parts[1]), int(parts[2]), int(parts[3].split('.')[0]))
+                    if key in tiles:
+                        self._send(200, tiles[key])
+                    else:
+                        self._send(204)
+                else:
+                    self._send(404, b'{"error": "not found"}', 'application/json')
+            except (ValueError, KeyError, TypeError) as e:
+                self._error(e)
+
+        def do_POST(self):
+            if urlparse(self.path).path.strip('/') != 'query':
+                self._send(404, b'{"error": "not found"}', 'application/json')
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                params = json.loads(self.rfile.read(length) or b'{}')
+                if params.get('geometry') is not None:
+                    params['geometry'] = shapely.from_geojson(json.dumps(params['geometry']))
+                params['filters'] = {c: tuple(r) for c, r in (params.get('filters') or {}).items()}
+                self._query(params)
+            except (ValueError, KeyError, TypeError, shapely.errors.GEOSException) as e:
+                self._error(e)
+
+    return ThreadingHTTPServer((host, port), Handler)
@@ -1,94 +1,480 @@
-from shapely.geometry import Polygon, MultiPolygon
-import richdem as rd
+from shapely.geometry import shape
+import shapely
 import pandas as pd
 import numpy as np
 import geopandas as gpd
-import rasterstats
 import rasterio
-import subprocess as sp
-import os
-import shutil
-from sklearn.preprocessing import MinMaxScaler
-from skcriteria import Data, MIN
-from skcriteria.madm import closeness
+from rasterio import features as rio_features
+from rasterio.windows import Window, transform as window_transform
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future
+from .zonal import LabelGrid
+from .tiling import iter_blocks, iter_box_chips
+from .spatial_index import PointIndex
+from .store import RasterStore
+from .histogram import SlopeHistogram
+from .mcda import minmax_scale, topsis
+from .cleanup import clean_flat_labels
+from .instrument import Instrument, instrumented
+from .sun import DEFAULT_DATES, sun_positions, sunlit, caster_reach
+
+# Block size (pixels) of the coarse DSM min/max that bounds sun shadows and 
+# default number of sun positions swept at once per tile.
+SUN_BLOCK = 64
+SUN_THREADS = 4
+
+# shapely type ids
+POLYGON_TYPE_ID = 3
+MULTI_TYPE_IDS = (4, 5, 6, 7)
+
+# Feature registry filled by the @feature decorator. requires lists processor
+# inputs that must exist before the feature runs, after lists features whose
+# columns it reads and kwargs maps feature_builder() kwargs to method arguments.
+FeatureSpec = namedtuple('FeatureSpec', ['requires', 'after', 'kwargs'])
+FEATURES = {}
+INPUT_STAGES = {'slope': 'create_slope_arr()', 'height': 'create_height_arr()',
+                'flat_bldgs': 'pitched_roof_filter()'}
+
+
+def feature(requires=(), after=(), kwargs=None):
+   """Registers a RooftopProc.feature_<name> method with feature_builder().
+   The method takes the rooftops gdf (plus the columns of the features listed in
+   after) and returns a DataFrame of new columns indexed by faid."""
+
+   def register(func):
+      FEATURES[func.__name__[len('feature_'):]] = FeatureSpec(tuple(requires), 
+                                                              tuple(after),
+                                                              kwargs or {})
+      return func
+   return register
+
+
+def resolve_features(features):
+   """Orders features so every feature runs after the ones it depends on, 
+   adding missing dependencies
+
+   Args:
+      features (list): feature names
+
+   Returns:
+      list: lists of feature names; the features in one list are independent of 
+         each other and of everything in later lists
+   """
+   depth = {}
+
+   def visit(name, path):
+      if name not in FEATURES:
+         raise ValueError('Unknown feature: ' + name)
+      if name in path:
+         raise ValueError('Circular feature dependency: ' + ' -> '.join(path + (name,)))
+      if name not in depth:
+         depth[name] = 1 + max((visit(d, path + (name,)) for d in FEATURES[name].after), 
+                               default=-1)
+      return depth[name]
+
+   for f in features:
+      visit(f, ())
+   levels = [[] for _ in range(max(depth.values(), default=-1) + 1)]
+   for name, d in depth.items():
+      levels[d].append(name)
+   return levels
+
+
+def request_order(features):
+   """Features in the order the caller asked for them, each dependency that 
+   was not asked for inserted just before its first dependent. This is the 
+   order their criteria are registered in for index_builder() weights.
+
+   Args:
+      features (list): feature names
+
+   Returns:
+      list: feature names
+   """
+   order = []
+
+   def place(name):
+      for dep in FEATURES[name].after:
+         if dep not in features and dep not in order:
+            place(dep)
+      order.append(name)
+
+   for f in features:
+      if f not in order:
+         place(f)
+   return order
 
 
 class RooftopProc(object):
 
-   def __init__(self, S3, main_dir, dsm_fname, hfdem_fname, bldgs_fname, bldgs_id):
+   def __init__(self, S3, main_dir, dsm_fname, hfdem_fname, bldgs_fname, bldgs_id,
+                bounds=None, pad=1, crop_to_bldgs=False, memmap=False, instrument=None):
+      """
+      Args:
+         S3 (S3Helper): S3 helper for the bucket holding the inputs
+         main_dir (str): directory to read and write from in the S3 bucket
+         dsm_fname (str): file name of the DSM geotiff
+         hfdem_fname (str): file name of the HFDEM geotiff
+         bldgs_fname (str or gdf): file name of the building footprints (zipped 
+            shapefile, GeoParquet or FlatGeobuf), or an already loaded 
+            GeoDataFrame of footprints
+         bldgs_id (str): name of the unique building id column
+         bounds (tuple, optional): (minx, miny, maxx, maxy) in the raster CRS. If
+            set, all raster work is restricted to this window. Defaults to None.
+         pad (int, optional): pixels added around bounds so slope at the edge of 
+            the window matches the full scene. Defaults to 1.
+         crop_to_bldgs (bool, optional): restrict raster work to the bounds of the
+            footprints when bounds is not given. With tiled (COG) inputs on S3 
+            only the blocks inside that window are downloaded. Defaults to False.
+         memmap (bool, optional): keep the decoded bands and derived rasters in 
+            memory-mapped files on local disk instead of RAM. Defaults to False.
+         instrument (Instrument, optional): receives an event per stage (time, 
+            memory, counts, S3 bytes). Defaults to an Instrument that only keeps
+            the events in memory.
+      """
       self.S3 = S3
       self.main_dir = main_dir
-      self.dsm_rio = S3.read_tif_from_s3_as_rio(main_dir + dsm_fname)
-      self.hfdem_rio = S3.read_tif_from_s3_as_rio(main_dir + hfdem_fname)
-      self.meta = self.dsm_rio.meta
-      self.epsg = self.meta['crs'].to_epsg()
-      self.bldgs = S3.read_shp_from_s3_as_gpd(main_dir + bldgs_fname).to_crs(self.epsg)
-      if bldgs_id not in self.bldgs.columns:
-         self.bldgs[bldgs_id] = range(len(self.bldgs))
+      self.dsm_fname = dsm_fname
+      self.hfdem_fname = hfdem_fname
+      self.bldgs_fname = bldgs_fname
       self.bldgs_id = bldgs_id
+      self.bounds = bounds
+      self.pad = pad
+      self.crop_to_bldgs = crop_to_bldgs
+      self.instrument = instrument or Instrument()
       self.col_names = []
+      self._inputs = {}
+      self._label_grids = {}
+      self._pt_indexes = {}
+      self._slope_hist = None
+      self._parapet_cache = None
+      self._lock = threading.RLock()
+      self.rasters = RasterStore(memmap)
+
+   # Inputs are opened and read on first use, so constructing a RooftopProc is
+   # free and a worker only pays for what its stages touch.
+
+   def _lazy(self, name, load):
+      """Returns the input under name, loading it with load() on first use 
+      (once, even when several feature threads ask at the same time)"""
+
+      try:
+         return self._inputs[name]
+      except KeyError:
+         pass
+      with self._lock:
+         if name not in self._inputs:
+            self._inputs[name] = load()
+         return self._inputs[name]
+
+   def load(self):
+      """Opens the rasters and reads the footprints now instead of on first use,
+      e.g. to fail early on a missing input."""
+
+      self.dsm_rio, self.hfdem_rio, self.bldgs, self.meta
+      return self
+
+   def _open_raster(self, name, fname):
+      with self.instrument.stage('open_' + name, s3=self.S3):
+         return self.S3.read_tif_from_s3_as_rio(self.main_dir + fname)
+
+   @property
+   def dsm_rio(self):
+      return self._lazy('dsm_rio', lambda: self._open_raster('dsm', self.dsm_fname))
+
+   @property
+   def hfdem_rio(self):
+      return self._lazy('hfdem_rio', lambda: self._open_raster('hfdem', self.hfdem_fname))
+
+   @property
+   def epsg(self):
+      return self._lazy('epsg', lambda: self.dsm_rio.crs.to_epsg())
+
+   def _load_bldgs(self):
+      with self.instrument.stage('load_bldgs', s3=self.S3) as event:
+         if isinstance(self.bldgs_fname, gpd.GeoDataFrame):
+            bldgs = self.bldgs_fname.to_crs(self.epsg)
+         else:
+            bldgs = self.S3.read_gdf_from_s3(self.main_dir + self.bldgs_fname).to_crs(self.epsg)
+         event['rows_out'] = len(bldgs)
+      if self.bldgs_id not in bldgs.columns:
+         bldgs[self.bldgs_id] = range(len(bldgs))
+      return bldgs
+
+   @property
+   def bldgs(self):
+      return self._lazy('bldgs', self._load_bldgs)
+
+   @bldgs.setter
+   def bldgs(self, gdf):
+      self._inputs['bldgs'] = gdf
+
+   def _load_window(self):
+      bounds = self.bounds
+      if bounds is None and self.crop_to_bldgs and len(self.bldgs):
+         bounds = self.bldgs.total_bounds
+      return None if bounds is None else self._bounds_window(bounds, self.pad)
+
+   @property
+   def window(self):
+      """Pixel window of the DSM that raster work is restricted to, or None"""
+      return self._lazy('window', self._load_window)
+
+   def _load_meta(self):
+      meta = self.dsm_rio.meta.copy()
+      if self.window is not None:
+         meta.update(height=self.window.height, width=self.window.width,
+                     transform=self.dsm_rio.window_transform(self.window))
+      return meta
+
+   @property
+   def meta(self):
+      """Raster profile of the DSM (restricted to window)"""
+      return self._lazy('meta', self._load_meta)
+
+   @property
+   def slope_arr(self):
+      return self.rasters['slope']
+
+   @slope_arr.setter
+   def slope_arr(self, arr):
+      self.rasters.put('slope', arr, dtype='float32')
+
+   @property
+   def height_arr(self):
+      return self.rasters['height']
+
+   @height_arr.setter
+   def height_arr(self, arr):
+      self.rasters.put('height', arr, dtype='float32')
+
+   def release(self, *names):
+      """Frees stored rasters ('dsm', 'hfdem', 'slope', 'height') or cached label
+      grids (by layer name) that later stages no longer need. For example, after 
+      create_slope_arr() and create_height_arr() the DSM and HFDEM are not used
+      again: Rooftop.release('dsm', 'hfdem')."""
+
+      self.rasters.release(*names)
+      for name in names:
+         self._label_grids.pop(name, None)
+      if 'slope' in names or 'bldgs' in names:
+         self._slope_hist = None
+      self._parapet_cache = None
+
+   def _band(self, name):
+      """Input band ('dsm' or 'hfdem') as float32, decoded once and shared by 
+      all stages"""
+
+      src = getattr(self, name + '_rio')
+      return self.rasters.load(name, lambda: self._read_band(src))
       
-   def create_slope_arr(self, slope_fname):
-      """Calculates slope of DSM raster. Returns as numpy array and writes results 
-      to S3 bucket as a geotiff.
+   def _bounds_window(self, bounds, pad):
+      """Pixel window of the DSM covering bounds plus pad pixels, clipped to the 
+      raster extent"""
 
-      Args:
-         slope_fname (str): file name of slope geotiff to be written to S3 bucket
+      inv = ~self.dsm_rio.transform
+      c0, r0 = inv * (bounds[0], bounds[3])
+      c1, r1 = inv * (bounds[2], bounds[1])
+      c0 = max(int(np.floor(c0)) - pad, 0)
+      r0 = max(int(np.floor(r0)) - pad, 0)
+      c1 = min(int(np.ceil(c1)) + pad, self.dsm_rio.width)
+      r1 = min(int(np.ceil(r1)) + pad, self.dsm_rio.height)
+      return Window(c0, r0, c1 - c0, r1 - r0)
+
+   def _read_band(self, src, window=None):
+      """Reads band 1 of src restricted to self.window. window is relative to 
+      self.window."""
+
+      if self.window is not None:
+         if window is None:
+            window = self.window
+         else:
+            window = Window(window.col_off + self.window.col_off, 
+                            window.row_off + self.window.row_off,
+                            window.width, window.height)
+      return src.read(1, window=window)
+
+   def _slope(self, dsm_arr, affine):
+      """Runs richdem slope (degrees) on a DSM array with the given transform"""
+
+      import richdem as rd
 
-      Returns:
-         np.array: array of slope values as degrees
-      """
-      nodata = self.meta['nodata']
-      affine = self.meta['transform']
       geotransform = (affine[2], 
                      affine[0], 
                      affine[1], 
                      affine[5], 
                      affine[3], 
                      affine[4])
-      crs = self.dsm_rio.crs.to_proj4()
-      dsm_arr = self.dsm_rio.read(1).astype('float64')
-      dsm_rd = rd.rdarray(dsm_arr, no_data=nodata)
+      dsm_rd = rd.rdarray(dsm_arr, no_data=self.meta['nodata'])
       dsm_rd.geotransform = geotransform
-      dsm_rd.projection = crs
-      slope = np.array(rd.TerrainAttribute(dsm_rd, attrib='slope_degrees'))
-      self.S3.write_raster_to_s3(slope, self.main_dir + slope_fname, self.meta)
+      dsm_rd.projection = self.dsm_rio.crs.to_proj4()
+      return np.array(rd.TerrainAttribute(dsm_rd, attrib='slope_degrees'))
+
+   @instrumented()
+   def create_slope_arr(self, slope_fname, block_size=None, footprints_only=False,
+                        footprint_pad=2):
+      """Calculates slope of DSM raster. Returns as numpy array and writes results 
+      to S3 bucket as a geotiff.
+
+      Args:
+         slope_fname (str): file name of slope geotiff to be written to S3 bucket
+         block_size (int, optional): if set, the DSM is processed in blocks of 
+            block_size x block_size pixels with a one pixel halo and each block is
+            streamed to the geotiff, so peak memory depends on the block size 
+            instead of the scene size. The returned array is then memory-mapped 
+            from local disk. Output is identical to the whole-array path. 
+            Defaults to None (whole array).
+         footprints_only (bool, optional): only calculate slope in the 
+            bounding boxes of the building footprints (grown by footprint_pad
+            pixels), the only pixels later stages read. Nearby boxes are 
+            grouped into chips and the DSM is read and processed chip by chip
+            with a one pixel halo, so the work scales with the roof area instead
+            of the scene; all other pixels are set to nodata. Values inside the
+            chips are identical to the whole-array path. Defaults to False.
+         footprint_pad (int, optional): pixels added around each footprint 
+            box with footprints_only. Defaults to 2.
+
+      Returns:
+         np.array: array of slope values as degrees
+      """
+      if footprints_only:
+         return self._create_slope_arr_sparse(slope_fname, footprint_pad, block_size)
+      if block_size:
+         return self._create_slope_arr_blocked(slope_fname, block_size)
+
+      slope = self._slope(self._band('dsm'), self.meta['transform'])
+      self.S3.write_raster_to_s3(slope, self.main_dir + slope_fname, self.meta, 
+                                cog=True)
       self.slope_arr = slope
+      return self.slope_arr
+
+   def _create_slope_arr_blocked(self, slope_fname, block_size):
+      """Windowed version of create_slope_arr()"""
+
+      shape = (self.meta['height'], self.meta['width'])
+      slope = self.rasters.empty('slope', shape, 'float32', memmap=True)
+      with self.S3.open_raster_writer(self.main_dir + slope_fname, self.meta, 
+                                      cog=True) as dst:
+         for read_win, write_win, inner in iter_blocks(self.meta['height'], 
+                                                       self.meta['width'],
+                                                       block_size, halo=1):
+            dsm_arr = self._read_band(self.dsm_rio, read_win).astype('float32')
+            affine = window_transform(read_win, self.meta['transform'])
+            block = self._slope(dsm_arr, affine)[inner]
+            dst.write(block.astype(dst.dtypes[0]), 1, window=write_win)
+            slope[write_win.toslices()] = block
+
+      slope.flush()
+      return slope
+
+   def _create_slope_arr_sparse(self, slope_fname, footprint_pad, block_size=None):
+      """Footprint chip version of create_slope_arr()"""
+
+      shape = (self.meta['height'], self.meta['width'])
+      nodata = self.meta['nodata']
+      slope = self.rasters.empty('slope', shape, 'float32', 
+                                 memmap=True if block_size else None)
+      slope[...] = np.nan if nodata is None else nodata
+      from scipy import ndimage
+      boxes = ndimage.find_objects(self._label_grid(self.bldgs, self.bldgs_id, 'bldgs').labels)
+      for read_win, write_win, inner in iter_box_chips(boxes, shape[0], shape[1],
+                                                       pad=footprint_pad, halo=1):
+         if 'dsm' in self.rasters:
+            dsm_arr = self.rasters['dsm'][read_win.toslices()]
+         else:
+            dsm_arr = self._read_band(self.dsm_rio, read_win).astype('float32')
+         affine = window_transform(read_win, self.meta['transform'])
+         slope[write_win.toslices()] = self._slope(dsm_arr, affine)[inner]
+
+      if block_size:
+         with self.S3.open_raster_writer(self.main_dir + slope_fname, self.meta, 
+                                         cog=True) as dst:
+            for _, write_win, _ in iter_blocks(shape[0], shape[1], block_size):
+               dst.write(slope[write_win.toslices()].astype(dst.dtypes[0]), 1, 
+                         window=write_win)
+         slope.flush()
+         return slope
+      self.S3.write_raster_to_s3(slope, self.main_dir + slope_fname, self.meta, 
+                                cog=True)
       return slope
 
-   def create_height_arr(self, out_fname):
+   @instrumented()
+   def create_height_arr(self, out_fname, block_size=None):
       """Calculates structure height. Returns as numpy array and writes results to
       S3 bucket as a geotiff.
 
       Args:
          out_fname (str): file name of height geotiff to be written to S3 bucket. 
+         block_size (int, optional): if set, height is computed and streamed to
+            the geotiff in blocks of block_size x block_size pixels and the 
+            returned array is memory-mapped from local disk. Defaults to None
+            (whole array).
 
       Returns:
          np.array: numpy array of height above ground surface
       """
+      if block_size:
+         return self._create_height_arr_blocked(out_fname, block_size)
 
-      dsm_arr = self.dsm_rio.read(1).astype('float64')
-      hfdem_arr = self.hfdem_rio.read(1).astype('float64')
-      height = dsm_arr - hfdem_arr
-      self.S3.write_raster_to_s3(height, self.main_dir + out_fname, self.meta)
+      height = self._band('dsm') - self._band('hfdem')
+      self.S3.write_raster_to_s3(height, self.main_dir + out_fname, self.meta,
+                                cog=True)
       self.height_arr = height
+      return self.height_arr
+
+   def _create_height_arr_blocked(self, out_fname, block_size):
+      """Windowed version of create_height_arr()"""
+
+      shape = (self.meta['height'], self.meta['width'])
+      height = self.rasters.empty('height', shape, 'float32', memmap=True)
+      with self.S3.open_raster_writer(self.main_dir + out_fname, self.meta, 
+                                      cog=True) as dst:
+         for _, write_win, _ in iter_blocks(self.meta['height'], self.meta['width'],
+                                            block_size):
+            dsm_arr = self._read_band(self.dsm_rio, write_win).astype('float32')
+            hfdem_arr = self._read_band(self.hfdem_rio, write_win).astype('float32')
+            block = dsm_arr - hfdem_arr
+            dst.write(block.astype(dst.dtypes[0]), 1, window=write_win)
+            height[write_win.toslices()] = block
+
+      height.flush()
       return height
 
-   def _zstats_flat_area(self, x):
-      """Used in zonal_stats calculation for sloped area"""
-      flat_count = np.ma.sum(x)
-      affine = self.meta['transform']
-      return flat_count * affine[0] * -affine[4]
-   
-   def _zstats_total_area(self, x):
-      """Used in zonal_stats calculation for total polygon area"""
-      total_count = np.count_nonzero(x+100)
+   def _label_grid(self, gdf, id_col, layer=None, all_touched=False):
+      """Returns the label grid of a polygon layer, rasterizing it only if the
+      layer changed since the last call for the same layer name (defaults to 
+      id_col). See LabelGrid.from_gdf() for all_touched."""
+
+      key = hashlib.sha1(np.asarray(gdf[id_col]).tobytes() + bytes([all_touched]))
+      for wkb in shapely.to_wkb(np.asarray(gdf.geometry.values)):
+         key.update(wkb)
+      key = key.hexdigest()
+      layer = layer or id_col
+      with self._lock:
+         cached = self._label_grids.get(layer)
+         if cached is None or cached[0] != key:
+            shape = (self.meta['height'], self.meta['width'])
+            grid = LabelGrid.from_gdf(gdf, id_col, shape, self.meta['transform'],
+                                      all_touched=all_touched)
+            self._label_grids[layer] = (key, grid)
+         return self._label_grids[layer][1]
+
+   def _pixel_area(self):
       affine = self.meta['transform']
-      return total_count * affine[0] * -affine[4]
+      return affine[0] * -affine[4]
 
+   @instrumented()
    def pitched_roof_filter(self, pitch_slope_threshold=11, pitch_area_threshold=9):
       """Filters out roofs that are not flat based on pst and pat hyperparameters
 
+      total_area is the area of the pixels whose centres lie in the footprint 
+      and flat_area_perc the share of those with a slope up to 
+      pitch_slope_threshold. (Before the label grid, total_area counted every 
+      pixel of the footprint's bounding window, which understated 
+      flat_area_perc for L-shaped and other non-rectangular footprints.)
+
       Args:
           pitch_slope_threshold (int, optional): hyperparameter. Defaults to 11.
           pitch_area_threshold (int, optional): hyperparameter. Defaults to 9.
@@ -97,16 +483,22 @@ class RooftopProc(object):
           gpd: Geopandas dataframe of buildings with flat(ish) roofs
       """
       stat_name = 'flat_area'
-      slope_arr = np.where(self.slope_arr > pitch_slope_threshold, 0, 1)
-      zstats = rasterstats.zonal_stats(self.bldgs, slope_arr, 
-                                       affine=self.meta['transform'],
-                                       nodata = self.meta['nodata'],
-                                       geojson_out=True, 
-                                       add_stats={stat_name: self._zstats_flat_area,
-                                                  'total_area': self._zstats_total_area})
-      
-      gdf = self._add_zstats_to_gpd(zstats, self.bldgs, stat_name, self.bldgs_id)
-      gdf = self._add_zstats_to_gpd(zstats, gdf, 'total_area', self.bldgs_id)
+      hist = self._cached_slope_hist()
+      if hist is not None and self._on_bin_edge(hist, pitch_slope_threshold):
+         # Same counts as the zonal pass below, read from the histograms.
+         zstats = pd.DataFrame({'flat_sum': hist.count_below(pitch_slope_threshold, 
+                                                             nan_below=True)[:, 0],
+                                'flat_count': hist.total_count()},
+                               index=pd.Index(hist.ids, name=hist.id_col))
+      else:
+         slope_arr = ~(self.slope_arr > pitch_slope_threshold)
+         grid = self._label_grid(self.bldgs, self.bldgs_id, 'bldgs')
+         zstats = grid.zonal_stats({'flat': slope_arr}, stats=['count', 'sum'])
+      zstats[stat_name] = zstats['flat_sum'] * self._pixel_area()
+      zstats['total_area'] = zstats['flat_count'] * self._pixel_area()
+
+      gdf = self._join_zstats(self.bldgs, zstats, {stat_name: stat_name, 
+                                                   'total_area': 'total_area'})
          
       gdf = gdf.astype({stat_name: np.float64, 'total_area':np.float64}, copy=True)
       gdf[stat_name + '_perc'] = (gdf[stat_name]/gdf['total_area'])*100
@@ -116,100 +508,202 @@ class RooftopProc(object):
       self.flat_bldgs = flat_bldgs
       return flat_bldgs
 
-   def _add_zstats_to_gpd(self, zstats, gdf, name, join_col):
-      """Adds json zstats to gdf as new column
+   @instrumented()
+   def slope_histograms(self, bin_width=0.5):
+      """Precomputes a slope histogram per building (one pass over the slope 
+      raster). Afterwards pitched_roof_filter() with a threshold on a bin edge, 
+      pitched_roof_sweep() and flat_area_sweep() no longer read the raster.
+
+      Args:
+         bin_width (float, optional): bin width in degrees. Defaults to 0.5.
+
+      Returns:
+         SlopeHistogram: histograms keyed by bldgs_id
+      """
+
+      grid = self._label_grid(self.bldgs, self.bldgs_id, 'bldgs')
+      hist = self._cached_slope_hist()
+      if hist is None or hist.bin_width != bin_width:
+         hist = SlopeHistogram.from_grid(grid, self.slope_arr, bin_width)
+         self._slope_hist = (self.slope_arr, grid, hist)
+      return hist
+
+   def _cached_slope_hist(self):
+      """Histograms from slope_histograms() if they still match the current 
+      slope raster and footprints, else None"""
+
+      if self._slope_hist is None or 'slope' not in self.rasters:
+         return None
+      slope, grid, hist = self._slope_hist
+      if slope is not self.slope_arr or \
+            grid is not self._label_grid(self.bldgs, self.bldgs_id, 'bldgs'):
+         return None
+      return hist
+
+   @staticmethod
+   def _on_bin_edge(hist, threshold):
+      return float(threshold) == hist.edges[hist._edge_index([threshold])[0]]
+
+   def pitched_roof_sweep(self, pitch_slope_thresholds, pitch_area_thresholds, 
+                          bin_width=0.5):
+      """Evaluates pitched_roof_filter() for every combination of thresholds from
+      the slope histograms. Results are exact for slope thresholds on a bin edge.
+
+      Args:
+         pitch_slope_thresholds (list): pitch slope thresholds in degrees
+         pitch_area_thresholds (list): pitch area thresholds in percent
+         bin_width (float, optional): histogram bin width. Defaults to 0.5.
+
+      Returns:
+         pd.DataFrame: per threshold pair, the number of flat buildings and their
+            summed flat_area and total_area
+      """
+
+      hist = self.slope_histograms(bin_width)
+      return hist.sweep(pitch_slope_thresholds, pitch_area_thresholds, 
+                        self._pixel_area())
+
+   def flat_area_sweep(self, fa_slope_thresholds, bldgs=None, bin_width=0.5):
+      """Flat pixel area (slope <= fa_slope_thresh) of each building for several 
+      fa_slope_thresh values, from the slope histograms. This is the area 
+      flat_area_disaggregator() splits into FAIDs, so a building can only yield 
+      a FAID larger than fa_area_thresh if its flat area is at least that large.
+
+      Args:
+         fa_slope_thresholds (list): slope thresholds in degrees
+         bldgs (gdf, optional): buildings to report. Defaults to flat_bldgs.
+         bin_width (float, optional): histogram bin width. Defaults to 0.5.
+
+      Returns:
+         pd.DataFrame: indexed by bldgs_id, one column per threshold
+      """
+
+      hist = self.slope_histograms(bin_width)
+      bldgs = self.flat_bldgs if bldgs is None else bldgs
+      area = hist.count_below(fa_slope_thresholds) * self._pixel_area()
+      area = pd.DataFrame(area, index=pd.Index(hist.ids, name=self.bldgs_id),
+                          columns=np.atleast_1d(fa_slope_thresholds))
+      return area.loc[bldgs[self.bldgs_id].values]
+
+   def _join_zstats(self, gdf, zstats, cols, join_col=None):
+      """Joins columns of a zonal stats DataFrame onto gdf
 
       Args:
-          zstats (json): results from zonal_stats
           gdf (gdf): geodataframe to add zstats to
-          name (str): name of json property to use for gdf column
-          join_col (str): name of common property (json) and column (gdf) to join on
+          zstats (pd.DataFrame): results from LabelGrid.zonal_stats, indexed by id
+          cols (dict): {zstats column: new gdf column}
+          join_col (str, optional): gdf column matching the zstats index. 
+            Defaults to the zstats index name.
       """
-      
-      nlist = []
-      for b in zstats:
-         b_new = (b['properties'][join_col], b['properties'][name])
-         nlist.append(b_new)
-         
-      new_gdf = gpd.GeoDataFrame(nlist, columns=[join_col, name])
-      full_gdf = gdf.merge(new_gdf, on=join_col)
-      return full_gdf
+
+      join_col = join_col or zstats.index.name
+      new_cols = zstats[list(cols)].rename(columns=cols)
+      return gdf.join(new_cols, on=join_col, how='inner')
    
-   def polygonize_raster(self, arr):
-      """Converts numpy array to vector polygons
+   def polygonize_raster(self, arr, mask=None):
+      """Converts numpy array to vector polygons in memory. Each polygon is a 
+      connected region of equal value; the value is kept in the 'DN' column and
+      regions with value 0 are dropped.
 
       Args:
-          arr (np.array): array to be converted to vector polygons
+          arr (np.array): integer or float32 array to be converted to vector polygons
+          mask (np.array, optional): boolean array; only True pixels are 
+            polygonized. Defaults to None (all pixels).
       """
-       # Make temporary directory to perform polygonize operations in.
-
-      temp = 'temp'
-      if not os.path.isdir(temp):
-         os.mkdir(temp)
-
-      # Write raster to temp directory
-      f = os.path.join(temp, 'flat_tmp.tif')
-      out = rasterio.open(f, 'w', **self.meta)
-      out.write(arr[np.newaxis].astype(np.float32))
-      out.close()
-
-      # Polygonize and return shapefile
-      print('Creating polygons from raster data. Hang on, this may take a bit.')
-      sp.call(['gdal_polygonize.py', f, os.path.join(temp, 'polys.shp')])
-      flat_vec = gpd.read_file(os.path.join(temp, 'polys.shp'))
-      flat_vec = flat_vec.set_crs(self.epsg, allow_override=True)
-      flat_vec = flat_vec[flat_vec['DN'] != 0]
-      
-      # Remove temporary directory
-      shutil.rmtree(temp)
 
+      if arr.dtype == np.bool_:
+         arr = arr.astype(np.uint8)
+      shapes = rio_features.shapes(arr, mask=mask, transform=self.meta['transform'])
+      values, geoms = [], []
+      for geom, value in shapes:
+         if value != 0:
+            geoms.append(shape(geom))
+            values.append(value)
+
+      flat_vec = gpd.GeoDataFrame({'DN': np.array(values, dtype=arr.dtype)},
+                                  geometry=geoms, crs=self.epsg)
       return flat_vec   
 
    def convert_multipgons_to_pgons(self, gdf):
-      """Converts all multipolygons to individual polygons in a gdf.
-      See https://gist.github.com/mhweber/cf36bb4e09df9deee5eb54dc6be74d26
-
-      #TODO: Would apply() be faster?
+      """Converts all multipolygons to individual polygons in a gdf. Polygons 
+      inside GeometryCollections (e.g. from gpd.overlay) are kept as well; any 
+      other geometry type is dropped. Attributes and dtypes are preserved and the
+      output has a fresh RangeIndex. Runs in linear time.
 
       Args:
           gdf (GeoDataFrame): multipolygon geodataframe to be converted
       """
       
-      new_gdf = gpd.GeoDataFrame(columns=gdf.columns)      
-      for _, row in gdf.iterrows():
-         if type(row.geometry) == Polygon:
-               new_gdf = new_gdf.append(row,ignore_index=True)
-         if type(row.geometry) == MultiPolygon:
-               mult_gdf = gpd.GeoDataFrame(columns=gdf.columns)
-               recs = len(row.geometry)
-               mult_gdf = mult_gdf.append([row]*recs,ignore_index=True)
-               for geom in range(recs):
-                  mult_gdf.loc[geom,'geometry'] = row.geometry[geom]
-               new_gdf = new_gdf.append(mult_gdf,ignore_index=True)
+      geom_col = gdf.geometry.name
+      parts = np.asarray(gdf.geometry.values, dtype=object)
+      rows = np.arange(len(gdf))
+
+      # Flatten multi-part geometries and (possibly nested) collections.
+      while True:
+         multi = np.isin(shapely.get_type_id(parts), MULTI_TYPE_IDS)
+         if not multi.any():
+            break
+         sub, sub_idx = shapely.get_parts(parts[multi], return_index=True)
+         parts = np.concatenate([parts[~multi], sub])
+         rows = np.concatenate([rows[~multi], rows[multi][sub_idx]])
+
+      keep = (shapely.get_type_id(parts) == POLYGON_TYPE_ID) & ~shapely.is_empty(parts)
+      order = np.argsort(rows[keep], kind='stable')
+      new_gdf = gdf.iloc[rows[keep][order]].reset_index(drop=True)
+      new_gdf[geom_col] = gpd.GeoSeries(parts[keep][order], crs=gdf.crs)
       return new_gdf
  
+   @instrumented()
    def flat_area_disaggregator(self, bldgs, fa_slope_thresh, fa_area_thresh,
-                               out_fname):
+                               out_fname, smooth_sigma=0, open_radius=0, close_radius=0,
+                               min_patch_area=0, tile_size=1024, max_threads=None):
       """Disaggregates building footprint polygons to polygons representing flat areas
 
+      The flat raster can be cleaned up before it is polygonized (see 
+      cleanup.clean_flat_tile()): slope smoothed with a Gaussian filter, the 
+      flat mask opened and closed and patches smaller than min_patch_area 
+      dropped. This removes the slivers that would otherwise be polygonized, 
+      clipped and only then dropped by fa_area_thresh. All of it is off by 
+      default.
+
       Args:
           bldgs (gdf): geodataframe of building footprints (after slope filter)
           fa_slope_thresh (int): slope threshold to determine flat area
           fa_area_thresh (int): minimum area (sf) for defining as a flat area
-          out_fname (str): filename for output shapefile
+          out_fname (str): filename for output layer (.zip shapefile, .parquet or .fgb)
+          smooth_sigma (float, optional): Gaussian sigma in pixels. Defaults to 0.
+          open_radius (float, optional): opening radius in pixels. Defaults to 0.
+          close_radius (float, optional): closing radius in pixels. Defaults to 0.
+          min_patch_area (float, optional): smallest flat patch (map units) kept
+             before polygonizing. Defaults to 0.
+          tile_size (int, optional): tile size of the cleanup. Defaults to 1024.
+          max_threads (int, optional): threads of the cleanup. Defaults to the 
+             ThreadPoolExecutor default.
       """
 
       # If the building slope is less than fa_slope_thresh, classify as flat.
-      flat = np.where(self.slope_arr <= fa_slope_thresh, 1, 0)
+      # Only pixels touching the flat building footprints are kept, labelled 
+      # with the building they belong to; the clip below cuts the edge pixels 
+      # back to the outline, so a FAID covers its whole footprint as with an 
+      # overlay. A pixel touched by two footprints goes to the later one.
+      grid = self._label_grid(bldgs, self.bldgs_id, 'flat_bldgs_touched', all_touched=True)
+      min_pixels = int(np.ceil(min_patch_area / self._pixel_area()))
+      if smooth_sigma > 0 or open_radius >= 1 or close_radius >= 1 or min_pixels > 1:
+         flat = clean_flat_labels(self.slope_arr, grid.labels, fa_slope_thresh, 
+                                  smooth_sigma, open_radius, close_radius, min_pixels,
+                                  self.meta['nodata'], tile_size, max_threads)
+      else:
+         flat = np.where(self.slope_arr <= fa_slope_thresh, grid.labels, 0)
       
-      # Convert flat np.array to polygon.
-      flat_vector = self.polygonize_raster(flat)
+      # Convert flat np.array to polygons, one per connected flat patch per building.
+      flat_vector = self.polygonize_raster(flat, mask=flat > 0)
       
-      # Spatial join of buildings and flat areas.
-      joined = gpd.overlay(flat_vector.to_crs(self.epsg), bldgs, how='intersection')
-      
-      # Drop unnecessary column. 
-      joined = joined.drop(columns='DN')
+      # Clip each patch to its own footprint and carry the building attributes.
+      rows = flat_vector['DN'].values - 1
+      joined = bldgs.iloc[rows].reset_index(drop=True)
+      clipped = shapely.intersection(flat_vector.geometry.values, 
+                                     joined.geometry.values)
+      joined[joined.geometry.name] = gpd.GeoSeries(clipped, crs=bldgs.crs)
       
       # Convert all the multipolygons to individual polygons.
       joined = self.convert_multipgons_to_pgons(joined)
@@ -218,129 +712,175 @@ class RooftopProc(object):
       # Filter buildings with an area smaller than 1000 Sq. Ft.
       joined['flat_area'] = joined['geometry'].area 
       joined = joined[joined['flat_area'] > fa_area_thresh]
-      joined = joined.sort_values(by='fid')
+      joined = joined.sort_values(by=self.bldgs_id, kind='stable')
       joined['faid'] = range(joined.shape[0])
       
-      self.col_names.append(('flat_area', False))
+      self._add_col_name('flat_area', False)
       self.S3.write_gdf_to_s3(joined, self.main_dir + out_fname)
       
       return joined      
 
+   def _add_col_name(self, colname, invert):
+      """Registers a feature column for index_builder(). A feature that is 
+      computed again replaces its entry in place, so weights given by position
+      keep applying to the same criteria."""
+
+      with self._lock:
+         names = [c[0] for c in self.col_names]
+         if colname in names:
+            self.col_names[names.index(colname)] = (colname, invert)
+         else:
+            self.col_names.append((colname, invert))
+
+   @staticmethod
+   def _faid_frame(rooftops, **cols):
+      """DataFrame of feature columns indexed by faid, ready to be joined onto
+      rooftops"""
+
+      return pd.DataFrame(cols, index=pd.Index(rooftops['faid'].values, name='faid'))
+
+   @feature(requires=('slope',))
+   @instrumented()
    def feature_average_slope(self, rooftops):
       """Calculates average slope of rooftop area. Used in feature_builder()"""
       
-      affine = self.meta['transform']
-      nodata = self.meta['nodata']
-      zstats = rasterstats.zonal_stats(rooftops, self.slope_arr, affine=affine,
-                                 nodata=nodata, geojson_out=True,
-                                 stats=['mean'])
-      gdf = self._add_zstats_to_gpd(zstats, rooftops, 'mean', 'faid')
-      gdf.rename(columns={'mean': 'avg_slope'}, inplace=True)
-      self.col_names.append(('avg_slope', True))
+      grid = self._label_grid(rooftops, 'faid')
+      zstats = grid.zonal_stats({'slope': self.slope_arr}, stats=['mean'],
+                                nodata=self.meta['nodata'])
+      self._add_col_name('avg_slope', True)
 
       print('Adding average slope feature now.')
-      return gdf
+      return zstats[['slope_mean']].rename(columns={'slope_mean': 'avg_slope'})
 
+   @feature(requires=('height',))
+   @instrumented()
    def feature_height(self, rooftops):
       """Calculates median rooftop height. Used in feature_builder()"""
 
-      affine = self.meta['transform']
-      nodata = self.meta['nodata']
-      zstats = rasterstats.zonal_stats(rooftops, self.height_arr, affine=affine,
-                                       nodata=nodata, geojson_out=True, 
-                                       stats='median')
-      gdf = self._add_zstats_to_gpd(zstats, rooftops, 'median', 'faid')
-      gdf.rename(columns={'median': 'height'}, inplace=True)
-      self.col_names.append(('height', False))
+      grid = self._label_grid(rooftops, 'faid')
+      zstats = grid.zonal_stats({'height': self.height_arr}, stats=['median'],
+                                nodata=self.meta['nodata'])
+      self._add_col_name('height', False)
       print('Adding median height feature now.')
-      return gdf
+      return zstats[['height_median']].rename(columns={'height_median': 'height'})
    
-   def _distance_to_nearest_pt(self, rooftops, pts, colname):
-      rooftops['centers'] = rooftops.centroid
-      rooftops[colname] = rooftops['centers'].apply(lambda x: min([x.distance(y) for y in pts['geometry']]))
-      rooftops.drop(columns='centers', inplace=True)
-      return rooftops
+   def _point_index(self, path):
+      """Reads and indexes a point layer once per run; shared by every feature
+      that uses it. The read runs outside the processor lock: only threads 
+      asking for the same layer wait for it."""
+
+      with self._lock:
+         fut = self._pt_indexes.get(path)
+         loading = fut is None
+         if loading:
+            fut = self._pt_indexes[path] = Future()
+      if loading:
+         try:
+            pts = self.S3.read_gdf_from_s3(self.main_dir + path).to_crs(self.epsg)
+            fut.set_result(PointIndex(pts.geometry.values))
+         except BaseException as e:
+            # Let a later call try again.
+            with self._lock:
+               self._pt_indexes.pop(path, None)
+            fut.set_exception(e)
+      return fut.result()
+
+   def _distance_to_nearest_pt(self, rooftops, index, k=1):
+      """Distance from each rooftop centroid to the nearest point (or the mean 
+      distance to the k nearest points)"""
+
+      centers = rooftops.centroid
+      xy = np.column_stack([centers.x.values, centers.y.values])
+      return index.nearest(xy, k=k).mean(axis=1)
+
+   def _count_pts_within(self, rooftops, index, radius):
+      """Number of points within radius of each rooftop centroid"""
+
+      centers = rooftops.centroid
+      xy = np.column_stack([centers.x.values, centers.y.values])
+      return index.count_within(xy, radius)
    
-   def feature_closeness_to_pts(self, rooftops, ctp_paths):
+   @feature(kwargs={'ctp_paths': 'ctp_paths', 'ctp_k': 'k', 'ctp_radius': 'radius'})
+   @instrumented()
+   def feature_closeness_to_pts(self, rooftops, ctp_paths, k=1, radius=None):
       """Calculates closeness to a series of points. Used in feature_builder().
       
       Args: 
          ctp_paths (list): list of file names in S3 bucket to use as points. A
             separate feature is created for each file in the ctp_paths variable. 
+         k (int, optional): use the mean distance to the k nearest points instead
+            of the distance to the nearest one. Layers with fewer than k points
+            use all of them. Defaults to 1.
+         radius (float, optional): if set, the feature is the number of points 
+            within radius (map units) of the rooftop instead of a distance, and 
+            the column is named <file>_count. Defaults to None.
       """
+      cols = {}
       for p in ctp_paths:
          colname = p.split('.')[0]
-         self.col_names.append((colname, False))
-         pts = self.S3.read_shp_from_s3_as_gpd(self.main_dir + p).to_crs(self.epsg) 
-         rooftops = self._distance_to_nearest_pt(rooftops, pts, colname)
+         index = self._point_index(p)
+         if radius is None:
+            self._add_col_name(colname, False)
+            cols[colname] = self._distance_to_nearest_pt(rooftops, index, k)
+         else:
+            colname = colname + '_count'
+            self._add_col_name(colname, True)
+            cols[colname] = self._count_pts_within(rooftops, index, radius)
          print('Adding closeness to ' + colname + ' feature now.') 
-      return rooftops   
+      return self._faid_frame(rooftops, **cols)
    
    def _find_interior_holes(self, rooftops):
-      # Find all interior rings within polygon
-      out = []
-      for geom in rooftops['geometry']:
-         interior_coords = []
-         for interior in geom.interiors:
-               interior_coords.append(interior.coords)
-
-         out.append(interior_coords)
-
-      # Convert interiors of each polygon into MultiPolygons so they can each be associated with an FAID.
-      interiors = []
-      for geom in out:
-         interiors.append(MultiPolygon([Polygon(geom[i]) for i, _ in enumerate(geom)]))    
-
-      # Create GDF of interior polygons
-      interiors = pd.DataFrame({'faid': rooftops['faid'], 'geometry': interiors})
-      interiors = gpd.GeoDataFrame(interiors)
-      interiors = interiors.drop_duplicates()
-      
+      """Interior rings (holes) of all rooftops as polygons, extracted in bulk 
+      with the shapely array API. Returns a gdf with the faid of the rooftop 
+      each hole belongs to and a 1-based intid."""
+
+      parts, part_row = shapely.get_parts(rooftops.geometry.values, return_index=True)
+      n_rings = shapely.get_num_interior_rings(parts)
+      n_rings[n_rings < 0] = 0
+      poly = np.repeat(np.arange(len(parts)), n_rings)
+      ring = np.arange(len(poly)) - np.repeat(np.cumsum(n_rings) - n_rings, n_rings)
+      holes = shapely.polygons(shapely.get_interior_ring(parts[poly], ring))
+
+      interiors = gpd.GeoDataFrame({'faid': rooftops['faid'].values[part_row[poly]],
+                                    'intid': np.arange(1, len(holes) + 1)},
+                                   geometry=holes, crs=rooftops.crs)
       return interiors
    
    def _calc_height(self, gdf, colname):
       """Calculates median height of surface"""            
       
-      affine = self.meta['transform']
-      nodata = self.meta['nodata']
-      zstats = rasterstats.zonal_stats(gdf, self.height_arr, affine=affine,
-                                       nodata=nodata, geojson_out=True, 
-                                       stats='median')
-      new_gdf = self._add_zstats_to_gpd(zstats, gdf, 'median', 'intid')
-      new_gdf.rename(columns={'median': colname}, inplace=True)
+      grid = self._label_grid(gdf, 'intid')
+      zstats = grid.zonal_stats({'height': self.height_arr}, stats=['median'],
+                                nodata=self.meta['nodata'])
+      new_gdf = self._join_zstats(gdf, zstats, {'height_median': colname})
       return new_gdf 
    
+   @feature(requires=('height',), after=('height',))
+   @instrumented()
    def feature_volume_on_roof(self, rooftops):
-      """Calculates volume of stuff on top of roof. Used in feature_builder()"""
+      """Calculates volume of stuff on top of roof. Used in feature_builder(), 
+      which computes the height feature first."""
       
       # Check to make sure rooftop height has already been calculated. 
       if 'height' not in rooftops.columns:
          raise ValueError('You must include height as a feature before calculating volume.')
       
       interiors = self._find_interior_holes(rooftops)
-      interiors = self.convert_multipgons_to_pgons(interiors)
-      interiors['intid'] = range(1, len(interiors) + 1)
       int_height = self._calc_height(interiors, 'interior_height')
-      new_gdf = self._calc_volume(rooftops, int_height)
+      volume = self._calc_volume(rooftops, int_height)
+      self._add_col_name('volume', False)
       print('Adding volume on roof feature now.')
-      return new_gdf
+      return self._faid_frame(rooftops, volume=volume)
    
    def _calc_volume(self, rooftops, interiors):
-      """Calculates volume of interior stuff on a roof"""
+      """Volume of interior stuff on each roof (area of each hole times how far
+      it rises above the roof, summed per faid), in rooftops order"""
       
-      interiors['interior_area'] = interiors['geometry'].area 
-      merged = pd.merge(interiors.drop(columns='geometry'), rooftops, on='faid', how='outer')
-      merged['rise'] = merged['interior_height'] - merged['height']
-      merged['rise'] = [0 if x < 0 else x for x in merged['rise']]
-      merged['volume'] = merged['rise'] * merged['interior_area']
-      merged['volume'] = [0 if np.isnan(x) else x for x in merged['volume']]
-      clean = merged[['faid', 'volume', 'geometry']]
-      volume = clean.dissolve(by='faid', aggfunc='sum')
-      volume.drop(columns=['geometry'], inplace=True)
-      updated = pd.merge(rooftops, volume, on='faid')
-
-      self.col_names.append(('volume', False))
-      return updated  
+      height = rooftops.set_index('faid')['height'].reindex(interiors['faid']).values
+      rise = np.maximum(interiors['interior_height'].values - height, 0)
+      volume = np.nan_to_num(rise * shapely.area(interiors.geometry.values))
+      volume = pd.Series(volume).groupby(interiors['faid'].values).sum()
+      return volume.reindex(rooftops['faid'].values, fill_value=0).values
    
    def _create_bldg_buffer_pgon(self):
       """Used in feature_parapet()"""
@@ -359,80 +899,456 @@ class RooftopProc(object):
    
       return parapet
    
-   def feature_parapet(self, rooftops):
+   def _parapet_grid(self, width):
+      """Label grid of the inner edge ring and the interior of every flat 
+      building. A pixel is on the ring if a pixel of another label (or 
+      background) lies within width map units of the building outline, found 
+      with a grey erosion and dilation of the building labels over a disk. Ring
+      pixels of the i-th building get label i and its interior pixels i + n, so
+      one zonal pass covers both."""
+
+      from scipy import ndimage
+      bldgs_grid = self._label_grid(self.flat_bldgs, self.bldgs_id, 'flat_bldgs')
+      with self._lock:
+         cached = self._label_grids.get('parapet_ring')
+         if cached is not None and cached[0][0] is bldgs_grid and cached[0][1] == width:
+            return cached[1]
+
+         # Pixel centres within width of the outline are within width + half a 
+         # pixel of the nearest pixel centre outside the building.
+         radius = width / abs(self.meta['transform'][0]) + 0.5
+         k = int(np.floor(radius))
+         yy, xx = np.mgrid[-k:k + 1, -k:k + 1]
+         disk = yy ** 2 + xx ** 2 <= radius ** 2
+         labels = bldgs_grid.labels
+         ring = (ndimage.grey_erosion(labels, footprint=disk, mode='nearest') != labels) | \
+                (ndimage.grey_dilation(labels, footprint=disk, mode='nearest') != labels)
+         n = len(bldgs_grid.ids)
+         combined = np.where(ring | (labels == 0), labels, labels + n)
+         grid = LabelGrid(combined, np.concatenate([bldgs_grid.ids, bldgs_grid.ids]), 
+                          self.bldgs_id)
+         self._label_grids['parapet_ring'] = ((bldgs_grid, width), grid)
+         return grid
+
+   def _parapet_stats(self, width):
+      """Median slope and height of the edge ring and the interior of every 
+      flat building, from one zonal pass over the ring grid. Cached until the 
+      ring grid or the rasters change.
+
+      Returns:
+         pd.DataFrame: indexed by bldgs_id with ring_slope, ring_height, 
+            interior_slope and interior_height
+      """
+
+      grid = self._parapet_grid(width)
+      arrays = {name: self.rasters[name] for name in ('slope', 'height') if name in self.rasters}
+      key = (grid,) + tuple(arrays.values())
+      with self._lock:
+         cached = self._parapet_cache
+         if cached is not None and len(cached[0]) == len(key) and \
+               all(a is b for a, b in zip(cached[0], key)):
+            return cached[1]
+         zstats = grid.zonal_stats(arrays, stats=['median'], nodata=self.meta['nodata'])
+         n = len(zstats) // 2
+         stats = pd.DataFrame(index=zstats.index[:n])
+         for name in arrays:
+            stats['ring_' + name] = zstats[name + '_median'].values[:n]
+            stats['interior_' + name] = zstats[name + '_median'].values[n:]
+         self._parapet_cache = (key, stats)
+         return stats
+
+   @feature(requires=('slope', 'flat_bldgs'), 
+            kwargs={'parapet_mode': 'mode', 'parapet_width': 'width'})
+   @instrumented()
+   def feature_parapet(self, rooftops, mode='vector', width=1):
       """Calculates the median slope of a one meter buffer around the edge of 
-      of a building (not a rooftop). Used in feature_builder(). """
+      of a building (not a rooftop). Used in feature_builder().
+
+      Args:
+         mode (str, optional): 'vector' builds the ring with a negative buffer
+            and an overlay per building; 'raster' takes it from the building 
+            label grid (much faster, same pixels for grid aligned outlines). 
+            feature_builder() kwarg parapet_mode. Defaults to 'vector'.
+         width (float, optional): ring width in map units (raster mode only). 
+            feature_builder() kwarg parapet_width. Defaults to 1.
+      """
       
-      affine = self.meta['transform']
-      nodata = self.meta['nodata']
-      parapet = self._create_bldg_buffer_pgon()
-      zstats = rasterstats.zonal_stats(parapet, self.slope_arr, affine=affine,
-                                       nodata=nodata, geojson_out=True, 
-                                       stats='median')
-      new_gdf = pd.DataFrame(self.flat_bldgs['fid'])
-      gdf = self._add_zstats_to_gpd(zstats, new_gdf, 'median', 'fid')
-      gdf.rename(columns={'median': 'parapet_slope'}, inplace=True)
-      self.col_names.append(('parapet_slope', True))
-
-      full_gdf = rooftops.merge(gdf, on='fid')
+      if mode == 'raster':
+         ring_slope = self._parapet_stats(width)['ring_slope']
+         values = rooftops[self.bldgs_id].map(ring_slope).values
+      elif mode == 'vector':
+         parapet = self._create_bldg_buffer_pgon()
+         grid = self._label_grid(parapet, 'fid', 'parapet')
+         zstats = grid.zonal_stats({'slope': self.slope_arr}, stats=['median'],
+                                   nodata=self.meta['nodata'])
+         values = rooftops['fid'].map(zstats['slope_median']).values
+      else:
+         raise ValueError("mode must be 'vector' or 'raster'.")
+      self._add_col_name('parapet_slope', True)
       
       print('Adding parapet feature now.')   
-      return full_gdf   
+      return self._faid_frame(rooftops, parapet_slope=values)
+
+   @feature(requires=('height', 'flat_bldgs'), kwargs={'parapet_width': 'width'})
+   @instrumented()
+   def feature_parapet_height(self, rooftops, width=1):
+      """Calculates how far the edge ring of a building rises above its 
+      interior (median ring height minus median interior height), as in the v2
+      R script. Used in feature_builder().
+
+      Args:
+         width (float, optional): ring width in map units. feature_builder() 
+            kwarg parapet_width. Defaults to 1.
+      """
 
-   def feature_builder(self, rooftops, features, **kwargs):
-      """Main function to build features"""
+      stats = self._parapet_stats(width)
+      parapet_height = stats['ring_height'] - stats['interior_height']
+      self._add_col_name('parapet_height', False)
+
+      print('Adding parapet height feature now.')
+      return self._faid_frame(rooftops, 
+                              parapet_height=rooftops[self.bldgs_id].map(parapet_height).values)
+
+   def _scene_lonlat(self):
+      """Longitude and latitude of the centre of the whole DSM (not the 
+      window), so the domains of a city share the same sun positions"""
+
+      from pyproj import Transformer
+
+      src = self.dsm_rio
+      x, y = src.transform * (src.width / 2, src.height / 2)
+      to_wgs84 = Transformer.from_crs(self.epsg, 'EPSG:4326', always_xy=True)
+      return to_wgs84.transform(x, y)
+
+   def _scene_offset(self):
+      """(row, col) of self.window in the whole DSM"""
+      if self.window is None:
+         return 0, 0
+      return int(self.window.row_off), int(self.window.col_off)
+
+   def _dsm_tile(self, win):
+      """float32 DSM of a window relative to self.window that may reach past it
+      into the rest of the DSM, with NaN for nodata"""
+
+      inside = win.row_off >= 0 and win.col_off >= 0 and \
+         win.row_off + win.height <= self.meta['height'] and \
+         win.col_off + win.width <= self.meta['width']
+      if 'dsm' in self.rasters and inside:
+         arr = np.array(self.rasters['dsm'][win.toslices()], dtype='float32')
+      else:
+         arr = self._read_band(self.dsm_rio, win).astype('float32')
+      if self.meta['nodata'] is not None:
+         arr[arr == self.meta['nodata']] = np.nan
+      return arr
+
+   def _load_dsm_blocks(self):
+      row_off, col_off = self._scene_offset()
+      height, width = self.dsm_rio.height, self.dsm_rio.width
+      shape = (-(-height // SUN_BLOCK), -(-width // SUN_BLOCK))
+      lo = np.full(shape, np.inf, dtype='float32')
+      hi = np.full(shape, -np.inf, dtype='float32')
+      for _, win, _ in iter_blocks(height, width, 16 * SUN_BLOCK):
+         block = self._dsm_tile(Window(win.col_off - col_off, win.row_off - row_off,
+                                       win.width, win.height))
+         block = np.pad(block, ((0, -block.shape[0] % SUN_BLOCK), 
+                                (0, -block.shape[1] % SUN_BLOCK)), constant_values=np.nan)
+         block = block.reshape(block.shape[0] // SUN_BLOCK, SUN_BLOCK, 
+                               block.shape[1] // SUN_BLOCK, SUN_BLOCK)
+         nan = np.isnan(block)
+         r, c = win.row_off // SUN_BLOCK, win.col_off // SUN_BLOCK
+         out = (slice(r, r + block.shape[0]), slice(c, c + block.shape[2]))
+         lo[out] = np.where(nan, np.inf, block).min(axis=(1, 3))
+         hi[out] = np.where(nan, -np.inf, block).max(axis=(1, 3))
+      return lo, hi
+
+   @property
+   def dsm_blocks(self):
+      """(min, max) arrays of the whole DSM (not the window) in SUN_BLOCK 
+      pixel blocks, ignoring nodata (inf and -inf for blocks without data). 
+      They bound how far shadows can reach, see _caster_window()."""
+      return self._lazy('dsm_blocks', self._load_dsm_blocks)
+
+   @dsm_blocks.setter
+   def dsm_blocks(self, lo_hi):
+      self._inputs['dsm_blocks'] = lo_hi
+
+   def _block_stat(self, win, highest):
+      """Highest (or lowest) DSM block value covering a window of the whole
+      DSM, -inf (or inf) if there is none"""
+
+      arr = self.dsm_blocks[1 if highest else 0]
+      sub = arr[max(win.row_off, 0) // SUN_BLOCK:-(-(win.row_off + win.height) // SUN_BLOCK),
+                max(win.col_off, 0) // SUN_BLOCK:-(-(win.col_off + win.width) // SUN_BLOCK)]
+      if not sub.size:
+         return -np.inf if highest else np.inf
+      return float(sub.max() if highest else sub.min())
+
+   def _caster_window(self, win, azimuth, elevation, px, lowest):
+      """Window of the whole DSM holding a tile (win, of the whole DSM) and 
+      every pixel that can shade it for one sun position, see 
+      sun.caster_reach(). A caster rises at most as high as the highest DSM 
+      block in reach above the lowest block under the tile (lowest); the reach
+      is bounded with the highest block of the whole DSM first, then with the 
+      highest block in that first window. So a tile far from hills and towers
+      only reads its own strip of neighbours towards the sun."""
+
+      def grow(rise):
+         top, bottom, left, right = caster_reach(azimuth, elevation, px, rise)
+         r0, c0 = max(win.row_off - top, 0), max(win.col_off - left, 0)
+         r1 = min(win.row_off + win.height + bottom, self.dsm_rio.height)
+         c1 = min(win.col_off + win.width + right, self.dsm_rio.width)
+         return Window(c0, r0, c1 - c0, r1 - r0)
+
+      first = grow(float(self.dsm_blocks[1].max()) - lowest)
+      return grow(self._block_stat(first, True) - lowest)
+
+   def _sun_positions(self, dates=DEFAULT_DATES, step=60, min_elevation=5):
+      """Sun positions of feature_sun_exposure() at the scene centre"""
+
+      lon, lat = self._scene_lonlat()
+      return sun_positions(lat, lon, dates, step, min_elevation)
+
+   def _sun_reach(self, bounds, dates=DEFAULT_DATES, step=60, min_elevation=5):
+      """Distance in map units over which the DSM inside bounds (minx, miny, 
+      maxx, maxy) can cast a shadow at the lowest sun of feature_sun_exposure():
+      how far its highest block rises above the lowest block around it (found 
+      with the lowest block of the whole DSM first). A change of the DSM 
+      inside bounds can change sun_hours this far away."""
+
+      positions = self._sun_positions(dates, step, min_elevation)
+      region = self._bounds_window(bounds, 0)
+      top = self._block_stat(region, True)
+      if not len(positions) or top == -np.inf:
+         return 0.0
+      tan = np.tan(np.radians(positions['elevation'].min()))
+      px = self.meta['transform'][0]
+      pad = int(np.ceil(max(top - float(self.dsm_blocks[0].min()), 0) / tan / px)) + 1
+      around = Window(region.col_off - pad, region.row_off - pad, 
+                      region.width + 2 * pad, region.height + 2 * pad)
+      return max(top - self._block_stat(around, False), 0) / tan
+
+   def _sun_hours(self, dsm_arr, read_win, win, windows, positions, px, max_threads=None):
+      """Hours of direct sun per pixel of the tile win, summed over the sun 
+      positions: one sweep per position over its caster window (see 
+      _caster_window()), in a thread pool. dsm_arr is the DSM of read_win, 
+      which holds all caster windows; all windows are of the whole DSM. NaN 
+      where the DSM is nodata."""
+
+      def part(arr, outer, inner):
+         r, c = inner.row_off - outer.row_off, inner.col_off - outer.col_off
+         return arr[r:r + inner.height, c:c + inner.width]
+
+      def lit_hours(pos_win):
+         pos, cw = pos_win
+         # Relative to the whole DSM, so tiles and domains round the sun 
+         # lines alike.
+         lit = sunlit(part(dsm_arr, read_win, cw), pos.azimuth, pos.elevation, px, 
+                      (cw.row_off, cw.col_off))
+         return part(lit, cw, win) * np.float32(pos.hours)
+
+      hours = np.zeros((win.height, win.width), dtype='float32')
+      with ThreadPoolExecutor(max_workers=max_threads or SUN_THREADS) as pool:
+         for lit in pool.map(lit_hours, zip(positions.itertuples(), windows)):
+            hours += lit
+      hours[np.isnan(part(dsm_arr, read_win, win))] = np.nan
+      return hours
+
+   @feature(kwargs={'sun_dates': 'dates', 'sun_step': 'step', 
+                    'sun_min_elevation': 'min_elevation', 'sun_tile_size': 'tile_size',
+                    'sun_threads': 'max_threads'})
+   @instrumented()
+   def feature_sun_exposure(self, rooftops, dates=DEFAULT_DATES, step=60, min_elevation=5,
+                            tile_size=1024, max_threads=None):
+      """Calculates the mean daily hours of direct sun on a rooftop, shaded by 
+      the DSM (neighbouring buildings, trees and objects on the roof). Sun 
+      positions over the given dates come from sun_positions() at the scene 
+      centre; every position is one horizon sweep (see sun.sunlit()) over a 
+      tile of the DSM and the strip towards the sun that can shade it (see 
+      _caster_window()), which may reach past the window into the rest of the 
+      DSM. So the result depends neither on tile_size nor on the domains, and
+      only tiles with rooftops are processed. Used in feature_builder().
+
+      Args:
+         dates (list, optional): days to average over. feature_builder() kwarg 
+            sun_dates. Defaults to the solstices and an equinox of 2021.
+         step (float, optional): minutes between sun positions. 
+            feature_builder() kwarg sun_step. Defaults to 60.
+         min_elevation (float, optional): suns lower than this (degrees) are 
+            ignored. feature_builder() kwarg sun_min_elevation. Defaults to 5.
+         tile_size (int, optional): tile side in pixels, excluding the strips.
+            feature_builder() kwarg sun_tile_size. Defaults to 1024.
+         max_threads (int, optional): threads per tile (one sun position each,
+            every thread holds a float64 copy of its strip). feature_builder() 
+            kwarg sun_threads. Defaults to SUN_THREADS.
+      """
+
+      positions = self._sun_positions(dates, step, min_elevation)
+      shape = (self.meta['height'], self.meta['width'])
+      nodata = self.meta['nodata']
+      px = self.meta['transform'][0]
+
+      grid = self._label_grid(rooftops, 'faid')
+      hours = self.rasters.empty('sun_hours', shape, 'float32')
+      hours[...] = np.nan
+      row_off, col_off = self._scene_offset()
+      for _, win, _ in iter_blocks(shape[0], shape[1], tile_size):
+         if not grid.labels[win.toslices()].any():
+            continue
+         tile = Window(win.col_off + col_off, win.row_off + row_off, win.width, win.height)
+         lowest = self._block_stat(tile, False)
+         windows = [self._caster_window(tile, pos.azimuth, pos.elevation, px, lowest)
+                    for pos in positions.itertuples()]
+         r0 = min([w.row_off for w in windows], default=tile.row_off)
+         c0 = min([w.col_off for w in windows], default=tile.col_off)
+         r1 = max([w.row_off + w.height for w in windows], default=tile.row_off + tile.height)
+         c1 = max([w.col_off + w.width for w in windows], default=tile.col_off + tile.width)
+         read_win = Window(c0, r0, c1 - c0, r1 - r0)
+         dsm_arr = self._dsm_tile(Window(c0 - col_off, r0 - row_off, c1 - c0, r1 - r0))
+         hours[win.toslices()] = self._sun_hours(dsm_arr, read_win, tile, windows, 
+                                                 positions, px, max_threads)
+
+      zstats = grid.zonal_stats({'sun_hours': hours}, stats=['mean'], nodata=nodata)
+      self.rasters.release('sun_hours')
+      self._add_col_name('sun_hours', False)
+
+      print('Adding sun exposure feature now.')
+      return zstats[['sun_hours_mean']].rename(columns={'sun_hours_mean': 'sun_hours'})
+
+   def _has_input(self, name):
+      """Whether a feature input ('slope', 'height' or 'flat_bldgs') exists"""
+
+      if name == 'flat_bldgs':
+         return hasattr(self, 'flat_bldgs')
+      return name in self.rasters
+
+   @instrumented()
+   def feature_builder(self, rooftops, features, max_threads=None, **kwargs):
+      """Main function to build features. Features a requested feature depends on
+      are added automatically (e.g. height for volume_on_roof). Features that do 
+      not depend on each other run concurrently in a thread pool, and all new 
+      columns are joined onto rooftops at once. Building the same feature again 
+      replaces its column. New criteria are added to col_names in the order of
+      features (see request_order()), which is the order wts apply in.
+
+      Args:
+         rooftops (gdf): flat areas from flat_area_disaggregator()
+         features (list): names of the features to add (feature_<name> methods)
+         max_threads (int, optional): size of the thread pool. Defaults to the 
+            ThreadPoolExecutor default.
+         **kwargs: ctp_paths, ctp_k and ctp_radius for closeness_to_pts; 
+            parapet_mode and parapet_width for parapet and parapet_height; 
+            sun_dates, sun_step, sun_min_elevation, sun_tile_size and 
+            sun_threads for sun_exposure
+
+      Returns:
+         gdf: rooftops with one column per feature
+      """
       
-      for f in features:
-         func = eval('self.feature_' + f)
-         if f == 'closeness_to_pts':
-            if 'ctp_paths' in kwargs.keys():
-               rooftops = func(rooftops, kwargs['ctp_paths'])
-            else:
-               print('Oops, there are no ctp_paths for the closeness_to_pts feature.')
-         else:
-            rooftops = func(rooftops)
-         
+      levels = resolve_features(features)
+      registered = [c[0] for c in self.col_names]
+      for name in (n for level in levels for n in level):
+         missing = [r for r in FEATURES[name].requires if not self._has_input(r)]
+         if missing:
+            raise ValueError('The {} feature needs {}; run {} first.'.format(
+               name, ', '.join(missing), ', '.join(INPUT_STAGES[r] for r in missing)))
+
+      results = {}
+      with ThreadPoolExecutor(max_workers=max_threads) as pool:
+         for level in levels:
+            futures = {}
+            for name in level:
+               spec = FEATURES[name]
+               args = {arg: kwargs[kw] for kw, arg in spec.kwargs.items() if kw in kwargs}
+               if 'ctp_paths' in spec.kwargs and 'ctp_paths' not in args:
+                  print('Oops, there are no ctp_paths for the closeness_to_pts feature.')
+                  continue
+               inputs = rooftops
+               for dep in spec.after:
+                  inputs = inputs.drop(columns=results[dep].columns, errors='ignore')
+                  inputs = inputs.join(results[dep], on='faid')
+               futures[name] = pool.submit(getattr(self, 'feature_' + name), inputs, **args)
+            for name, fut in futures.items():
+               results[name] = fut.result()
+
+      if not results:
+         return rooftops
+      new_cols = pd.concat([results[n] for n in request_order(features) if n in results], 
+                           axis=1)
+      rooftops = rooftops.drop(columns=new_cols.columns, errors='ignore')
+      rooftops = rooftops.join(new_cols, on='faid')
+
+      # Criteria registered before keep their position; new ones follow in 
+      # request order (see request_order()) whatever order the threads 
+      # finished in.
+      invert = dict(self.col_names)
+      added = [c for c in new_cols.columns if c in invert and c not in registered]
+      self.col_names = [(c, invert[c]) for c in registered + added if c in invert]
       return rooftops
 
    @staticmethod
    def rescale(l, invert=False, wts=None):
-      scaler = MinMaxScaler()
-      arr = np.array(l).reshape(-1, 1)
-      arr = arr * -1 if invert else arr
-      scaler.fit(arr)
-      return scaler.transform(arr)
+      arr = np.asarray(l, dtype='float64').reshape(-1, 1)
+      return minmax_scale(arr, [invert])
+
+   def _criteria_matrix(self, full_features):
+      """Criteria of the MCDA: every feature in col_names rescaled to [0, 1] 
+      (inverted where flagged) and ranked, so all criteria are minimized"""
+
+      names = [c[0] for c in self.col_names]
+      scaled = minmax_scale(full_features[names].values, [c[1] for c in self.col_names])
+      return pd.DataFrame(scaled, columns=names).rank(method='min').values
          
-   def index_builder(self, full_features, wts=None):
-      mcda = full_features.copy()
-      geom = mcda['geometry']
+   @instrumented()
+   def index_builder(self, full_features, wts=None, out_fname='main_index.zip'):
+      """Ranks rooftops with TOPSIS over the features in col_names and writes the
+      result to S3
 
-      mcda = mcda.set_index('faid')
-      mcda = mcda[[x[0] for x in self.col_names]]
+      Args:
+         full_features (gdf): rooftops with features from feature_builder()
+         wts (list, optional): one weight per entry in col_names (normalized to 
+            sum to one). Defaults to equal weights.
+         out_fname (str, optional): output file name. Defaults to 'main_index.zip'.
 
-      orig_cols = []
-      tmp_cols = []
-      for cname, inv in self.col_names:
-         orig_cols.append(cname)
-         tmp_cols.append(cname+'_tmp')
-         mcda[cname+'_tmp'] = self.rescale(mcda[cname], inv)
+      Returns:
+         gdf: features, vulnerability (TOPSIS closeness) and vul_rank (1 = best)
+            indexed by faid
+      """
+
+      names = [c[0] for c in self.col_names]
+      closeness, rank = topsis(self._criteria_matrix(full_features), wts)
 
+      mcda = full_features[names].set_axis(pd.Index(full_features['faid'].values, 
+                                                    name='faid'))
+      mcda['vulnerability'] = closeness[:, 0]
+      mcda['vul_rank'] = rank[:, 0]
+      mcda = gpd.GeoDataFrame(mcda, geometry=full_features.geometry.values, 
+                              crs=full_features.crs)
+      self.S3.write_gdf_to_s3(mcda, self.main_dir + out_fname)
 
-      mcda_tmp = mcda[tmp_cols].rank(method='min')
-      crit = [MIN] * len(mcda_tmp.columns)
+      return mcda
 
-      if not wts:
-         wts = [1/len(mcda_tmp.columns)] * len(mcda_tmp.columns)
+   @instrumented()
+   def index_scenarios(self, full_features, scenarios):
+      """Runs the index_builder() MCDA for many weight vectors at once. The 
+      criteria matrix is built once and all scenarios are scored in one batched 
+      TOPSIS; nothing is written to S3.
 
-      mca_data = Data(mcda_tmp.values, crit, anames=mcda_tmp.index, cnames=mcda_tmp.columns, weights=wts)
+      Args:
+         full_features (gdf): rooftops with features from feature_builder()
+         scenarios (dict or list): {name: weights} or a list of weight vectors, 
+            each with one weight per entry in col_names
 
-      dm = closeness.TOPSIS()
-      dec = dm.decide(mca_data)
+      Returns:
+         tuple: (closeness, rank) DataFrames indexed by faid with one column per
+            scenario
+      """
 
-      mcda['vulnerability'] = dec.e_.closeness
-      mcda['vul_rank'] = dec.rank_
-      mcda['geometry'] = geom
-      mcda = mcda.drop(columns=tmp_cols)
-      mcda = gpd.GeoDataFrame(mcda) if not isinstance(mcda, gpd.GeoDataFrame) else mcda
-      self.S3.write_gdf_to_s3(mcda, self.main_dir + 'main_index.zip')
+      if isinstance(scenarios, dict):
+         labels, weights = list(scenarios), list(scenarios.values())
+      else:
+         labels, weights = list(range(len(scenarios))), scenarios
+      closeness, rank = topsis(self._criteria_matrix(full_features), weights)
 
-      return mcda
\ No newline at end of file
+      index = pd.Index(full_features['faid'].values, name='faid')
+      return (pd.DataFrame(closeness, index=index, columns=labels),
+              pd.DataFrame(rank, index=index, columns=labels))
@@ -1,5 +1,4 @@
 #%%
-import boto3
 from pathlib import Path
 import rasterio
 import fiona
@@ -10,13 +9,45 @@ import zipfile
 from io import BytesIO
 import os
 import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait as wait_all
+from urllib.parse import urlparse
+from rasterio.io import MemoryFile
+from rasterio.enums import Resampling
+import rasterio.shutil
 from fiona.io import ZipMemoryFile
 from io import BytesIO
 import zipfile
+from .cache import LocalCache
 
 #%%
-s3_res = boto3.resource('s3')
-s3_client = s3_res.meta.client
+# boto3 is imported and the default resource created on first use (see 
+# _default_resource()); importing this module stays cheap.
+_default = {}
+_default_lock = threading.Lock()
+
+# Vector formats by file extension
+GDF_FORMATS = {'zip': 'ESRI Shapefile', 'parquet': 'GeoParquet', 'fgb': 'FlatGeobuf'}
+
+# Block size of COG outputs; also the size below which no more overviews are built.
+COG_BLOCKSIZE = 512
+
+# Self-contained formats (overviews and index inside the file) for which GDAL
+# is told not to probe for sidecar files (.ovr, .aux.xml, ...) over /vsis3.
+SINGLE_FILE_EXTENSIONS = ('.tif', '.tiff', '.fgb')
+
+
+def _default_resource():
+    """boto3 S3 resource for AWS shared by every helper without an endpoint_url,
+    created on first use"""
+    with _default_lock:
+        if 'resource' not in _default:
+            import boto3
+            _default['resource'] = boto3.resource('s3')
+        return _default['resource']
+
 
 # %%
 class S3Helper(object):
@@ -25,10 +56,226 @@ class S3Helper(object):
     Class with helper functions to read and process data in S3
     """
 
-    def __init__(self, bucket):
+    def __init__(self, bucket, cache_dir=None, cache_size=10 * 2**30, 
+                 max_concurrency=10, multipart_chunksize=8 * 2**20, background=False,
+                 endpoint_url=None):
+        """
+        Args:
+            bucket (str): name of the S3 bucket
+            cache_dir (str, optional): local directory for caching reads. Objects
+                whose ETag has not changed are then served from disk. Defaults to
+                None (no cache).
+            cache_size (int, optional): cache size cap in bytes. Least recently 
+                used objects are evicted beyond it. Defaults to 10 GiB.
+            max_concurrency (int, optional): threads per multipart upload. 
+                Defaults to 10.
+            multipart_chunksize (int, optional): part size (and threshold) for 
+                multipart uploads in bytes. Defaults to 8 MiB.
+            background (bool, optional): if True, writes return as soon as the 
+                object is serialized and the upload runs in a background thread.
+                Call wait() before relying on the objects. Defaults to False.
+            endpoint_url (str, optional): alternative S3 endpoint, e.g. a local 
+                S3 stand-in for testing. Defaults to None (AWS).
+        """
         self.bucket = bucket
-        self.resource = s3_res 
-        self.client = s3_client
+        self.endpoint_url = endpoint_url
+        self.background = background
+        self.max_concurrency = max_concurrency
+        self.multipart_chunksize = multipart_chunksize
+        self.cache = LocalCache(cache_dir, cache_size) if cache_dir else None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._set_clients()
+
+    def _set_clients(self):
+        # The boto3 resource, client and transfer config are created on first 
+        # use (see the properties below).
+        self._resource = None
+        self._transfer_config = None
+        self._client_lock = threading.Lock()
+        self._uploader = None
+        self._pending = []
+        self._upload_lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+
+    @property
+    def resource(self):
+        with self._client_lock:
+            if self._resource is None:
+                if self.endpoint_url:
+                    import boto3
+                    self._resource = boto3.resource('s3', endpoint_url=self.endpoint_url)
+                else:
+                    self._resource = _default_resource()
+            return self._resource
+
+    @property
+    def client(self):
+        return self.resource.meta.client
+
+    @property
+    def transfer_config(self):
+        with self._client_lock:
+            if self._transfer_config is None:
+                from boto3.s3.transfer import TransferConfig
+                self._transfer_config = TransferConfig(
+                    max_concurrency=self.max_concurrency,
+                    multipart_threshold=self.multipart_chunksize,
+                    multipart_chunksize=self.multipart_chunksize)
+            return self._transfer_config
+
+    def __getstate__(self):
+        # boto3 objects and the upload pool can't be pickled; drop them so the 
+        # helper can be sent to worker processes.
+        state = self.__dict__.copy()
+        for k in ('_resource', '_transfer_config', '_client_lock', '_uploader', '_pending',
+                  '_upload_lock', '_counter_lock'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_clients()
+
+    @staticmethod
+    def _boto3_session():
+        import boto3
+        return boto3.Session()
+
+    def _gdal_env(self, path=None):
+        """GDAL config options for /vsis3 reads of path. Windowed reads of a 
+        tiled (e.g. COG) object then only fetch the blocks they need with HTTP 
+        range requests, without listing the prefix first. Only paths with an
+        extension in SINGLE_FILE_EXTENSIONS skip the sidecar probes; other 
+        formats (.vrt, .jp2, .gpkg, ...) can still open the files they need."""
+        env = {'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+               'VSI_CACHE': 'TRUE'}
+        ext = os.path.splitext(path or '')[1].lower()
+        if ext in SINGLE_FILE_EXTENSIONS:
+            env['CPL_VSIL_CURL_ALLOWED_EXTENSIONS'] = ext
+        if self.endpoint_url:
+            url = urlparse(self.endpoint_url)
+            env.update({'AWS_S3_ENDPOINT': url.netloc, 
+                        'AWS_HTTPS': 'YES' if url.scheme == 'https' else 'NO',
+                        'AWS_VIRTUAL_HOSTING': 'FALSE'})
+        return env
+
+    @staticmethod
+    def _cog_profile(meta):
+        """Creation options for a tiled, compressed geotiff"""
+        profile = dict(meta, driver='GTiff', tiled=True, blockxsize=COG_BLOCKSIZE, 
+                       blockysize=COG_BLOCKSIZE, compress='deflate', 
+                       predictor=3 if np.dtype(meta['dtype']).kind == 'f' else 2)
+        return profile
+
+    @staticmethod
+    def _write_cog(src_path, dst_path):
+        """Adds overviews to a tiled geotiff and copies it to a Cloud-Optimized 
+        GeoTIFF (overviews and IFDs ahead of the image data)."""
+        with rasterio.open(src_path, 'r+') as src:
+            factors = []
+            size = max(src.width, src.height)
+            while size > COG_BLOCKSIZE:
+                size //= 2
+                factors.append(2 ** (len(factors) + 1))
+            if factors:
+                src.build_overviews(factors, Resampling.average)
+            profile = S3Helper._cog_profile(src.meta)
+
+        profile.pop('driver')
+        rasterio.shutil.copy(src_path, dst_path, driver='GTiff', 
+                             copy_src_overviews=True, **profile)
+
+    def _counter(self, attr):
+        """boto3 transfer callback adding the transferred bytes to attr"""
+        def add(n):
+            with self._counter_lock:
+                setattr(self, attr, getattr(self, attr) + n)
+        return add
+
+    def transfer_stats(self):
+        """Bytes moved through boto3 (uploads, downloads and cache fetches) by 
+        this helper. Range reads made by GDAL (/vsis3) and Arrow are not 
+        included."""
+        return {'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written}
+
+    def _upload(self, body, path, cleanup=None):
+        """Uploads a file-like object or local file with a managed (multipart, 
+        multi-threaded) transfer. In background mode the upload is queued and 
+        this returns immediately.
+
+        Args:
+            body (BytesIO or str): in-memory buffer or local file path
+            path (str): S3 key
+            cleanup (callable, optional): called once the upload has finished
+        """
+        def upload():
+            try:
+                if isinstance(body, str):
+                    self.client.upload_file(body, self.bucket, path, 
+                                            Config=self.transfer_config,
+                                            Callback=self._counter('bytes_written'))
+                else:
+                    body.seek(0)
+                    self.client.upload_fileobj(body, self.bucket, path, 
+                                               Config=self.transfer_config,
+                                               Callback=self._counter('bytes_written'))
+            finally:
+                if cleanup:
+                    cleanup()
+            print(path.split("/")[-1] + " has been successfully written to your S3 bucket.")
+
+        if not self.background:
+            upload()
+            return None
+
+        # Feature threads write concurrently; all of them must share one pool
+        # so wait() sees every upload.
+        with self._upload_lock:
+            if self._uploader is None:
+                self._uploader = ThreadPoolExecutor(max_workers=4)
+            future = self._uploader.submit(upload)
+            self._pending.append(future)
+        return future
+
+    def wait(self):
+        """Blocks until all background uploads are done, including those queued
+        while waiting. Raises the first upload error, if any."""
+        while True:
+            with self._upload_lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            # Let every upload finish before raising the first error.
+            wait_all(pending)
+            for f in pending:
+                f.result()
+
+    def _cached_path(self, path):
+        """Returns the local cached copy of an S3 object, downloading it if the 
+        object is new or its ETag changed"""
+        etag = self.client.head_object(Bucket=self.bucket, Key=path)['ETag']
+        fetch = lambda f: self.client.download_fileobj(Bucket=self.bucket, Key=path, Fileobj=f,
+                                                       Callback=self._counter('bytes_read'))
+        return self.cache.get(self.bucket, path, etag, fetch)
+
+    def cache_stats(self):
+        """Returns hit/miss statistics of the local read cache"""
+        return self.cache.stats() if self.cache else {}
+
+    def read_bytes(self, path):
+        """Returns the contents of an S3 object. With a cache the bytes are 
+        memory-mapped from the local copy.
+
+        Args:
+            path (str): path to object
+        """
+        if self.cache:
+            return self.cache.open_mmap(self._cached_path(path))
+        bytes_buffer = BytesIO()
+        self.client.download_fileobj(Bucket=self.bucket, Key=path, Fileobj=bytes_buffer,
+                                     Callback=self._counter('bytes_read'))
+        return bytes_buffer.getvalue()
 
     def list_folders(self, path):
         """Returns list all folders in prefix"""
@@ -58,88 +305,188 @@ class S3Helper(object):
             zip_path (str): S3 path to zipfile (e.g. 'missoula/geospatial/first_interstate_bldg.zip')
         """
         
-        bytes_buffer = BytesIO()
-        s3_client.download_fileobj(Bucket=self.bucket, Key=zip_path, Fileobj=bytes_buffer)
-        zipshape = zipfile.ZipFile(bytes_buffer)
+        zipshape = zipfile.ZipFile(BytesIO(self.read_bytes(zip_path)))
         shpnames = [f for f in zipshape.namelist() if '.shp' == f[-4:] and '__MACOSX' not in f]
         dbfnames = [f for f in zipshape.namelist() if '.dbf' == f[-4:] and '__MACOSX' not in f]
         shxnames = [f for f in zipshape.namelist() if '.shx' == f[-4:] and '__MACOSX' not in f]
         return shpnames[0], shxnames[0], dbfnames[0]
     
-    def read_shp_from_s3_as_gpd(self, path):
+    def read_shp_from_s3_as_gpd(self, path, bbox=None):
         """Gets zipped shapefile from S3 bucket and returns as Geopandas DF
 
         Args:
             path (str): path to zipped shapefile
+            bbox (tuple, optional): (minx, miny, maxx, maxy) in the layer CRS; only
+                features intersecting it are returned. Defaults to None.
         """
+        if self.cache:
+            return gpd.read_file('zip://' + self._cached_path(path), bbox=bbox)
+        if self.endpoint_url:
+            return gpd.read_file(BytesIO(self.read_bytes(path)), bbox=bbox)
         full_path = 'zip+s3://' + self.bucket + '/' + path
-        with fiona.Env(session=AWSSession(boto3.Session())):
-            gdf = gpd.read_file(full_path)
+        with fiona.Env(session=AWSSession(self._boto3_session())):
+            gdf = gpd.read_file(full_path, bbox=bbox)
         return gdf
+
+    @staticmethod
+    def _gdf_format(path):
+        ext = path.rsplit('.', 1)[-1].lower()
+        if ext not in GDF_FORMATS:
+            raise ValueError('Unsupported vector format .{}; use one of {}.'.format(
+                ext, ', '.join('.' + e for e in GDF_FORMATS)))
+        return ext
+
+    def read_gdf_from_s3(self, path, bbox=None, columns=None):
+        """Reads a vector layer from S3; the format is picked from the extension
+        (.zip shapefile, .parquet GeoParquet or .fgb FlatGeobuf). With bbox, 
+        GeoParquet skips row groups by their bbox statistics and FlatGeobuf uses
+        its packed R-tree, so only the matching features are downloaded.
+
+        Args:
+            path (str): path to the layer
+            bbox (tuple, optional): (minx, miny, maxx, maxy) in the layer CRS; only
+                features intersecting it are returned. Defaults to None.
+            columns (list, optional): GeoParquet columns to read. Defaults to None
+                (all).
+        """
+        fmt = self._gdf_format(path)
+        if fmt == 'zip':
+            return self.read_shp_from_s3_as_gpd(path, bbox=bbox)
+
+        if fmt == 'parquet':
+            if self.cache:
+                return gpd.read_parquet(self._cached_path(path), bbox=bbox, columns=columns)
+            from pyarrow import fs as pafs
+
+            if self.endpoint_url:
+                url = urlparse(self.endpoint_url)
+                filesystem = pafs.S3FileSystem(endpoint_override=url.netloc, 
+                                               scheme=url.scheme)
+            else:
+                filesystem = pafs.S3FileSystem()
+            return gpd.read_parquet(self.bucket + '/' + path, bbox=bbox, columns=columns,
+                                    filesystem=filesystem)
+
+        if self.cache:
+            full_path = self._cached_path(path)
+        else:
+            full_path = '/vsis3/' + self.bucket + '/' + path
+        with fiona.Env(session=AWSSession(self._boto3_session()), **self._gdal_env(path)):
+            return gpd.read_file(full_path, bbox=bbox, engine='fiona')
     
     def read_tif_from_s3_as_rio(self, path, s3=True):
         """Gets geotiff from s3 bucket and returns as rasterio object
 
+        Without a cache the object is read through GDAL's /vsis3, so windowed
+        reads of a tiled geotiff only download the blocks they touch.
+
         Args:
             path (str): path to geotiff
             s3 (bool): set as True if file is in s3
         """
-        if s3:
+        if s3 and self.cache:
+            full_path = self._cached_path(path)
+        elif s3:
             full_path = 's3://' + self.bucket + '/' + path
         else:
             full_path = path
-        return rasterio.open(full_path)
+        with rasterio.Env(**self._gdal_env(path)):
+            return rasterio.open(full_path)
         
-    def write_gdf_to_s3(self, gdf, path):
-        """Writes geopandas dataframe to S3 as a zipped shapefile
+    def write_gdf_to_s3(self, gdf, path, row_group_size=50000):
+        """Writes geopandas dataframe to S3. The format is picked from the 
+        extension:
+
+        - .zip: zipped ESRI shapefile
+        - .parquet: GeoParquet, rows sorted along a Hilbert curve and written with
+          a bbox covering column, so bbox reads can skip whole row groups
+        - .fgb: FlatGeobuf with its packed Hilbert R-tree
+
         Args:
             gdf (gdf): Geopandas DataFrame to be written S3 bucket
             path (str): full path including filename (e.g. missoula/geospatial/test.zip)
+            row_group_size (int, optional): GeoParquet rows per row group. 
+                Defaults to 50000.
         """
-        tempdir = 'temp/'
+        fmt = self._gdf_format(path)
         fname = path.split("/")[-1].split('.')[0]
-        ftype = path.split('.')[-1]
         
-        if not os.path.isdir(tempdir):
-            os.mkdir(tempdir)
-
-        gdf.to_file(filename=tempdir + fname, driver='ESRI Shapefile')
-        shutil.make_archive(tempdir + fname, ftype, tempdir + fname)
-        s3_res.Bucket('roof-index').put_object(
-            Key=path,
-            Body=open(tempdir + fname + '.' + ftype, 'rb')
-        )
-        print(fname + '.' + ftype + " has been successfully written to your S3 bucket.")
-        shutil.rmtree(tempdir)
-
-    def write_raster_to_s3(self, arr, path, meta):
+        buf = BytesIO()
+        if fmt == 'parquet':
+            if len(gdf):
+                order = np.argsort(gdf.hilbert_distance().values, kind='stable')
+                gdf = gdf.iloc[order]
+            gdf.to_parquet(buf, write_covering_bbox=True, row_group_size=row_group_size)
+        elif fmt == 'fgb':
+            with tempfile.TemporaryDirectory() as tempdir:
+                local = os.path.join(tempdir, fname + '.fgb')
+                gdf.to_file(local, driver='FlatGeobuf', SPATIAL_INDEX='YES')
+                with open(local, 'rb') as f:
+                    buf.write(f.read())
+        else:
+            with tempfile.TemporaryDirectory() as tempdir:
+                gdf.to_file(filename=os.path.join(tempdir, fname), driver='ESRI Shapefile')
+                with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+                    for f in sorted(os.listdir(os.path.join(tempdir, fname))):
+                        z.write(os.path.join(tempdir, fname, f), f)
+
+        return self._upload(buf, path)
+
+    def write_raster_to_s3(self, arr, path, meta, cog=False):
         """Writes numpy array to S3 as a geotiff
 
         Args:
             arr (arr): numpy array
             path (str): full path including filename (e.g. missoula/geospatial/test.tiff)
             meta (dict): meta data for geotiff creation
+            cog (bool, optional): write a tiled, deflate compressed Cloud-Optimized 
+                GeoTIFF with overviews. Defaults to False.
         """
 
-        tempdir = 'temp/'
-        fname = path.split("/")[-1]
-        
         # Expand dimentions of array
         arr = np.expand_dims(arr, axis=0)
         
-        if not os.path.isdir(tempdir):
-            os.mkdir(tempdir)
+        with MemoryFile() as mem:
+            with mem.open(**(self._cog_profile(meta) if cog else meta)) as f:
+                f.write(arr)
+            if cog:
+                with MemoryFile() as cog_mem:
+                    self._write_cog(mem.name, cog_mem.name)
+                    buf = BytesIO(cog_mem.read())
+            else:
+                buf = BytesIO(mem.read())
 
-        with rasterio.open(tempdir + fname, 'w', **meta) as f:
-            f.write(arr)
+        return self._upload(buf, path)
 
-        s3_res.Bucket(self.bucket).put_object(
-            Key=path,
-            Body=open(tempdir + fname, 'rb')
-        )
-        
-        print(fname + " has been successfully written to your S3 bucket.")
-        shutil.rmtree(tempdir)
+    @contextmanager
+    def open_raster_writer(self, path, meta, cog=False):
+        """Opens a local geotiff for block-by-block writing and uploads it to S3
+        when the context exits. Use instead of write_raster_to_s3 when the full 
+        array does not fit in memory.
+
+        Args:
+            path (str): full path including filename (e.g. missoula/geospatial/test.tiff)
+            meta (dict): meta data for geotiff creation
+            cog (bool, optional): upload as a Cloud-Optimized GeoTIFF with 
+                overviews. Defaults to False.
+
+        Yields:
+            rasterio.io.DatasetWriter: open dataset to write windows into
+        """
+        tempdir = tempfile.mkdtemp(prefix='rooftop_')
+        local = os.path.join(tempdir, path.split("/")[-1])
+        try:
+            with rasterio.open(local, 'w', **(self._cog_profile(meta) if cog else meta)) as dst:
+                yield dst
+            if cog:
+                cog_local = os.path.join(tempdir, 'cog_' + path.split("/")[-1])
+                self._write_cog(local, cog_local)
+                os.replace(cog_local, local)
+        except BaseException:
+            shutil.rmtree(tempdir)
+            raise
+
+        self._upload(local, path, cleanup=lambda: shutil.rmtree(tempdir))
 
 
 # %% TEST shapefile read/write
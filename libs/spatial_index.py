@@ -0,0 +1,74 @@
+import numpy as np
+import shapely
+
+
+class PointIndex(object):
+
+    """
+    Nearest-neighbour index over a layer of target geometries. Point layers are
+    indexed with a KD-tree over their coordinates; any other geometry type falls
+    back to a shapely STRtree so distances are still measured to the geometry
+    itself (e.g. the edge of a park polygon).
+    """
+
+    def __init__(self, geoms):
+        geoms = np.asarray(geoms)
+        geoms = geoms[~(shapely.is_missing(geoms) | shapely.is_empty(geoms))]
+        if len(geoms) == 0:
+            raise ValueError('Cannot index an empty layer.')
+        self.n = len(geoms)
+        if np.all(shapely.get_type_id(geoms) == 0):
+            from scipy.spatial import cKDTree
+            self.kdtree = cKDTree(shapely.get_coordinates(geoms))
+            self.strtree = None
+        else:
+            self.kdtree = None
+            self.geoms = geoms
+            self.strtree = shapely.STRtree(geoms)
+
+    def nearest(self, xy, k=1):
+        """Distances from each query point to its k nearest targets
+
+        Args:
+            xy (np.array): (n, 2) array of query coordinates
+            k (int, optional): number of neighbours, clipped to the size of the
+                layer. Only 1 is supported for non-point layers. Defaults to 1.
+
+        Returns:
+            np.array: (n, min(k, layer size)) array of distances sorted nearest
+                first.
+        """
+        if k < 1:
+            raise ValueError('k must be at least 1.')
+        # cKDTree pads missing neighbours with inf, which would make every mean
+        # distance inf and the criterion NaN once scaled.
+        k = min(k, self.n)
+        if self.kdtree is not None:
+            dist, _ = self.kdtree.query(xy, k=k)
+            return dist.reshape(len(xy), k)
+
+        if k != 1:
+            raise ValueError('k > 1 is only supported for point layers.')
+        pts = shapely.points(xy)
+        (qidx, _), dist = self.strtree.query_nearest(pts, return_distance=True,
+                                                     all_matches=False)
+        out = np.full((len(xy), 1), np.inf)
+        out[qidx, 0] = dist
+        return out
+
+    def count_within(self, xy, radius):
+        """Number of targets within radius of each query point
+
+        Args:
+            xy (np.array): (n, 2) array of query coordinates
+            radius (float): search radius in map units
+
+        Returns:
+            np.array: (n,) integer counts
+        """
+        if self.kdtree is not None:
+            return self.kdtree.query_ball_point(xy, r=radius, return_length=True)
+
+        pts = shapely.points(xy)
+        qidx, _ = self.strtree.query(pts, predicate='dwithin', distance=radius)
+        return np.bincount(qidx, minlength=len(xy))
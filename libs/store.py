@@ -0,0 +1,87 @@
+import os
+import tempfile
+import numpy as np
+
+
+class RasterStore(object):
+
+    """
+    Named full-scene arrays shared by the stages of one RooftopProc run. Input
+    bands are decoded once and kept as float32; arrays can live in memory or in
+    memory-mapped files on local disk, and intermediates can be released as soon
+    as no later stage needs them.
+    """
+
+    def __init__(self, memmap=False):
+        """
+        Args:
+            memmap (bool, optional): back every array with a .npy file in a
+                private temp directory instead of RAM. Defaults to False.
+        """
+        self.memmap = memmap
+        self._arrays = {}
+        self._tempdir = None
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def __getitem__(self, name):
+        try:
+            return self._arrays[name]
+        except KeyError:
+            raise KeyError(name + ' has not been computed yet (or was released).') from None
+
+    def empty(self, name, shape, dtype='float32', memmap=None):
+        """Allocates an uninitialized array under name and returns it
+
+        Args:
+            name (str): array name
+            shape (tuple): array shape
+            dtype (str, optional): array dtype. Defaults to 'float32'.
+            memmap (bool, optional): overrides the store default. Defaults to None.
+        """
+        self.release(name)
+        if self.memmap if memmap is None else memmap:
+            if self._tempdir is None:
+                self._tempdir = tempfile.TemporaryDirectory(prefix='rooftop_')
+            path = os.path.join(self._tempdir.name, name + '.npy')
+            arr = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        else:
+            arr = np.empty(shape, dtype=dtype)
+        self._arrays[name] = arr
+        return arr
+
+    def put(self, name, arr, dtype=None):
+        """Stores arr under name, converting to dtype (without copying when it
+        already matches) and moving it to disk if the store is memory-mapped."""
+        arr = np.asarray(arr)
+        if dtype is not None:
+            arr = arr.astype(dtype, copy=False)
+        if self.memmap and not isinstance(arr, np.memmap):
+            out = self.empty(name, arr.shape, arr.dtype)
+            out[...] = arr
+            return out
+        self.release(name)
+        self._arrays[name] = arr
+        return arr
+
+    def load(self, name, read):
+        """Returns the array under name, decoding it with read() as float32 on
+        first use only"""
+        if name not in self._arrays:
+            self.put(name, read(), dtype='float32')
+        return self._arrays[name]
+
+    def release(self, *names):
+        """Drops arrays (and their backing files) that are no longer needed"""
+        for name in names:
+            arr = self._arrays.pop(name, None)
+            if isinstance(arr, np.memmap):
+                path = arr.filename
+                del arr
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+    def nbytes(self):
+        """Total size of the held arrays in bytes"""
+        return sum(a.nbytes for a in self._arrays.values())
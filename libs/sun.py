@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+
+# Default days for sun exposure: summer solstice, equinox and winter solstice.
+DEFAULT_DATES = ('2021-06-21', '2021-09-22', '2021-12-21')
+
+
+def solar_position(times, lat, lon):
+    """Sun azimuth and elevation (low precision almanac algorithm, about 0.01
+    degree between 1950 and 2050)
+
+    Args:
+        times (array): UTC times (anything np.datetime64 accepts)
+        lat (float): latitude in degrees
+        lon (float): longitude in degrees (east positive)
+
+    Returns:
+        tuple: (azimuth, elevation) arrays in degrees, azimuth clockwise from
+            north
+    """
+    times = np.asarray(times, dtype='datetime64[ns]')
+    d = (times - np.datetime64('2000-01-01T12:00')) / np.timedelta64(1, 'D')
+    g = np.radians(357.529 + 0.98560028 * d)
+    q = 280.459 + 0.98564736 * d
+    ecl_lon = np.radians(q + 1.915 * np.sin(g) + 0.020 * np.sin(2 * g))
+    obliquity = np.radians(23.439 - 0.00000036 * d)
+    ra = np.arctan2(np.cos(obliquity) * np.sin(ecl_lon), np.cos(ecl_lon))
+    dec = np.arcsin(np.sin(obliquity) * np.sin(ecl_lon))
+    gmst = np.radians((18.697374558 + 24.06570982441908 * d) % 24 * 15)
+    hour_angle = gmst + np.radians(lon) - ra
+    lat = np.radians(lat)
+    elevation = np.arcsin(np.sin(lat) * np.sin(dec) +
+                          np.cos(lat) * np.cos(dec) * np.cos(hour_angle))
+    azimuth = np.arctan2(-np.sin(hour_angle),
+                         np.tan(dec) * np.cos(lat) - np.sin(lat) * np.cos(hour_angle))
+    return np.degrees(azimuth) % 360, np.degrees(elevation)
+
+
+def sun_positions(lat, lon, dates=DEFAULT_DATES, step=60, min_elevation=5):
+    """Sun positions sampled every step minutes over each date (local solar
+    day), keeping those at least min_elevation above the horizon. Each
+    position carries the hours it stands for, averaged over the dates, so the
+    hours of the positions a pixel sees add up to its mean daily hours of
+    direct sun.
+
+    Args:
+        lat (float): latitude in degrees
+        lon (float): longitude in degrees
+        dates (list, optional): days to sample. Defaults to the solstices and
+            an equinox.
+        step (float, optional): minutes between samples. Defaults to 60.
+        min_elevation (float, optional): lower suns are left out (their
+            shadows are very long and they carry little energy). Defaults to 5.
+
+    Returns:
+        pd.DataFrame: azimuth, elevation and hours per position
+    """
+    offsets = np.arange(step / 2, 24 * 60, step)
+    times = [pd.Timestamp(day) - pd.Timedelta(hours=lon / 15) + pd.Timedelta(minutes=m)
+             for day in dates for m in offsets]
+    azimuth, elevation = solar_position(pd.DatetimeIndex(times).values, lat, lon)
+    positions = pd.DataFrame({'azimuth': azimuth, 'elevation': elevation,
+                              'hours': step / 60 / len(dates)})
+    return positions[positions['elevation'] >= min_elevation].reset_index(drop=True)
+
+
+def sunlit(dsm, azimuth, elevation, px, origin=(0, 0)):
+    """Pixels of a DSM in direct sun for one sun position
+
+    A pixel is in shadow if any pixel towards the sun rises above the line
+    from the pixel to the sun. Along a line of pixels towards the sun at
+    distances x this means some z_q - x_q tan(elevation) exceeds the pixel's
+    own z_p - x_p tan(elevation), so one reverse cumulative maximum per line
+    tests every pixel at once. The DSM is sheared so those lines (rounded to
+    the nearest pixel) become rows, which makes the sweep O(pixels) for any
+    azimuth. Casters further away than the array edge are not seen; callers
+    add a halo. Lines and distances are taken in the coordinates of the whole
+    raster (see origin), so tiles of a raster give the same result as the
+    whole.
+
+    Args:
+        dsm (np.array): elevations, NaN for nodata (never casts a shadow)
+        azimuth (float): degrees clockwise from north (north up raster)
+        elevation (float): degrees above the horizon
+        px (float): pixel size in map units (same units as the DSM values)
+        origin (tuple, optional): (row, col) of dsm[0, 0] in the whole raster.
+            Defaults to (0, 0).
+
+    Returns:
+        np.array: boolean array, True where the sun is visible
+    """
+    az = np.radians(azimuth)
+    d_row, d_col = -np.cos(az), np.sin(az)
+    # Sweep along the last axis towards the sun: transpose if the sun is
+    # mostly north or south, flip if it lies towards lower indices.
+    transpose = abs(d_row) > abs(d_col)
+    z = dsm.T if transpose else dsm
+    along, across = (d_row, d_col) if transpose else (d_col, d_row)
+    offset = origin[0] if transpose else origin[1]
+    flip = along < 0
+    nrows, ncols = z.shape
+    cols = offset + np.arange(ncols)
+    if flip:
+        z = z[:, ::-1]
+        cols = cols[::-1]
+    slope = across / along
+    step = px / abs(along)
+
+    # Row of pixel (r, c) in the sheared array is r + shift[c], so every line
+    # towards the sun is one row.
+    shift = np.round(-slope * cols).astype(np.int64)
+    shift -= shift.min()
+    sheared = np.full((nrows + shift.max(), ncols), -np.inf, dtype=np.float64)
+    runs = np.flatnonzero(np.r_[True, np.diff(shift) != 0, True])
+    for c0, c1 in zip(runs[:-1], runs[1:]):
+        sheared[shift[c0]:shift[c0] + nrows, c0:c1] = z[:, c0:c1]
+    sheared[np.isnan(sheared)] = -np.inf
+
+    # Distances towards the sun from the raster origin (float64): every pixel
+    # gets exactly the same value in any tile.
+    toward_sun = -cols if flip else cols
+    sheared -= toward_sun * (step * np.tan(np.radians(elevation)))
+    upstream = np.maximum.accumulate(sheared[:, :0:-1], axis=1)[:, ::-1]
+    shade = np.zeros(sheared.shape, dtype=bool)
+    shade[:, :-1] = upstream > sheared[:, :-1]
+
+    lit = np.empty(z.shape, dtype=bool)
+    for c0, c1 in zip(runs[:-1], runs[1:]):
+        lit[:, c0:c1] = ~shade[shift[c0]:shift[c0] + nrows, c0:c1]
+    if flip:
+        lit = lit[:, ::-1]
+    return lit.T if transpose else lit
+
+
+def caster_reach(azimuth, elevation, px, rise):
+    """Pixels to add on each side of a tile so that it holds every pixel that
+    can shade the tile in sunlit() for one sun position. A caster lies towards
+    the sun at most rise / tan(elevation) away, rise being how far the highest
+    caster can stand above the lowest pixel of the tile. Lines towards the sun
+    are rounded to pixels, so they may drift one more pixel across.
+
+    Args:
+        azimuth (float): degrees clockwise from north (north up raster)
+        elevation (float): degrees above the horizon
+        px (float): pixel size in map units (same units as rise)
+        rise (float): height of the highest caster above the lowest pixel
+
+    Returns:
+        tuple: (top, bottom, left, right) pixels to add
+    """
+    if not rise > 0:
+        return 0, 0, 0, 0
+    az = np.radians(azimuth)
+    d_row, d_col = -np.cos(az), np.sin(az)
+    # Same sweep axis as sunlit(): casters are at most k steps along it.
+    transpose = abs(d_row) > abs(d_col)
+    along, across = (d_row, d_col) if transpose else (d_col, d_row)
+    k = int(np.ceil(rise / np.tan(np.radians(elevation)) / (px / abs(along))))
+    drift = int(np.ceil(k * abs(across / along))) + 1
+    along_ext = (0, k) if along > 0 else (k, 0)
+    across_ext = (1, drift) if across > 0 else (drift, 1)
+    rows, cols = (along_ext, across_ext) if transpose else (across_ext, along_ext)
+    return rows + cols
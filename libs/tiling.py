@@ -0,0 +1,107 @@
+import numpy as np
+from rasterio.windows import Window
+
+
+def iter_blocks(height, width, block_size, halo=0):
+    """Walks a raster in square blocks with an optional halo
+
+    The halo is clipped at the raster edge, so a block on the edge sees exactly
+    what a whole-array computation would see there.
+
+    Args:
+        height (int): number of rows in the raster
+        width (int): number of columns in the raster
+        block_size (int): rows/cols per block, excluding the halo
+        halo (int, optional): extra pixels read on each side. Defaults to 0.
+
+    Yields:
+        tuple: (read_window, write_window, inner) where read_window includes the
+            halo, write_window is the block itself and inner is a (row, col)
+            slice pair that crops an array read with read_window to the block.
+    """
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            nrows = min(block_size, height - row)
+            ncols = min(block_size, width - col)
+            r0 = max(row - halo, 0)
+            c0 = max(col - halo, 0)
+            r1 = min(row + nrows + halo, height)
+            c1 = min(col + ncols + halo, width)
+            read_window = Window(c0, r0, c1 - c0, r1 - r0)
+            write_window = Window(col, row, ncols, nrows)
+            inner = (slice(row - r0, row - r0 + nrows),
+                     slice(col - c0, col - c0 + ncols))
+            yield read_window, write_window, inner
+
+
+def iter_box_chips(boxes, height, width, pad=0, gap=8, min_fill=0.25, halo=0):
+    """Groups bounding boxes (e.g. of building footprints) into compact chips
+
+    Each box is grown by pad pixels. Boxes less than about gap pixels apart are
+    grouped (connected cells of a grid with gap pixel cells) and a group 
+    becomes one chip if its boxes cover at least min_fill of the group's 
+    bounding box, so a row of houses is one chip while a sparse neighbourhood 
+    is not read as a whole. Otherwise every box is its own chip. Only the boxes
+    are touched, never the raster, so the cost scales with the number of boxes.
+
+    Args:
+        boxes (list): (row slice, col slice) pairs, e.g. from 
+            scipy.ndimage.find_objects (None entries are skipped)
+        height (int): number of rows in the raster
+        width (int): number of columns in the raster
+        pad (int, optional): pixels added around each box. Defaults to 0.
+        gap (int, optional): grouping distance in pixels, 0 to keep every box
+            on its own. Defaults to 8.
+        min_fill (float, optional): smallest fraction of a grouped chip covered
+            by its boxes. Defaults to 0.25.
+        halo (int, optional): extra pixels read on each side, clipped at the
+            raster edge as in iter_blocks(). Defaults to 0.
+
+    Yields:
+        tuple: (read_window, write_window, inner) as in iter_blocks()
+    """
+    boxes = np.array([(r.start, c.start, r.stop, c.stop) for r, c in
+                      (b for b in boxes if b is not None)], dtype=np.int64).reshape(-1, 4)
+    if not len(boxes):
+        return
+    boxes = np.clip(boxes + [-pad, -pad, pad, pad], 0, [height, width, height, width])
+
+    chips = boxes
+    if gap:
+        from scipy import ndimage
+        # Rectangles of grid cells touched by each box, drawn with a 2D
+        # difference array.
+        cells = np.stack([boxes[:, 0] // gap, boxes[:, 1] // gap,
+                          (boxes[:, 2] - 1) // gap + 1, (boxes[:, 3] - 1) // gap + 1], axis=1)
+        diff = np.zeros((cells[:, 2].max() + 1, cells[:, 3].max() + 1), dtype=np.int32)
+        np.add.at(diff, (cells[:, 0], cells[:, 1]), 1)
+        np.add.at(diff, (cells[:, 0], cells[:, 3]), -1)
+        np.add.at(diff, (cells[:, 2], cells[:, 1]), -1)
+        np.add.at(diff, (cells[:, 2], cells[:, 3]), 1)
+        groups, n_groups = ndimage.label(diff.cumsum(0).cumsum(1) > 0)
+        group = groups[cells[:, 0], cells[:, 1]] - 1
+
+        bounds = np.empty((n_groups, 4), dtype=np.int64)
+        bounds[:, :2] = np.iinfo(np.int64).max
+        bounds[:, 2:] = 0
+        np.minimum.at(bounds[:, 0], group, boxes[:, 0])
+        np.minimum.at(bounds[:, 1], group, boxes[:, 1])
+        np.maximum.at(bounds[:, 2], group, boxes[:, 2])
+        np.maximum.at(bounds[:, 3], group, boxes[:, 3])
+        box_px = np.bincount(group, weights=(boxes[:, 2] - boxes[:, 0]) *
+                             (boxes[:, 3] - boxes[:, 1]), minlength=n_groups)
+        bounds_px = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+        dense = box_px >= min_fill * bounds_px
+        chips = np.concatenate([bounds[dense], boxes[~dense[group]]])
+
+    for row, col, row_stop, col_stop in chips.tolist():
+        nrows, ncols = row_stop - row, col_stop - col
+        r0 = max(row - halo, 0)
+        c0 = max(col - halo, 0)
+        r1 = min(row + nrows + halo, height)
+        c1 = min(col + ncols + halo, width)
+        read_window = Window(c0, r0, c1 - c0, r1 - r0)
+        write_window = Window(col, row, ncols, nrows)
+        inner = (slice(row - r0, row - r0 + nrows),
+                 slice(col - c0, col - c0 + ncols))
+        yield read_window, write_window, inner
@@ -17,6 +17,7 @@ setup(
     packages=['rooftop'],
     package_dir={'rooftop': 'libs'},
     python_requires='>=3.8.3, <4',
-    install_requires=['rasterio', 'fiona', 'numpy', 'boto3', 'geopandas',
-                      'scikit-criteria', 'richdem', 'scikit-learn', 'rasterstats'],  # Optional
+    install_requires=['rasterio', 'fiona>=1.9', 'numpy', 'scipy', 'boto3', 'geopandas>=1.0',
+                      'shapely>=2.0', 'pyarrow', 'richdem'],  # Optional
+    entry_points={'console_scripts': ['rooftop=rooftop.cli:main']},
 )
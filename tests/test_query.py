@@ -0,0 +1,128 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import geopandas as gpd
+import pytest
+import shapely
+from shapely.geometry import box, mapping
+from rooftop.query import IndexQuery, make_server
+
+CRS = 'EPSG:32612'
+X0, Y0 = 400000, 3700000
+
+
+@pytest.fixture(scope='module')
+def index():
+    """A 10 x 10 grid of 20 m rooftops, rank 1 in the south west corner"""
+    rows = [(i, j) for j in range(10) for i in range(10)]
+    geoms = [box(X0 + 50 * i, Y0 + 50 * j, X0 + 50 * i + 20, Y0 + 50 * j + 20)
+             for i, j in rows]
+    ranks = np.arange(1, len(rows) + 1)
+    gdf = gpd.GeoDataFrame({'faid': ranks[::-1] - 1, 'height': [float(i) for i, _ in rows],
+                            'vulnerability': 1 - ranks / 100.0, 'vul_rank': ranks},
+                           geometry=geoms, crs=CRS)
+    # Shuffled and indexed by faid, as written by index_builder().
+    return gdf.sample(frac=1, random_state=0).set_index('faid')
+
+
+@pytest.fixture(scope='module')
+def iq(index):
+    return IndexQuery(index)
+
+
+def test_query_top_k_of_an_area_in_rank_order(iq):
+    pos = iq.query(bbox=(X0, Y0, X0 + 120, Y0 + 120), k=None)
+    assert iq.frame(pos)['vul_rank'].tolist() == [1, 2, 3, 11, 12, 13, 21, 22, 23]
+    assert iq.frame(iq.query(bbox=(X0, Y0, X0 + 120, Y0 + 120), k=4))['vul_rank'].tolist() == \
+        [1, 2, 3, 11]
+    assert iq.frame(iq.query(k=3))['vul_rank'].tolist() == [1, 2, 3]
+
+
+def test_query_polygon_and_filters(iq):
+    triangle = shapely.Polygon([(X0, Y0), (X0 + 200, Y0), (X0, Y0 + 200)])
+    pos = iq.query(geometry=triangle, k=None, filters={'height': (1, None)})
+    frame = iq.frame(pos)
+    assert (frame['height'] >= 1).all()
+    assert shapely.intersects(frame.geometry.values, triangle).all()
+    assert frame['vul_rank'].is_monotonic_increasing
+    contained = iq.query(geometry=triangle, k=None, predicate='contains')
+    assert len(contained) < len(iq.query(geometry=triangle, k=None))
+    top = iq.query(k=5, filters={'height': (8, 9)})
+    assert iq.frame(top)['vul_rank'].tolist() == [9, 10, 19, 20, 29]
+
+
+def test_query_reprojects_the_area(iq):
+    area = gpd.GeoSeries([box(X0, Y0, X0 + 120, Y0 + 120)], crs=CRS).to_crs('EPSG:4326')
+    pos = iq.query(bbox=area.total_bounds, k=None, crs='EPSG:4326')
+    assert set(iq.frame(pos)['vul_rank']) >= {1, 2, 3, 11, 12, 13, 21, 22, 23}
+    collection = json.loads(iq.to_geojson(pos[:1]))
+    lon, lat = collection['features'][0]['geometry']['coordinates'][0][0]
+    assert -113 < lon < -111 and 33 < lat < 34
+    assert collection['features'][0]['properties']['vul_rank'] == 1
+
+
+def test_tiles_hold_every_rooftop_they_touch(iq):
+    tiles = iq.tiles(min_zoom=15, max_zoom=16)
+    assert {z for z, _, _ in tiles} == {15, 16}
+    for z in (15, 16):
+        faids = set()
+        for (tz, _, _), body in tiles.items():
+            if tz == z:
+                collection = json.loads(body)
+                assert collection['type'] == 'FeatureCollection'
+                faids |= {f['properties']['faid'] for f in collection['features']}
+        assert faids == set(range(100))
+
+
+@pytest.fixture(scope='module')
+def server(iq):
+    httpd = make_server(iq, port=0, tiles=iq.tiles(min_zoom=15, max_zoom=15))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_address[1]), iq
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def fetch(url, body=None):
+    data = None if body is None else json.dumps(body).encode()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data)) as r:
+            return r.status, r.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def test_server_get_and_post_queries(server):
+    url, iq = server
+    area = gpd.GeoSeries([box(X0, Y0, X0 + 120, Y0 + 120)], crs=CRS).to_crs('EPSG:4326')
+    bbox = ','.join(str(v) for v in area.total_bounds)
+    status, body = fetch(url + '/query?bbox={}&k=2&filter=height:1:'.format(bbox))
+    assert status == 200
+    assert [f['properties']['vul_rank'] for f in json.loads(body)['features']] == [2, 3]
+
+    status, body = fetch(url + '/query', {'geometry': mapping(area[0]), 'k': 3})
+    assert status == 200
+    assert [f['properties']['vul_rank'] for f in json.loads(body)['features']] == [1, 2, 3]
+
+    status, body = fetch(url + '/query', {'geometry': mapping(area[0]), 'k': 3,
+                                          'crs': CRS, 'filters': {'height': [50, None]}})
+    assert status == 204 and body == b''
+
+
+def test_server_rejects_bad_requests(server):
+    url, _ = server
+    assert fetch(url + '/query?k=many')[0] == 400
+    assert fetch(url + '/query?filter=no_such_column:1:2')[0] == 400
+    assert fetch(url + '/query?bbox=1,2,3')[0] == 400
+    assert fetch(url + '/query', {'geometry': {'type': 'Polygon'}})[0] == 400
+    assert fetch(url + '/nowhere')[0] == 404
+
+
+def test_server_tiles(server):
+    url, iq = server
+    (z, x, y), body = next(iter(iq.tiles(min_zoom=15, max_zoom=15).items()))
+    assert fetch(url + '/tiles/{}/{}/{}.geojson'.format(z, x, y)) == (200, body)
+    assert fetch(url + '/tiles/3/0/0.geojson')[0] == 204
@@ -0,0 +1,511 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+import shapely
+from shapely.geometry import box
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'benchmarks'))
+from synthetic_city import make_city
+from local_s3 import local_s3
+from rooftop.rooftop import RooftopProc
+
+MAIN_DIR = 'city/'
+
+
+@pytest.fixture(scope='module')
+def city():
+    """A 64 building synthetic city on a local S3 server"""
+    dsm, hfdem, bldgs, meta = make_city(64)
+    with local_s3('rooftop-test') as S3:
+        S3.write_raster_to_s3(dsm, MAIN_DIR + 'dsm.tif', meta, cog=True)
+        S3.write_raster_to_s3(hfdem, MAIN_DIR + 'hfdem.tif', meta, cog=True)
+        S3.write_gdf_to_s3(bldgs, MAIN_DIR + 'bldgs.parquet')
+        yield S3, bldgs, meta
+
+
+@pytest.fixture(scope='module')
+def updated_city(city):
+    """The city after a footprint update and a new DSM tile, under city_v2/"""
+    S3, bldgs, meta = city
+    dsm, hfdem, _, _ = make_city(64)
+    new = bldgs[~bldgs['fid'].isin([5])].copy()
+    shrunk = new['fid'] == 20
+    new.loc[shrunk, 'geometry'] = new.loc[shrunk].geometry.buffer(-2, join_style=2)
+    added = bldgs[bldgs['fid'] == 5].copy()
+    added['fid'] = 5000
+    new = gpd.GeoDataFrame(pd.concat([new, added], ignore_index=True), crs=bldgs.crs)
+    dsm[60:90, 100:130] += np.linspace(0, 6, 30, dtype='float32')[None, :]
+    t = meta['transform']
+    changed = [(t[2] + 100 * t[0], t[5] + 90 * t[4], t[2] + 130 * t[0], t[5] + 60 * t[4])]
+    S3.write_raster_to_s3(dsm, 'city_v2/dsm.tif', meta, cog=True)
+    S3.write_raster_to_s3(hfdem, 'city_v2/hfdem.tif', meta, cog=True)
+    S3.write_gdf_to_s3(new, 'city_v2/bldgs.parquet')
+    return S3, bldgs, changed
+
+
+def make_proc(S3, main_dir=MAIN_DIR, **kwargs):
+    return RooftopProc(S3, main_dir, 'dsm.tif', 'hfdem.tif', 'bldgs.parquet', 'fid', **kwargs)
+
+
+def prepared(S3, fa_slope_thresh=45, main_dir=MAIN_DIR, **kwargs):
+    """Processor with slope, height and flat areas, and its rooftops"""
+    proc = make_proc(S3, main_dir)
+    proc.create_slope_arr('slope.tif')
+    proc.create_height_arr('height.tif')
+    flat_bldgs = proc.pitched_roof_filter(11, 9)
+    rooftops = proc.flat_area_disaggregator(flat_bldgs, fa_slope_thresh, 93.903,
+                                            'flat_area.parquet', **kwargs)
+    return proc, rooftops
+
+
+def test_label_grid_sees_changed_shapes(city):
+    S3, bldgs, meta = city
+    proc = make_proc(S3)
+    t = meta['transform']
+    x0, y1 = t * (10, 10)
+    x1, y0 = t * (40, 40)
+    solid = gpd.GeoDataFrame({'id': [1]}, geometry=[box(x0, y0, x1, y1)], crs=bldgs.crs)
+    holed = solid.copy()
+    holed['geometry'] = solid.geometry.difference(box(x0 + 10, y0 + 10, x0 + 20, y0 + 20))
+    assert (proc._label_grid(solid, 'id', 'test').labels > 0).sum() == 900
+    assert (proc._label_grid(holed, 'id', 'test').labels > 0).sum() == 800
+
+
+
+def test_flat_areas_of_rotated_footprints_match_overlay(city):
+    from shapely import affinity
+
+    S3, bldgs, meta = city
+    t = meta['transform']
+    x0, y0 = t * (40, 60)
+    footprints = [affinity.rotate(box(x0, y0, x0 + 41, y0 + 22.5), 17),
+                  affinity.rotate(box(x0 + 60, y0, x0 + 90.5, y0 + 25.3), -33)]
+    roofs = gpd.GeoDataFrame({'fid': [1, 2]}, geometry=footprints, crs=bldgs.crs)
+    proc = make_proc(S3)
+    proc.slope_arr = np.zeros((meta['height'], meta['width']), dtype='float32')
+    rooftops = proc.flat_area_disaggregator(roofs, 45, 50, 'rotated.parquet')
+
+    scene = gpd.GeoDataFrame(geometry=[box(*proc.dsm_rio.bounds)], crs=bldgs.crs)
+    overlay = gpd.overlay(scene, roofs, how='intersection')
+    np.testing.assert_allclose(rooftops['flat_area'].values, overlay.area.values)
+
+
+def test_pitched_roof_filter_counts_only_footprint_pixels(city):
+    S3, bldgs, meta = city
+    t = meta['transform']
+    x0, y1 = t * (20, 20)
+    x1, y0 = t * (60, 60)
+    xm, ym = t * (30, 30)
+    # L-shape: 40 x 40 pixels minus a 30 x 30 corner, 700 pixels.
+    ell = box(x0, y0, x1, y1).difference(box(xm, y0, x1, ym))
+    proc = make_proc(S3, crop_to_bldgs=False)
+    proc.bldgs = gpd.GeoDataFrame({'fid': [1]}, geometry=[ell], crs=bldgs.crs)
+    slope = np.full((meta['height'], meta['width']), 30, dtype='float32')
+    slope[20:30, 20:60] = 0
+    proc.slope_arr = slope
+    flat = proc.pitched_roof_filter(11, 50)
+    pixel = t[0] * -t[4]
+    assert flat['total_area'].tolist() == [700 * pixel]
+    assert flat['flat_area'].tolist() == [400 * pixel]
+    proc.slope_histograms()
+    binned = proc.pitched_roof_filter(11, 50)
+    assert binned['total_area'].tolist() == [700 * pixel]
+
+
+def test_multipolygons_are_split_in_row_order():
+    from shapely.geometry import GeometryCollection, LineString, MultiPolygon, Polygon
+
+    a, b, c, d, e = (box(i, 0, i + 1, 1) for i in range(0, 10, 2))
+    gdf = gpd.GeoDataFrame(
+        {'fid': np.array([7, 3, 9, 1], dtype='int32'), 'height': [1.5, 2.5, 3.5, 4.5],
+         'kind': pd.Categorical(['x', 'y', 'x', 'z'])},
+        geometry=[MultiPolygon([a, b]), c,
+                  GeometryCollection([LineString([(0, 0), (1, 1)]), d,
+                                      GeometryCollection([MultiPolygon([e])])]),
+                  Polygon()],
+        index=[10, 20, 30, 40], crs='EPSG:32612')
+    out = RooftopProc(None, MAIN_DIR, 'dsm.tif', 'hfdem.tif', gdf, 'fid') \
+        .convert_multipgons_to_pgons(gdf)
+    assert out['fid'].tolist() == [7, 7, 3, 9, 9]
+    assert out['height'].tolist() == [1.5, 1.5, 2.5, 3.5, 3.5]
+    assert list(out.index) == list(range(5))
+    assert out.dtypes.equals(gdf.dtypes)
+    assert out.crs == gdf.crs
+    assert shapely.equals(out.geometry.values, [a, b, c, d, e]).all()
+
+def test_volume_after_new_flat_areas_matches_fresh_processor(city):
+    S3, _, _ = city
+    proc, rooftops = prepared(S3, fa_slope_thresh=45)
+    proc.feature_builder(rooftops, ['volume_on_roof'])
+    rooftops = proc.flat_area_disaggregator(proc.flat_bldgs, 20, 93.903, 'fa.parquet')
+    reused = proc.feature_builder(rooftops, ['volume_on_roof'])
+    fresh_proc, fresh_rooftops = prepared(S3, fa_slope_thresh=20)
+    fresh = fresh_proc.feature_builder(fresh_rooftops, ['volume_on_roof'])
+    np.testing.assert_allclose(reused['volume'].values, fresh['volume'].values)
+
+
+def test_recomputed_feature_keeps_its_weight_position(city):
+    S3, _, _ = city
+    proc, rooftops = prepared(S3)
+    full = proc.feature_builder(rooftops, ['height', 'average_slope', 'volume_on_roof'])
+    order = list(proc.col_names)
+    wts = [0.1, 0.2, 0.3, 0.4]
+    index = proc.index_builder(full, wts=wts, out_fname='index.parquet')
+    full = proc.feature_builder(full, ['height'])
+    assert proc.col_names == order
+    again = proc.index_builder(full, wts=wts, out_fname='index.parquet')
+    np.testing.assert_array_equal(index['vul_rank'].values, again['vul_rank'].values)
+
+
+
+def test_criteria_follow_the_requested_feature_order(city):
+    S3, _, _ = city
+    proc, rooftops = prepared(S3)
+    proc.feature_builder(rooftops, ['height', 'volume_on_roof', 'average_slope'])
+    assert [c[0] for c in proc.col_names] == ['flat_area', 'height', 'volume', 'avg_slope']
+
+    proc, rooftops = prepared(S3)
+    proc.feature_builder(rooftops, ['average_slope', 'volume_on_roof'])
+    assert [c[0] for c in proc.col_names] == ['flat_area', 'avg_slope', 'height', 'volume']
+
+def test_index_stage_does_not_open_inputs(city):
+    S3, bldgs, _ = city
+    proc = make_proc(S3)
+    proc.col_names = [('height', False), ('avg_slope', True)]
+    full = gpd.GeoDataFrame({'faid': range(3), 'height': [3.0, 5.0, 4.0],
+                             'avg_slope': [2.0, 1.0, 4.0]},
+                            geometry=bldgs.geometry.values[:3], crs=bldgs.crs)
+    proc.index_builder(full, out_fname='index.parquet')
+    assert proc._inputs == {}
+    assert proc.instrument.events[-1]['pixels'] is None
+
+
+def test_concurrent_stages_profile_one_at_a_time(tmp_path):
+    import threading
+    from rooftop.instrument import Instrument
+
+    instrument = Instrument(profile=True, profile_dir=str(tmp_path))
+    barrier = threading.Barrier(4)
+
+    def run(i):
+        with instrument.stage('stage_{}'.format(i)):
+            barrier.wait()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum('profile' in e for e in instrument.events) == 1
+    assert not instrument._profiling
+
+
+
+def ring_reference(proc, rooftops, width):
+    """Median slope and parapet height of a ring of the given width inside each
+    flat footprint, from vector rings"""
+    from rooftop.zonal import LabelGrid
+
+    bldgs = proc.flat_bldgs
+    inner = bldgs.geometry.buffer(-width, join_style=2)
+    shape, transform = proc.slope_arr.shape, proc.meta['transform']
+    stats = {}
+    for name, geoms in (('ring', bldgs.geometry.difference(inner)), ('interior', inner)):
+        layer = gpd.GeoDataFrame({'fid': bldgs['fid'].values}, geometry=geoms.values,
+                                 crs=bldgs.crs)
+        grid = LabelGrid.from_gdf(layer, 'fid', shape, transform)
+        zstats = grid.zonal_stats({'slope': proc.slope_arr, 'height': proc.height_arr},
+                                  stats=['median'], nodata=proc.meta['nodata'])
+        stats[name] = zstats
+    slope = rooftops['fid'].map(stats['ring']['slope_median']).values
+    height = rooftops['fid'].map(stats['ring']['height_median'] -
+                                 stats['interior']['height_median']).values
+    return slope, height
+
+
+@pytest.mark.parametrize('width', [1, 1.7])
+def test_raster_parapet_matches_vector_rings(city, width):
+    S3, _, _ = city
+    proc, rooftops = prepared(S3)
+    raster = proc.feature_builder(rooftops, ['parapet', 'parapet_height'],
+                                  parapet_mode='raster', parapet_width=width)
+    slope, height = ring_reference(proc, rooftops, width)
+    np.testing.assert_allclose(raster['parapet_slope'].values, slope)
+    np.testing.assert_allclose(raster['parapet_height'].values, height)
+    if width == 1:
+        vector = proc.feature_builder(rooftops, ['parapet'], parapet_mode='vector')
+        np.testing.assert_allclose(raster['parapet_slope'].values,
+                                   vector['parapet_slope'].values)
+
+def test_sun_exposure_does_not_depend_on_tiles(city):
+    S3, _, _ = city
+    proc, rooftops = prepared(S3)
+    whole = proc.feature_builder(rooftops, ['sun_exposure'], sun_step=120)
+    assert 'sun_hours' not in proc.rasters
+    tiled = proc.feature_builder(rooftops, ['sun_exposure'], sun_step=120, sun_tile_size=37)
+    np.testing.assert_allclose(whole['sun_hours'].values, tiled['sun_hours'].values)
+    assert whole['sun_hours'].between(0, 24).all()
+
+
+def test_sun_exposure_sees_shadows_from_hills(city):
+    S3, _, _ = city
+    proc, rooftops = prepared(S3)
+    dsm = proc._read_band(proc.dsm_rio).astype('float32')
+    # A ridge along the south edge, far beyond the tallest building's shadow.
+    dsm[-8:, :] += 200
+    proc.rasters.put('dsm', dsm)
+    whole = proc.feature_builder(rooftops, ['sun_exposure'], sun_step=120,
+                                 sun_min_elevation=30)
+    tiled = proc.feature_builder(rooftops, ['sun_exposure'], sun_step=120,
+                                 sun_min_elevation=30, sun_tile_size=37)
+    np.testing.assert_allclose(whole['sun_hours'].values, tiled['sun_hours'].values)
+
+
+
+def with_tower(S3):
+    """Prepared processor with a 120 m tower in the north west of its DSM"""
+    proc, rooftops = prepared(S3)
+    dsm = proc._read_band(proc.dsm_rio).astype('float32')
+    dsm[10:14, 10:14] += 120
+    proc.rasters.put('dsm', dsm)
+    return proc, rooftops, dsm
+
+
+def test_sun_exposure_matches_a_whole_raster_sweep(city):
+    from rooftop.sun import sunlit
+
+    S3, _, meta = city
+    proc, rooftops, dsm = with_tower(S3)
+    dsm[dsm == meta['nodata']] = np.nan
+    positions = proc._sun_positions(step=120, min_elevation=10)
+    hours = sum(sunlit(dsm, p.azimuth, p.elevation, meta['transform'][0]) * p.hours
+                for p in positions.itertuples())
+    expected = proc._label_grid(rooftops, 'faid').zonal_stats({'h': hours})['h_mean']
+    tiled = proc.feature_builder(rooftops, ['sun_exposure'], sun_step=120,
+                                 sun_min_elevation=10, sun_tile_size=23)
+    np.testing.assert_allclose(tiled['sun_hours'].values, expected.values, rtol=1e-6)
+
+
+def test_sun_strips_only_reach_towards_the_sun(city):
+    from rasterio.windows import Window
+
+    S3, _, meta = city
+    proc, _, _ = with_tower(S3)
+    tile = Window(90, 90, 16, 16)
+    lowest = proc._block_stat(tile, False)
+    # Sun from the south east: the tower in the north west cannot shade the tile.
+    strip = proc._caster_window(tile, 135, 20, meta['transform'][0], lowest)
+    assert strip.row_off >= tile.row_off - 1 and strip.col_off >= tile.col_off - 1
+    t = meta['transform']
+    x0, y1 = t * (10, 10)
+    x1, y0 = t * (14, 14)
+    tower = proc._sun_reach((x0, y0, x1, y1), min_elevation=20)
+    x0, y1 = t * (130, 130)
+    x1, y0 = t * (134, 134)
+    assert 0 < proc._sun_reach((x0, y0, x1, y1), min_elevation=20) < tower / 2
+
+def assert_same_faids(expected, actual):
+    assert list(expected.columns) == list(actual.columns)
+    assert len(expected) == len(actual)
+    for col in expected.columns:
+        if col == 'geometry':
+            assert shapely.equals_exact(expected.geometry.values, actual.geometry.values,
+                                        tolerance=1e-6).all()
+        else:
+            np.testing.assert_allclose(expected[col].astype(float).values,
+                                       actual[col].astype(float).values)
+
+
+INCREMENTAL_FEATURES = ['average_slope', 'height', 'volume_on_roof', 'parapet',
+                        'parapet_height', 'sun_exposure']
+SUN_KWARGS = dict(sun_step=120, sun_min_elevation=30)
+
+
+def test_update_domains_matches_full_run(updated_city):
+    from rooftop.incremental import update_domains
+
+    S3, old_bldgs, changed = updated_city
+    proc, rooftops = prepared(S3)
+    previous = proc.feature_builder(rooftops, INCREMENTAL_FEATURES, **SUN_KWARGS)
+    full_proc, rooftops = prepared(S3, main_dir='city_v2/')
+    full = full_proc.feature_builder(rooftops, INCREMENTAL_FEATURES, **SUN_KWARGS)
+
+    updated = update_domains(make_proc(S3, 'city_v2/'), previous, old_bldgs, 100, 'u_slope.tif',
+                             'u_height.tif', 'u_flat_area.parquet', INCREMENTAL_FEATURES,
+                             changed_bounds=changed, footprints_only=False, max_workers=2,
+                             **SUN_KWARGS)
+    assert_same_faids(full, updated)
+
+
+def test_run_job_reports_skipped_stages(city, tmp_path):
+    import glob
+    from rooftop.cli import DEFAULTS, run_job
+
+    S3, _, _ = city
+    settings = {'bucket': S3.bucket, 'endpoint_url': S3.endpoint_url, 'cache_dir': None}
+    job = dict(DEFAULTS, name='city', main_dir=MAIN_DIR, dsm='dsm.tif', hfdem='hfdem.tif',
+               bldgs='bldgs.parquet')
+    first = run_job(settings, job, str(tmp_path))
+    assert set(first['stages'].values()) == {'computed'}
+
+    for path in glob.glob(str(tmp_path / 'city' / 'slope-*')):
+        os.remove(path)
+    second = run_job(settings, dict(job, wts=[0.3, 0.2, 0.2, 0.2, 0.1]), str(tmp_path))
+    assert second['stages'] == {'slope': 'skipped', 'height': 'cached', 'flat_bldgs': 'cached',
+                                'flat_area': 'cached', 'features': 'cached',
+                                'index': 'computed'}
+    assert second['faids'] == first['faids']
+
+
+def test_point_layer_read_does_not_hold_the_processor_lock(city):
+    import threading
+
+    S3, bldgs, _ = city
+    started, release = threading.Event(), threading.Event()
+
+    class SlowS3(object):
+        def __getattr__(self, name):
+            return getattr(S3, name)
+
+        def read_gdf_from_s3(self, path, **kwargs):
+            started.set()
+            release.wait(10)
+            return gpd.GeoDataFrame(geometry=bldgs.centroid, crs=bldgs.crs)
+
+    proc = make_proc(S3)
+    proc.epsg
+    proc.S3 = SlowS3()
+    loader = threading.Thread(target=proc._point_index, args=('pts.parquet',))
+    loader.start()
+    assert started.wait(10)
+    other = threading.Thread(target=proc._add_col_name, args=('height', False))
+    other.start()
+    other.join(5)
+    assert not other.is_alive()
+    release.set()
+    loader.join()
+    assert proc._point_index('pts.parquet') is proc._point_index('pts.parquet')
+
+
+def test_closeness_to_pts_k_and_radius(city):
+    S3, bldgs, _ = city
+    pts = bldgs.iloc[:3][['fid', 'geometry']].copy()
+    pts['geometry'] = pts.representative_point()
+    S3.write_gdf_to_s3(pts, MAIN_DIR + 'three_pts.parquet')
+    proc, rooftops = prepared(S3)
+    centers = rooftops.centroid
+    dist = np.stack([centers.distance(p) for p in pts.geometry], axis=1)
+    dist.sort(axis=1)
+
+    # k past the number of points is the mean distance to all of them.
+    for k, expected in ((1, dist[:, 0]), (2, dist[:, :2].mean(axis=1)),
+                        (10, dist.mean(axis=1))):
+        full = proc.feature_builder(rooftops, ['closeness_to_pts'],
+                                    ctp_paths=['three_pts.parquet'], ctp_k=k)
+        np.testing.assert_allclose(full['three_pts'].values, expected)
+    index = proc.index_builder(full, out_fname='ctp_index.parquet')
+    assert np.isfinite(index['vulnerability']).all()
+
+    radius = np.median(dist[:, 0])
+    full = proc.feature_builder(rooftops, ['closeness_to_pts'],
+                                ctp_paths=['three_pts.parquet'], ctp_radius=radius)
+    np.testing.assert_array_equal(full['three_pts_count'].values,
+                                  (dist <= radius).sum(axis=1))
+    assert 0 < full['three_pts_count'].sum() < 3 * len(rooftops)
+
+    with pytest.raises(ValueError):
+        proc.feature_builder(rooftops, ['closeness_to_pts'],
+                             ctp_paths=['three_pts.parquet'], ctp_k=0)
+
+
+def test_flat_cleanup_does_not_depend_on_tiles():
+    from rooftop.cleanup import clean_flat_labels, clean_flat_tile, cleanup_halo
+
+    rng = np.random.default_rng(0)
+    slope = rng.uniform(0, 30, (120, 150)).astype('float32')
+    labels = np.zeros(slope.shape, dtype='int32')
+    labels[5:115, 10:70] = 1
+    labels[20:60, 80:145] = 2
+    labels[70:110, 80:82] = 3
+    args = (slope, labels, 15, 1, 1, 1, 60)
+    whole = clean_flat_tile(*args)
+    assert 0 < (whole > 0).sum() < (labels > 0).sum()
+    for tile_size in (16, 37, 1024):
+        np.testing.assert_array_equal(clean_flat_labels(*args, tile_size=tile_size), whole)
+    assert cleanup_halo(1, 1, 1) == 8
+
+
+def test_label_grid_matches_rasterstats(city):
+    rasterstats = pytest.importorskip('rasterstats')
+    S3, bldgs, meta = city
+    dsm, _, _, _ = make_city(64)
+    proc = make_proc(S3)
+    stats = ['count', 'mean', 'min', 'max', 'median']
+    zstats = proc._label_grid(bldgs, 'fid', 'bldgs').zonal_stats(
+        {'dsm': dsm}, stats=stats, nodata=meta['nodata'])
+    expected = pd.DataFrame(rasterstats.zonal_stats(bldgs, dsm, affine=meta['transform'],
+                                                    nodata=meta['nodata'], stats=stats))
+    for stat in stats:
+        np.testing.assert_allclose(zstats['dsm_' + stat].values, expected[stat].values,
+                                   rtol=1e-6)
+
+
+def test_blocked_slope_and_height_match_whole_raster(city):
+    S3, _, _ = city
+    whole = make_proc(S3)
+    blocked = make_proc(S3)
+    sparse = make_proc(S3)
+    slope = whole.create_slope_arr('slope.tif')
+    np.testing.assert_array_equal(blocked.create_slope_arr('b_slope.tif', block_size=50), slope)
+    np.testing.assert_array_equal(blocked.create_height_arr('b_height.tif', block_size=50),
+                                  whole.create_height_arr('height.tif'))
+    chips = sparse.create_slope_arr('s_slope.tif', block_size=50, footprints_only=True)
+    roofs = whole._label_grid(whole.bldgs, 'fid', 'bldgs').labels > 0
+    np.testing.assert_array_equal(chips[roofs], slope[roofs])
+
+
+def test_histogram_filter_matches_zonal_filter(city):
+    S3, _, _ = city
+    zonal = make_proc(S3)
+    zonal.create_slope_arr('slope.tif')
+    binned = make_proc(S3)
+    binned.create_slope_arr('slope.tif')
+    binned.slope_histograms()
+    expected = zonal.pitched_roof_filter(11, 9)
+    actual = binned.pitched_roof_filter(11, 9)
+    assert binned._cached_slope_hist() is not None
+    assert list(actual['fid']) == list(expected['fid'])
+    for col in ('total_area', 'flat_area'):
+        np.testing.assert_allclose(actual[col].values, expected[col].values)
+    sweep = binned.pitched_roof_sweep([11], [9])
+    assert sweep.iloc[0]['n_flat_bldgs'] == len(expected)
+
+
+def test_index_scenarios_match_index_builder(city):
+    S3, _, _ = city
+    proc, rooftops = prepared(S3)
+    full = proc.feature_builder(rooftops, ['height', 'average_slope', 'volume_on_roof'])
+    scenarios = {'equal': [0.25, 0.25, 0.25, 0.25], 'height': [0.7, 0.1, 0.1, 0.1]}
+    closeness, rank = proc.index_scenarios(full, scenarios)
+    for name, wts in scenarios.items():
+        index = proc.index_builder(full, wts=wts, out_fname='index.parquet')
+        np.testing.assert_allclose(closeness[name].values, index['vulnerability'].values)
+        np.testing.assert_array_equal(rank[name].values, index['vul_rank'].values)
+
+
+def test_run_domains_matches_full_run(city):
+    from rooftop.domains import run_domains
+
+    S3, _, _ = city
+    proc, rooftops = prepared(S3)
+    full = proc.feature_builder(rooftops, INCREMENTAL_FEATURES, **SUN_KWARGS)
+    merged = run_domains(make_proc(S3), 100, 'd_slope.tif', 'd_height.tif',
+                         'd_flat_area.parquet', INCREMENTAL_FEATURES, max_workers=2,
+                         **SUN_KWARGS)
+    # Domains number their FAIDs in domain order, so compare building by building.
+    merged = merged.drop(columns=['domain', 'faid']).sort_values('fid', kind='stable')
+    full = full.drop(columns='faid').sort_values('fid', kind='stable')
+    assert_same_faids(full.reset_index(drop=True), merged.reset_index(drop=True))
@@ -0,0 +1,146 @@
+import os
+import sys
+import fcntl
+import numpy as np
+import geopandas as gpd
+import pytest
+import shapely
+from shapely.geometry import box
+from rooftop.cache import LocalCache
+from rooftop.s3utils import S3Helper
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'benchmarks'))
+from local_s3 import local_s3
+
+
+def _fetcher(data):
+    return lambda f: f.write(data)
+
+
+def test_evict_keeps_lock_files_and_busy_entries(tmp_path):
+    cache = LocalCache(str(tmp_path), max_bytes=150)
+    old = cache.get('bucket', 'old.tif', 'a', _fetcher(b'x' * 100))
+    os.utime(old, (1, 1))
+    busy = cache.get('bucket', 'busy.tif', 'b', _fetcher(b'y' * 100))
+    os.utime(busy, (2, 2))
+    # Another process is re-validating the busy entry.
+    with open(busy + LocalCache.LOCK_SUFFIX, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        new = cache.get('bucket', 'new.tif', 'c', _fetcher(b'z' * 100))
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+    assert not os.path.exists(old)
+    assert os.path.exists(busy) and os.path.exists(new)
+    for path in (old, busy, new):
+        assert os.path.exists(path + LocalCache.LOCK_SUFFIX)
+
+
+def test_gdal_env_limits_extensions_to_single_file_formats():
+    from rooftop.s3utils import S3Helper
+
+    S3 = S3Helper('bucket')
+    assert S3._gdal_env('city/dsm.tif')['CPL_VSIL_CURL_ALLOWED_EXTENSIONS'] == '.tif'
+    assert S3._gdal_env('city/bldgs.fgb')['CPL_VSIL_CURL_ALLOWED_EXTENSIONS'] == '.fgb'
+    for path in ('city/dsm.vrt', 'city/ortho.jp2', 'city/bldgs.gpkg'):
+        assert 'CPL_VSIL_CURL_ALLOWED_EXTENSIONS' not in S3._gdal_env(path)
+
+
+def test_import_does_not_load_heavy_dependencies():
+    import subprocess
+    import sys
+
+    code = ('import sys, rooftop.s3utils, rooftop.rooftop\n'
+            'print(" ".join(m for m in ("pyarrow.fs", "richdem", "scipy.ndimage")\n'
+            '               if m in sys.modules))')
+    out = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True,
+                         text=True).stdout
+    assert out.strip() == ''
+
+
+@pytest.fixture(scope='module')
+def s3():
+    with local_s3('s3utils-test') as S3:
+        yield S3
+
+
+@pytest.fixture(params=['s3', 'cache'])
+def helper(request, s3, tmp_path):
+    """The local S3 bucket read directly (GDAL /vsis3, pyarrow S3) or through
+    the local cache"""
+    if request.param == 's3':
+        return s3
+    return S3Helper(s3.bucket, endpoint_url=s3.endpoint_url, cache_dir=str(tmp_path))
+
+
+def layer():
+    """Grid of 30 x 30 boxes with integer, float and string attributes"""
+    cells = [(i, j) for j in range(30) for i in range(30)]
+    return gpd.GeoDataFrame({'fid': np.arange(len(cells), dtype='int64'),
+                             'height': [i * 0.5 for i, _ in cells],
+                             'name': ['b{}'.format(n) for n in range(len(cells))]},
+                            geometry=[box(400000 + 10 * i, 3700000 + 10 * j,
+                                          400000 + 10 * i + 8, 3700000 + 10 * j + 8)
+                                      for i, j in cells], crs='EPSG:32612')
+
+
+@pytest.mark.parametrize('ext', ['parquet', 'fgb'])
+def test_vector_layers_round_trip(helper, s3, ext):
+    gdf = layer()
+    s3.write_gdf_to_s3(gdf, 'layers/grid.' + ext, row_group_size=100)
+    back = helper.read_gdf_from_s3('layers/grid.' + ext).sort_values('fid').reset_index(drop=True)
+    assert back.crs == gdf.crs
+    assert back[['fid', 'height', 'name']].equals(gdf[['fid', 'height', 'name']])
+    assert shapely.equals(back.geometry.values, gdf.geometry.values).all()
+
+
+@pytest.mark.parametrize('ext', ['parquet', 'fgb'])
+def test_bbox_reads_return_only_intersecting_features(helper, s3, ext):
+    gdf = layer()
+    s3.write_gdf_to_s3(gdf, 'layers/bbox.' + ext, row_group_size=100)
+    bbox = (400052, 3700101, 400095, 3700143)
+    back = helper.read_gdf_from_s3('layers/bbox.' + ext, bbox=bbox)
+    expected = gdf['fid'][gdf.intersects(box(*bbox))]
+    assert sorted(back['fid']) == sorted(expected) and len(expected) == 25
+
+
+def test_background_uploads_land_after_wait(s3, monkeypatch):
+    import threading
+    import time
+    from io import BytesIO
+    from rooftop import s3utils
+
+    pools = []
+
+    class CountingPool(s3utils.ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            time.sleep(0.1)  # widen the window for racing writers
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(s3utils, 'ThreadPoolExecutor', CountingPool)
+    helper = S3Helper(s3.bucket, endpoint_url=s3.endpoint_url, background=True)
+    barrier = threading.Barrier(8)
+
+    def write(i):
+        barrier.wait()
+        helper._upload(BytesIO(b'x' * i), 'background/{}.bin'.format(i))
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    helper.wait()
+    assert len(pools) == 1
+    for i in range(8):
+        assert s3.read_bytes('background/{}.bin'.format(i)) == b'x' * i
+
+
+def test_wait_raises_upload_errors(s3):
+    from io import BytesIO
+
+    helper = S3Helper('no-such-bucket', endpoint_url=s3.endpoint_url, background=True)
+    helper._upload(BytesIO(b'x'), 'lost.bin')
+    with pytest.raises(Exception, match='NoSuchBucket|does not exist'):
+        helper.wait()
+    helper.wait()